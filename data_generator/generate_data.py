@@ -37,15 +37,16 @@ def generator_loop(generator_config, client, normal_data):
     else:
         df_mask = df[dataset_label] == 1
 
-    # Get a single random row that is normal or anomalous
-    df_sample = df[df_mask].sample(n=1, random_state=np.random.RandomState())
+    # Get batch_size random rows that are normal or anomalous, a single row is sent as a flat list.
+    # Rows only repeat within a batch if there are fewer matching rows than batch_size
+    batch_size = generator_config.get("batch_size", 1)
+    df_pool = df[df_mask]
+    df_sample = df_pool.sample(n=batch_size, replace=batch_size > len(df_pool), random_state=np.random.RandomState())
     df_sample = df_sample.drop(dataset_label, axis=1)
-    json_sample = df_sample.to_json(orient="split", index=False)
-    
-    json_values = json.loads(json_sample)
-    list_value = {"data": json_values["data"][0]}
+    rows = df_sample.values.tolist()
+    list_value = {"data": rows[0] if batch_size == 1 else rows}
        
-    client.publish(generator_config["pub_topic"], str(list_value))
+    client.publish(generator_config["pub_topic"], json.dumps(list_value))
     if generator_config['publish_interval'] > 0:
         time.sleep(int(generator_config['publish_interval']))
     
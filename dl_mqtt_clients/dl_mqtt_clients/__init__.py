@@ -1,5 +1,18 @@
-from .net.net import KerasNN
-from .mosqeras import ad_mosqeras
-from .model_server.server import ModelAggregator
+#imported on first use so that e.g. the NumPy predict backend does not pull in TensorFlow
+_lazy_imports = {'KerasNN': ('.net.net', 'KerasNN'),
+                 'ad_mosqeras': ('.mosqeras.ad_mosqeras', None),
+                 'ModelAggregator': ('.model_server.server', 'ModelAggregator')}
+
+def __getattr__(name):
+    if name not in _lazy_imports:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    import importlib
+    module, attr = _lazy_imports[name]
+    value = importlib.import_module(module, __name__)
+    if attr is not None:
+        value = getattr(value, attr)
+    globals()[name] = value
+    return value
+
 __version__ = '0.0.1-dev1'
-__all__ = ["KerasNN", "ad_mosqeras", "ModelAggregator"]
\ No newline at end of file
+__all__ = ["KerasNN", "ad_mosqeras", "ModelAggregator"]
@@ -2,9 +2,127 @@ import abc
 import paho.mqtt.client as mqtt
 import ssl
 import logging
+import threading
+import time
+import functools
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
 from dl_mqtt_clients.func._general_func import _translate_mosq_protocol, _translate_ssl_protocol
+from dl_mqtt_clients.func._transport_func import is_chunk_frame, split_payload, parse_chunk, is_codec_frame, compress_payload, decompress_payload
 from dl_mqtt_clients.configurations import MQTTConnectionConfig
 
+class _decoded_msg():
+    """
+    Stand-in for paho's MQTTMessage handed to callbacks once a chunked payload is complete and/or decompressed
+    """
+    def __init__(self, msg, payload):
+        self.topic = msg.topic
+        self.qos = msg.qos
+        self.retain = msg.retain
+        self.payload = payload
+
+class _chunk_reassembler():
+    """
+    Collects chunk frames (see func/_transport_func.py) per topic and transfer id and returns the payload once all chunks
+    arrived. Chunks may arrive out of order or more than once. Transfers that are not completed within timeout seconds
+    are dropped, as are the oldest pending transfers once the buffered bytes would exceed max_bytes. While transfers are
+    pending a daemon thread expires them every timeout / 2 seconds, so they are dropped even if no further chunk arrives.
+
+    Args:
+        timeout (float): seconds a transfer may stay incomplete
+        max_bytes (int): maximum number of bytes buffered for incomplete transfers
+    """
+    def __init__(self, timeout, max_bytes):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._pending = OrderedDict()
+        self._pending_bytes = 0
+        #recently completed / dropped transfers, late duplicate chunks of those are ignored
+        self._finished = OrderedDict()
+        self._lock = threading.Lock()
+        self._sweeper = None
+        self._closed = threading.Event()
+
+    def pending(self):
+        return len(self._pending)
+
+    def _finish(self, key):
+        _transfer = self._pending.pop(key)
+        self._pending_bytes -= len(_transfer['buffer'])
+        self._finished[key] = True
+        while len(self._finished) > 256:
+            self._finished.popitem(last=False)
+        return _transfer
+
+    def _drop(self, key, reason):
+        _transfer = self._finish(key)
+        self.logger.warning("Dropping chunked transfer on topic {} ({} of {} chunks received): {}".format(
+            key[0], len(_transfer['received']), _transfer['count'], reason))
+
+    def _sweep_loop(self):
+        while not self._closed.wait(self.timeout / 2.0):
+            self.expire()
+            with self._lock:
+                if not self._pending:
+                    self._sweeper = None
+                    return
+
+    def _start_sweeper(self):
+        #called with the lock held when a transfer starts
+        if self._sweeper is None and not self._closed.is_set():
+            self._sweeper = threading.Thread(target=self._sweep_loop, name='chunk_sweeper', daemon=True)
+            self._sweeper.start()
+
+    def close(self):
+        """
+        Stops the expiry thread
+        """
+        self._closed.set()
+
+    def expire(self, now=None):
+        """
+        Drops transfers that have not completed within the timeout
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            for key in [k for k, t in self._pending.items() if now - t['started'] > self.timeout]:
+                self._drop(key, 'timed out')
+
+    def add(self, topic, payload):
+        """
+        Adds a chunk frame. Returns the reassembled payload (bytes) when the transfer is complete, None otherwise
+        """
+        header, data = parse_chunk(payload)
+        self.expire()
+        key = (topic, header['transfer_id'])
+        with self._lock:
+            if key in self._finished:
+                return None
+            _transfer = self._pending.get(key)
+            if _transfer is None:
+                if header['total'] > self.max_bytes:
+                    self.logger.warning("Ignoring chunked transfer on topic {} of {} bytes, larger than max_bytes {}".format(topic, header['total'], self.max_bytes))
+                    self._finished[key] = True
+                    return None
+                while self._pending and self._pending_bytes + header['total'] > self.max_bytes:
+                    self._drop(next(iter(self._pending)), 'reassembly buffer full')
+                _transfer = {'buffer': bytearray(header['total']), 'received': set(), 'count': header['count'],
+                             'total_crc': header['total_crc'], 'started': time.time()}
+                self._pending[key] = _transfer
+                self._pending_bytes += header['total']
+                self._start_sweeper()
+            _transfer['buffer'][header['offset']:header['offset'] + len(data)] = data
+            _transfer['received'].add(header['index'])
+            if len(_transfer['received']) < _transfer['count']:
+                return None
+            self._finish(key)
+        if zlib.crc32(_transfer['buffer']) != _transfer['total_crc']:
+            self.logger.warning("Chunked transfer on topic {} failed checksum, dropping".format(topic))
+            return None
+        return bytes(_transfer['buffer'])
+
 class _mosq_client():
 
     def _validate_att(self):
@@ -23,6 +141,13 @@ class _mosq_client():
         self.client.on_connect = self._on_connect
         self.logger = logging.getLogger(self.__class__.__name__)
         self.topic_callback_map = {}
+        self.reassembler = _chunk_reassembler(timeout=self.mqtt_config.chunk_timeout(), max_bytes=self.mqtt_config.max_reassembly_bytes())
+        #compression runs on this worker instead of the caller / paho network thread; one worker keeps publish order
+        self._codec_executor = None
+        #received compressed payloads are decompressed and handed to their callback on this worker, in arrival order
+        self._receive_executor = None
+        self._codec_stats = {'publish': {}, 'receive': {}}
+        self._codec_stats_lock = threading.Lock()
         if on_message_callb:
             self._set_default_callback(on_message_callb)
     
@@ -52,7 +177,87 @@ class _mosq_client():
         """
         if self.client.on_message:
             self.logger.warning('default callback previously set. using _set_default_callback will overwrite. Overwriting ..')
-        self.client.on_message = on_message_callb
+        self.client.on_message = self._wrap_callback(on_message_callb)
+
+    def _wrap_callback(self, callback):
+        """
+        Wraps a message callback so chunked payloads are reassembled and compressed payloads decompressed first;
+        the callback only sees complete messages. Compressed messages are decompressed and passed to the callback on the
+        receive worker so the paho network thread returns straight away, the wrapper then returns the worker's future.
+        Messages of a compressed topic keep their order, but may be handled after later uncompressed messages
+        """
+        @functools.wraps(callback)
+        def _on_message(client, userdata, msg):
+            _payload = msg.payload
+            if is_chunk_frame(_payload):
+                try:
+                    _payload = self.reassembler.add(msg.topic, _payload)
+                except ValueError as e:
+                    self.logger.warning("Dropping chunk on topic {}: {}".format(msg.topic, e))
+                    return
+                if _payload is None:
+                    return
+            if is_codec_frame(_payload):
+                if self._receive_executor is None:
+                    self._receive_executor = ThreadPoolExecutor(max_workers=1)
+                return self._receive_executor.submit(self._decompress_and_call, callback, client, userdata, _decoded_msg(msg, _payload))
+            if _payload is msg.payload:
+                return callback(client, userdata, msg)
+            return callback(client, userdata, _decoded_msg(msg, _payload))
+        return _on_message
+
+    def _decompress_and_call(self, callback, client, userdata, msg):
+        _start = time.thread_time()
+        try:
+            _codec, _raw = decompress_payload(msg.payload, max_bytes=self.mqtt_config.max_reassembly_bytes())
+        except ValueError as e:
+            self.logger.warning("Dropping message on topic {}: {}".format(msg.topic, e))
+            return
+        self._record_codec_stats('receive', msg.topic, _codec, len(_raw), len(msg.payload), time.thread_time() - _start)
+        msg.payload = _raw
+        try:
+            return callback(client, userdata, msg)
+        except Exception as e:
+            self.logger.error("Error handling message on topic: {}".format(msg.topic), exc_info=e)
+            raise
+
+    def _topic_codec(self, topic):
+        """
+        Returns the (codec, level) configured in mqtt_config.compression() for a topic, None if it is sent uncompressed
+        """
+        for _filter, _spec in self.mqtt_config.compression().items():
+            if mqtt.topic_matches_sub(_filter, topic):
+                return _spec['codec'], _spec.get('level')
+        return None
+
+    def _record_codec_stats(self, direction, topic, codec, raw_bytes, wire_bytes, cpu_seconds):
+        with self._codec_stats_lock:
+            _stats = self._codec_stats[direction].setdefault(topic, {'codec': codec, 'messages': 0, 'raw_bytes': 0, 'wire_bytes': 0, 'cpu_seconds': 0.0})
+            _stats['codec'] = codec
+            _stats['messages'] += 1
+            _stats['raw_bytes'] += raw_bytes
+            _stats['wire_bytes'] += wire_bytes
+            _stats['cpu_seconds'] += cpu_seconds
+        self.logger.debug("{} {} on topic {}: {} -> {} bytes, {:.4f}s cpu".format(direction, codec, topic, raw_bytes, wire_bytes, cpu_seconds))
+
+    def codec_stats(self):
+        """
+        Returns per topic compression statistics for published and received messages: codec, messages, raw_bytes,
+        wire_bytes (after compression), bytes_saved and cpu_seconds spent compressing / decompressing
+        """
+        with self._codec_stats_lock:
+            _stats = {d: {t: dict(v, bytes_saved=v['raw_bytes'] - v['wire_bytes']) for t, v in topics.items()} for d, topics in self._codec_stats.items()}
+        return _stats
+
+    def log_codec_stats(self):
+        """
+        Logs the compression statistics of every topic
+        """
+        for _direction, _topics in self.codec_stats().items():
+            for _topic, _s in _topics.items():
+                self.logger.info("{} {} ({}): {} msgs, {} -> {} bytes ({:.1f}% saved), {:.3f}s cpu".format(
+                    _direction, _topic, _s['codec'], _s['messages'], _s['raw_bytes'], _s['wire_bytes'],
+                    100.0 * _s['bytes_saved'] / max(_s['raw_bytes'], 1), _s['cpu_seconds']))
 
     def connect_client(self):
         """
@@ -75,7 +280,7 @@ class _mosq_client():
         adds a specific callback function for a certain topic
         """
         self.topic_callback_map[topic] = callback.__name__
-        self.client.message_callback_add(topic, callback)
+        self.client.message_callback_add(topic, self._wrap_callback(callback))
         
     def update_config(self, config):
         """
@@ -98,14 +303,51 @@ class _mosq_client():
     def publish_msg(self, formatted_msg, pub_topic=None):
         """
 		Publishes a formatted payload message to the broker.
+        Payloads on topics with a codec in mqtt_config.compression() are compressed on a worker thread, others are sent
+        right away. Either way the returned future completes (or holds the error) once the message is handed to paho.
+        Payloads larger than mqtt_config.chunk_size() are split into chunks that the receiving client reassembles.
 
         Args:
             formatted_msg (any): Message formatted to desire specification (e.g. str). Must be a readable type that is language-agnostic
             pub_topic (str) [Optional]: If specified, publish message to this topic. Otherwise publish to the objects configuration pub_topic 
+        Returns:
+            concurrent.futures.Future
         """
         _topic = pub_topic if pub_topic else self.mqtt_config.pub_topic()
         self.logger.debug("Out Msg - Len {}, Msg {}".format(len(formatted_msg), formatted_msg))
         self.logger.info("Publishing outgoing message to topic: {}".format(_topic))
+        _codec = self._topic_codec(_topic)
+        if _codec is None:
+            _sent = Future()
+            try:
+                _sent.set_result(self._send(formatted_msg, _topic))
+            except Exception as e:
+                self.logger.error("Error publishing message to topic: {}".format(_topic), exc_info=e)
+                _sent.set_exception(e)
+            return _sent
+        if self._codec_executor is None:
+            self._codec_executor = ThreadPoolExecutor(max_workers=1)
+        return self._codec_executor.submit(self._compress_and_send, formatted_msg, _topic, *_codec)
+
+    def _compress_and_send(self, formatted_msg, topic, codec, level):
+        try:
+            _start = time.thread_time()
+            _payload = compress_payload(formatted_msg, codec, level)
+            _raw_bytes = len(formatted_msg.encode('utf8')) if isinstance(formatted_msg, str) else len(formatted_msg)
+            self._record_codec_stats('publish', topic, codec, _raw_bytes, len(_payload), time.thread_time() - _start)
+            self._send(_payload, topic)
+        except Exception as e:
+            self.logger.error("Error compressing / publishing message to topic: {}".format(topic), exc_info=e)
+            raise
+
+    def _send(self, formatted_msg, _topic):
+        _chunk_size = self.mqtt_config.chunk_size()
+        if _chunk_size and len(formatted_msg) > _chunk_size:
+            _chunks = split_payload(formatted_msg, _chunk_size)
+            self.logger.info("Payload of {} bytes split into {} chunks".format(len(formatted_msg), len(_chunks)))
+            for _chunk in _chunks:
+                self.client.publish(topic=_topic, payload=_chunk, qos=self.mqtt_config.pubQos())
+            return
         self.client.publish(topic=_topic, payload=formatted_msg, qos=self.mqtt_config.pubQos())
 
     def shutdown(self):
@@ -113,6 +355,13 @@ class _mosq_client():
 		Stops the client loop and disconnects the client from the broker
         """
         self.logger.info('Client shutdown initiated')
+        self.reassembler.close()
+        if self._codec_executor is not None:
+            self._codec_executor.shutdown(wait=True)
+            self._codec_executor = None
         self.client.loop_stop()
+        if self._receive_executor is not None:
+            self._receive_executor.shutdown(wait=True)
+            self._receive_executor = None
         self.client.disconnect()
         self.logger.info('Client disconnected')
\ No newline at end of file
@@ -9,6 +9,7 @@ import logging
 
 from copy import deepcopy
 from dl_mqtt_clients.func._general_func import _translate_mosq_protocol, _translate_ssl_protocol
+from dl_mqtt_clients.func._transport_func import chunk_header_size, available_codecs, codec_level_range
 
 class Config(metaclass=abc.ABCMeta):
 		
@@ -39,7 +40,12 @@ class MQTTConnectionConfig(Config):
                'keepalive': None,
                'pub_qos': None,
                'mqtt_protocol': None,
-               'ssl_cert_path': None
+               'ssl_cert_path': None,
+               'chunk_size': None,
+               'chunk_timeout': 30.0,
+               'max_reassembly_bytes': 268435456,
+               'compression': {},
+               'serializer': 'json'
                }
     def __init__(self, c):
         super().__init__(c=c)
@@ -77,6 +83,21 @@ class MQTTConnectionConfig(Config):
     def ssl_cert_path(self):
         return self.get_property('ssl_cert_path')
 
+    def chunk_size(self):
+        return self.get_property('chunk_size')
+
+    def chunk_timeout(self):
+        return self.get_property('chunk_timeout')
+
+    def max_reassembly_bytes(self):
+        return self.get_property('max_reassembly_bytes')
+
+    def compression(self):
+        return self.get_property('compression')
+
+    def serializer(self):
+        return self.get_property('serializer')
+
     def _validate_config(self):
         any_errors = False
         #type validation
@@ -107,6 +128,21 @@ class MQTTConnectionConfig(Config):
         if not type(self.mqtt_protocol())==int:
             self._logger.error("Invalid Type for mqtt_protocol")
             any_errors=True	
+        if self.chunk_size() is not None and not type(self.chunk_size())==int:
+            self._logger.error("Invalid Type for chunk_size")
+            any_errors=True
+        if not type(self.chunk_timeout()) in [int, float]:
+            self._logger.error("Invalid Type for chunk_timeout")
+            any_errors=True
+        if not type(self.max_reassembly_bytes())==int:
+            self._logger.error("Invalid Type for max_reassembly_bytes")
+            any_errors=True
+        if not type(self.compression())==dict or not all(type(v)==dict for v in self.compression().values()):
+            self._logger.error("Invalid Type for compression. Required: dict of topic -> {codec: str, level: int}")
+            any_errors=True
+        if not type(self.serializer())==str:
+            self._logger.error("Invalid Type for serializer")
+            any_errors=True
         if any_errors:
             return not any_errors
 		
@@ -123,6 +159,25 @@ class MQTTConnectionConfig(Config):
         if not _translate_mosq_protocol(self.mqtt_protocol()):
             self._logger.error("Invalid value for MQTT Protocol")
             any_errors=True
+        if self.chunk_size() is not None and self.chunk_size() <= chunk_header_size():
+            self._logger.error("Invalid value for chunk_size. Must be larger than {}".format(chunk_header_size()))
+            any_errors=True
+        if self.chunk_timeout() <= 0:
+            self._logger.error("Invalid value for chunk_timeout. Must be > 0")
+            any_errors=True
+        if self.max_reassembly_bytes() <= 0:
+            self._logger.error("Invalid value for max_reassembly_bytes. Must be > 0")
+            any_errors=True
+        if self.serializer() not in ['json', 'binary']:
+            self._logger.error("Invalid value for serializer. Must be one of json, binary")
+            any_errors=True
+        for topic, spec in self.compression().items():
+            if spec.get('codec') not in available_codecs():
+                self._logger.error("Invalid compression codec for topic {}. Must be one of {}".format(topic, available_codecs()))
+                any_errors=True
+            elif spec.get('level') is not None and not (type(spec['level'])==int and codec_level_range(spec['codec'])[0] <= spec['level'] <= codec_level_range(spec['codec'])[1]):
+                self._logger.error("Invalid compression level for topic {}. Must be an int in {}".format(topic, codec_level_range(spec['codec'])))
+                any_errors=True
         return not any_errors
 
 class KerasConfig(Config):
@@ -138,7 +193,12 @@ class KerasConfig(Config):
                'lr_patience': None,
                'lr_delta': None,
                'lr_cooldown': None,
-               'min_lr': None
+               'min_lr': None,
+               'wire_format': 'binary',
+               'quant_mode': 'global',
+               'delta_updates': False,
+               'delta_threshold': 0.0,
+               'topk_ratio': None
                }
     def __init__(self, c):
         super().__init__(c=c)
@@ -174,6 +234,16 @@ class KerasConfig(Config):
         return self.get_property('lr_cooldown')
     def min_lr(self):
         return self.get_property('min_lr')
+    def wire_format(self):
+        return self.get_property('wire_format')
+    def quant_mode(self):
+        return self.get_property('quant_mode')
+    def delta_updates(self):
+        return self.get_property('delta_updates')
+    def delta_threshold(self):
+        return self.get_property('delta_threshold')
+    def topk_ratio(self):
+        return self.get_property('topk_ratio')
     def _validate_config(self):
         any_errors = False
         #type checks
@@ -218,16 +288,43 @@ class KerasConfig(Config):
         if self.reduce_lr_on_plateau() and type(self.min_lr())!=float:
             self._logger.error("Reduce Learaning Rate on Plateau minimum Learning Rate must be of type float")
             any_errors=True
+        if not type(self.wire_format())==str:
+            self._logger.error("Wire format must be of type str")
+            any_errors=True
+        if not type(self.quant_mode())==str:
+            self._logger.error("Quantization mode must be of type str")
+            any_errors=True
+        if not type(self.delta_updates())==bool:
+            self._logger.error("Delta updates must be of type bool")
+            any_errors=True
+        if self.delta_updates() and type(self.delta_threshold())!=float:
+            self._logger.error("Delta threshold must be of type float")
+            any_errors=True
+        if self.topk_ratio() is not None and type(self.topk_ratio())!=float:
+            self._logger.error("Top-k ratio must be of type float")
+            any_errors=True
         if any_errors:
             return not any_errors
         #value checks
-        if self.precision() not in [4, 8, 16, 32]:
-            self._logger.error("Precision parameter must be one of [4, 8, 16, 32]")
+        if self.precision() not in [2, 4, 8, 16, 32]:
+            self._logger.error("Precision parameter must be one of [2, 4, 8, 16, 32]")
             any_errors=True
         if self.early_stopping():
             if self.es_patience() > self.train_epochs():
                 self._logger.error("ES patience must be less than train epochs parameter")
                 any_errors=True
+        if self.wire_format() not in ['binary', 'jsonpickle']:
+            self._logger.error("Wire format must be one of ['binary', 'jsonpickle']")
+            any_errors=True
+        if self.quant_mode() not in ['global', 'layer', 'channel']:
+            self._logger.error("Quantization mode must be one of ['global', 'layer', 'channel']")
+            any_errors=True
+        if self.delta_updates() and self.delta_threshold() < 0.0:
+            self._logger.error("Delta threshold must be >= 0.0")
+            any_errors=True
+        if self.topk_ratio() is not None and not (0.0 < self.topk_ratio() <= 1.0):
+            self._logger.error("Top-k ratio must fall in (0.0, 1.0]")
+            any_errors=True
         if self.train_bs() <= 0:
             self._logger.error("Batch size must be greater than zero")
             any_errors=True
@@ -239,7 +336,26 @@ class ModelServerConfig(Config):
                'num_rounds': None,
                'prod_pub_topic': None,
                'model_cache_size': None,
-               'merge_ratio': None}
+               'merge_ratio': None,
+               'wire_format': 'binary',
+               'quant_mode': 'global',
+               'version_history_size': 4,
+               'downlink_mode': 'full',
+               'keyframe_interval': 10,
+               'downlink_topk_ratio': None,
+               'update_clip_norm': None,
+               'update_weighting': 'samples',
+               'target_loss': None,
+               'server_optimizer': 'fedavg',
+               'server_lr': None,
+               'server_momentum': 0.9,
+               'server_beta2': 0.99,
+               'server_epsilon': 1e-3,
+               'optimizer_state_path': None,
+               'aggregation_mode': 'sync',
+               'async_alpha': 0.6,
+               'staleness_exponent': 0.5,
+               'publish_interval': 30.0}
 
     def __init__(self, c):
         super().__init__(c=c)
@@ -266,6 +382,63 @@ class ModelServerConfig(Config):
         if type(self.merge_ratio()) != float:
             self._logger.error("merge_ratio incorrect type; required: float")
             any_errors = True
+        if type(self.wire_format()) != str:
+            self._logger.error("wire_format incorrect type; required: str")
+            any_errors = True
+        if type(self.quant_mode()) != str:
+            self._logger.error("quant_mode incorrect type; required: str")
+            any_errors = True
+        if type(self.version_history_size()) != int:
+            self._logger.error("version_history_size incorrect type; required: int")
+            any_errors = True
+        if type(self.downlink_mode()) != str:
+            self._logger.error("downlink_mode incorrect type; required: str")
+            any_errors = True
+        if type(self.keyframe_interval()) != int:
+            self._logger.error("keyframe_interval incorrect type; required: int")
+            any_errors = True
+        if self.downlink_topk_ratio() is not None and type(self.downlink_topk_ratio()) != float:
+            self._logger.error("downlink_topk_ratio incorrect type; required: float")
+            any_errors = True
+        if self.update_clip_norm() is not None and type(self.update_clip_norm()) != float:
+            self._logger.error("update_clip_norm incorrect type; required: float")
+            any_errors = True
+        if type(self.update_weighting()) != str:
+            self._logger.error("update_weighting incorrect type; required: str")
+            any_errors = True
+        if self.target_loss() is not None and type(self.target_loss()) != float:
+            self._logger.error("target_loss incorrect type; required: float")
+            any_errors = True
+        if type(self.server_optimizer()) != str:
+            self._logger.error("server_optimizer incorrect type; required: str")
+            any_errors = True
+        if self.server_lr() is not None and type(self.server_lr()) != float:
+            self._logger.error("server_lr incorrect type; required: float")
+            any_errors = True
+        if type(self.server_momentum()) != float:
+            self._logger.error("server_momentum incorrect type; required: float")
+            any_errors = True
+        if type(self.server_beta2()) != float:
+            self._logger.error("server_beta2 incorrect type; required: float")
+            any_errors = True
+        if type(self.server_epsilon()) != float:
+            self._logger.error("server_epsilon incorrect type; required: float")
+            any_errors = True
+        if self.optimizer_state_path() is not None and type(self.optimizer_state_path()) != str:
+            self._logger.error("optimizer_state_path incorrect type; required: str")
+            any_errors = True
+        if type(self.aggregation_mode()) != str:
+            self._logger.error("aggregation_mode incorrect type; required: str")
+            any_errors = True
+        if type(self.async_alpha()) != float:
+            self._logger.error("async_alpha incorrect type; required: float")
+            any_errors = True
+        if type(self.staleness_exponent()) != float:
+            self._logger.error("staleness_exponent incorrect type; required: float")
+            any_errors = True
+        if type(self.publish_interval()) != float:
+            self._logger.error("publish_interval incorrect type; required: float")
+            any_errors = True
         if any_errors:
             return not any_errors
 
@@ -285,8 +458,59 @@ class ModelServerConfig(Config):
         if self.model_cache_size() <= 0:
             self._logger.error("model_cache_size must be greater than 0")
             any_errors= True
-        if self.precision() not in [4, 8, 16, 32]:
-            self._logger.error("Precision parameter must be one of [4, 8, 16, 32]")
+        if self.precision() not in [2, 4, 8, 16, 32]:
+            self._logger.error("Precision parameter must be one of [2, 4, 8, 16, 32]")
+            any_errors=True
+        if self.wire_format() not in ['binary', 'jsonpickle']:
+            self._logger.error("wire_format must be one of ['binary', 'jsonpickle']")
+            any_errors=True
+        if self.quant_mode() not in ['global', 'layer', 'channel']:
+            self._logger.error("quant_mode must be one of ['global', 'layer', 'channel']")
+            any_errors=True
+        if self.version_history_size() < 1:
+            self._logger.error("version_history_size must be >= 1")
+            any_errors=True
+        if self.downlink_mode() not in ['full', 'delta']:
+            self._logger.error("downlink_mode must be one of ['full', 'delta']")
+            any_errors=True
+        if self.keyframe_interval() < 1:
+            self._logger.error("keyframe_interval must be >= 1")
+            any_errors=True
+        if self.downlink_topk_ratio() is not None and not (0.0 < self.downlink_topk_ratio() <= 1.0):
+            self._logger.error("downlink_topk_ratio must fall in (0.0, 1.0]")
+            any_errors=True
+        if self.update_clip_norm() is not None and self.update_clip_norm() <= 0.0:
+            self._logger.error("update_clip_norm must be > 0")
+            any_errors=True
+        if self.update_weighting() not in ['samples', 'uniform']:
+            self._logger.error("update_weighting must be one of ['samples', 'uniform']")
+            any_errors=True
+        if self.server_optimizer() not in ['fedavg', 'fedavgm', 'fedadam']:
+            self._logger.error("server_optimizer must be one of ['fedavg', 'fedavgm', 'fedadam']")
+            any_errors=True
+        if self.server_lr() is not None and self.server_lr() <= 0.0:
+            self._logger.error("server_lr must be > 0")
+            any_errors=True
+        if not (0.0 <= self.server_momentum() < 1.0):
+            self._logger.error("server_momentum must fall in [0.0, 1.0)")
+            any_errors=True
+        if not (0.0 <= self.server_beta2() < 1.0):
+            self._logger.error("server_beta2 must fall in [0.0, 1.0)")
+            any_errors=True
+        if self.server_epsilon() <= 0.0:
+            self._logger.error("server_epsilon must be > 0")
+            any_errors=True
+        if self.aggregation_mode() not in ['sync', 'async']:
+            self._logger.error("aggregation_mode must be one of ['sync', 'async']")
+            any_errors=True
+        if not (0.0 < self.async_alpha() <= 1.0):
+            self._logger.error("async_alpha must fall in (0.0, 1.0]")
+            any_errors=True
+        if self.staleness_exponent() < 0.0:
+            self._logger.error("staleness_exponent must be >= 0")
+            any_errors=True
+        if self.publish_interval() <= 0.0:
+            self._logger.error("publish_interval must be > 0")
             any_errors=True
 
         return not any_errors
@@ -304,4 +528,61 @@ class ModelServerConfig(Config):
         return self.get_property('model_cache_size')
 		
     def merge_ratio(self):
-        return self.get_property('merge_ratio')
\ No newline at end of file
+        return self.get_property('merge_ratio')
+
+    def wire_format(self):
+        return self.get_property('wire_format')
+
+    def quant_mode(self):
+        return self.get_property('quant_mode')
+
+    def version_history_size(self):
+        return self.get_property('version_history_size')
+
+    def downlink_mode(self):
+        return self.get_property('downlink_mode')
+
+    def keyframe_interval(self):
+        return self.get_property('keyframe_interval')
+
+    def downlink_topk_ratio(self):
+        return self.get_property('downlink_topk_ratio')
+
+    def update_clip_norm(self):
+        return self.get_property('update_clip_norm')
+
+    def update_weighting(self):
+        return self.get_property('update_weighting')
+
+    def target_loss(self):
+        return self.get_property('target_loss')
+
+    def server_optimizer(self):
+        return self.get_property('server_optimizer')
+
+    def server_lr(self):
+        return self.get_property('server_lr')
+
+    def server_momentum(self):
+        return self.get_property('server_momentum')
+
+    def server_beta2(self):
+        return self.get_property('server_beta2')
+
+    def server_epsilon(self):
+        return self.get_property('server_epsilon')
+
+    def optimizer_state_path(self):
+        return self.get_property('optimizer_state_path')
+
+    def aggregation_mode(self):
+        return self.get_property('aggregation_mode')
+
+    def async_alpha(self):
+        return self.get_property('async_alpha')
+
+    def staleness_exponent(self):
+        return self.get_property('staleness_exponent')
+
+    def publish_interval(self):
+        return self.get_property('publish_interval')
\ No newline at end of file
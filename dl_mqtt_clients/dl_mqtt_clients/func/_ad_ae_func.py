@@ -1,5 +1,6 @@
 import numpy as np
 
 def reconstr_error(predicted, expected):
+    """Returns the L2 norm of (predicted - expected) per row, rows of any shape"""
     assert(predicted.shape==expected.shape)
-    return np.linalg.norm(predicted-expected, axis=1)
\ No newline at end of file
+    return np.linalg.norm((predicted-expected).reshape(len(expected), -1), axis=1)
\ No newline at end of file
@@ -7,22 +7,27 @@ import logging
 
 logging.basicConfig(level=logging.INFO)
 
-def parse_json_field(values):
+def parse_data_field(values, features=None):
     """
-    Takes a json value field and returns it as NumPy array to be used in Keras
+    Takes a json data field and returns it as a float32 NumPy array of shape (rows, features)
     @params
-    values (list / str): list or csv string of float values
+    values (list / dict): a single row (list of floats), a row-major batch (list of rows)
+                          or a columnar batch (dict of feature name -> list of values, one per row)
+    features (list): feature names in the model's input order; a columnar batch is stacked in this order and rejected
+                     if its columns differ or no order is given
     """
-    if type(values) is list:
-        data = [float(x) for x in values]
-    elif type(values) is str:
-        data = [float(x) for c in values]
-    elif type(values) is dict:
-        raise TypeError
-        
-    data = np.array(values)
-    #expand dimensions to be batch_size, ndims or (1, ndims) since NeuralNets expect (batch_size, features) as input
-    data = np.expand_dims(data, axis=0)
+    if type(values) is dict:
+        if features is None:
+            raise ValueError("Columnar batches need a configured feature order")
+        if set(values) != set(features):
+            raise ValueError("Columns {} do not match the features {}".format(sorted(values), list(features)))
+        data = np.asarray([values[name] for name in features], dtype=np.float32).T
+    else:
+        data = np.asarray(values, dtype=np.float32)
+    if data.ndim == 1:
+        data = data.reshape(1, -1)
+    if data.ndim != 2:
+        raise ValueError("Data field must be a row, a list of rows or a dict of columns; got {} dims".format(data.ndim))
     return data
 
 def utf8len(s):
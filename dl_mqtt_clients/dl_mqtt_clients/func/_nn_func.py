@@ -1,15 +1,28 @@
-from sklearn.preprocessing import MinMaxScaler, StandardScaler
-from sklearn.externals import joblib
 import numpy as np
 import copy
 import pickle
+from collections import namedtuple
+from dl_mqtt_clients.net.scaler import AffineScaler
 
-def normalize_data(data, scaler):
+def normalize_data(data, scaler, copy=True):
+    """Scales data with an AffineScaler (float32, in place if copy is False) or a fitted sklearn scaler"""
+    if isinstance(scaler, AffineScaler):
+        return scaler.transform(data, copy=copy)
     return np.array(scaler.transform(data))
 
-def load_scaler(h5_path):
+def load_sklearn_scaler(h5_path):
+    #joblib (and sklearn) are only imported for pickled scalers
+    import joblib
     return joblib.load(h5_path)
 
+def load_scaler(h5_path, affine=False):
+    """Loads a scaler exported as .npz (see net/scaler.py) without sklearn, or a pickled sklearn scaler. With affine=True
+    a pickled MinMaxScaler / StandardScaler is converted to an AffineScaler"""
+    if h5_path.endswith('.npz'):
+        return AffineScaler.load(h5_path)
+    scaler = load_sklearn_scaler(h5_path)
+    return AffineScaler.from_sklearn(scaler) if affine else scaler
+
 def compress(values, min_value, max_value, max_comp_value):
     """Function that takes a NumPy array and maps its values to points 
         along linear spaced points from [0, max_comp_value]
@@ -56,12 +69,48 @@ def bits_to_dtype(x):
             string: data type
     """
     return {
+        2: 'uint8',
+        4: 'uint8',
         8: 'uint8',
-        16: 'float16',
+        16: 'uint16',
         32: 'float',
         64: 'float64'
         }[x]
 
+def pack_bits(values, precision):
+    """Function that packs integer values in [0, 2**precision - 1] into bytes, 8 // precision values per byte.
+        Only sub-byte precisions (1, 2, 4) are packed
+
+        Args:
+            values (numpy/uint8): values to pack, any shape
+            precision (int): bits used by each value
+        Returns:
+            packed (numpy/uint8): 1-D packed array of ceil(values.size * precision / 8) bytes
+    """
+    per_byte = 8 // precision
+    flat = np.ravel(values).astype(np.uint8)
+    pad = (-flat.size) % per_byte
+    if pad:
+        flat = np.concatenate([flat, np.zeros(pad, dtype=np.uint8)])
+    shifts = np.arange(0, 8, precision, dtype=np.uint8)
+    return np.bitwise_or.reduce(flat.reshape(-1, per_byte) << shifts, axis=1).astype(np.uint8)
+
+def unpack_bits(packed, precision, shape):
+    """Inverse of pack_bits
+
+        Args:
+            packed (numpy/uint8): packed bytes
+            precision (int): bits used by each value
+            shape (tuple): shape of the unpacked array
+        Returns:
+            values (numpy/uint8): unpacked values reshaped to shape
+    """
+    shifts = np.arange(0, 8, precision, dtype=np.uint8)
+    mask = np.uint8(2**precision - 1)
+    values = (np.asarray(packed, dtype=np.uint8)[:, None] >> shifts) & mask
+    size = int(np.prod(shape, dtype=np.int64))
+    return values.ravel()[:size].reshape(shape)
+
 def getMinMaxVals(keras_weights):
     """Function that gets the minimum vaue from a list of numpy arrays
 
@@ -105,31 +154,112 @@ def compress_keras_weights(keras_weights, precision, minW, maxW):
         Iterates through each layer of the 
         Args:
             keras_weights (float): list of numpy. generated from model.get_weights()
-            precision (int): integer precision to compress to. must be one of [8, 16, 32]
+            precision (int): integer precision to compress to. must be one of [2, 4, 8, 16, 32]
             minW (float): minimum float value 
             maxW (float): maximum float value
         Returns:
-            compressed_weights (list): list of numpy arrays as dtype determiend by 'precision' argument
+            compressed_weights (list): list of numpy arrays as dtype determiend by 'precision' argument.
+                                       precisions below 8 are bit packed into flat uint8 arrays (see pack_bits)
     """
     max_comp_value = 2**precision-1
     dtype = bits_to_dtype(precision)
     assert(len(keras_weights) > 0)
     compressed_weights = [compress(layer, minW, maxW, max_comp_value).astype(dtype) for layer in keras_weights]
+    if precision < 8:
+        compressed_weights = [pack_bits(layer, precision) for layer in compressed_weights]
     return compressed_weights
 
-def inflate_keras_weights(keras_weights, minV, maxV, base_precision):
+def inflate_keras_weights(keras_weights, minV, maxV, base_precision, scales=None, zero_points=None, shapes=None):
     """  
         Args:
             keras_weights (list):
             minV (float):
             maxV (float):
             base_precision (float):
+            scales (list) [Optional]: per layer scales generated by compress_keras_weights_scaled. If set, minV/maxV are ignored
+            zero_points (list) [Optional]: per layer zero points generated by compress_keras_weights_scaled
+            shapes (list) [Optional]: original layer shapes, required to unpack precisions below 8
         Returns:
             inflated_weights (list):
     """
+    if base_precision < 8:
+        if shapes is None:
+            raise ValueError("Layer shapes are required to inflate {}-bit packed weights".format(base_precision))
+        keras_weights = [unpack_bits(layer, base_precision, shape) for layer, shape in zip(keras_weights, shapes)]
+    if scales is not None:
+        return [inflate_scaled(layer, scale, zero_point) for layer, scale, zero_point in zip(keras_weights, scales, zero_points)]
     inflated_weights = [inflate(layer, minV, maxV, base_precision).astype(np.float32) for layer in keras_weights]
     return inflated_weights
 
+def get_quant_params(layer, precision, per_channel=False):
+    """Function that computes the affine quantization parameters of a single layer, so that
+        layer ~= q * scale + zero_point with q in [0, 2**precision - 1]
+
+        Args:
+            layer (numpy/float): layer weights
+            precision (int): integer precision to compress to
+            per_channel (bool): compute one scale / zero point per output channel (last axis) instead of one per layer.
+                                1-D layers (e.g. biases) always use a single scale
+        Returns:
+            scale (numpy/float32): scalar or (channels,) array
+            zero_point (numpy/float32): scalar or (channels,) array, the real value mapped to q=0
+    """
+    if per_channel and layer.ndim > 1:
+        axes = tuple(range(layer.ndim - 1))
+        minV, maxV = np.min(layer, axis=axes), np.max(layer, axis=axes)
+    else:
+        minV, maxV = np.min(layer), np.max(layer)
+    scale = np.asarray((maxV - minV) / (2**precision - 1), dtype=np.float32)
+    #constant layers/channels map every value to q=0
+    scale[scale == 0] = 1.0
+    return scale, np.asarray(minV, dtype=np.float32)
+
+def compress_scaled(values, scale, zero_point, max_comp_value):
+    """Function that maps a NumPy array to integer points in [0, max_comp_value] using an affine scale / zero point.
+        scale and zero_point broadcast against the last axis of values
+
+        Returns:
+            rounded_values (numpy/float): compressed representation of input array, rounded to nearest integer val
+    """
+    rounded_values = np.subtract(values, zero_point, dtype=np.float32)
+    rounded_values /= scale
+    np.round(rounded_values, out=rounded_values)
+    np.clip(rounded_values, 0, max_comp_value, out=rounded_values)
+    return rounded_values
+
+def inflate_scaled(values, scale, zero_point):
+    """Inverse of compress_scaled, returns the float32 approximation q * scale + zero_point"""
+    inflated_values = np.multiply(values, scale, dtype=np.float32)
+    inflated_values += zero_point
+    return inflated_values
+
+def compress_keras_weights_scaled(keras_weights, precision, per_channel=False):
+    """Quantizes a set of weights generated from Keras' model.get_weights() with a scale and zero point per layer,
+        or per output channel, so a single outlier layer does not consume the resolution of every other layer
+
+        Args:
+            keras_weights (list): list of numpy. generated from model.get_weights()
+            precision (int): integer precision to compress to
+            per_channel (bool): one scale / zero point per output channel rather than per layer
+        Returns:
+            compressed_weights (list): list of numpy arrays as dtype determined by 'precision' argument, bit packed below 8
+            scales (list): list of float32 numpy scales, one entry per layer
+            zero_points (list): list of float32 numpy zero points, one entry per layer
+    """
+    max_comp_value = 2**precision-1
+    dtype = bits_to_dtype(precision)
+    assert(len(keras_weights) > 0)
+    compressed_weights, scales, zero_points = [], [], []
+    for layer in keras_weights:
+        scale, zero_point = get_quant_params(layer, precision, per_channel=per_channel)
+        compressed_layer = compress_scaled(layer, scale, zero_point, max_comp_value).astype(dtype)
+        if precision < 8:
+            compressed_layer = pack_bits(compressed_layer, precision)
+        compressed_weights.append(compressed_layer)
+        scales.append(scale)
+        zero_points.append(zero_point)
+    return compressed_weights, scales, zero_points
+
 def is_weight_list_same_dim(weightList1, weightList2):
     if type(weightList1) != list or type(weightList2) != list:
         raise TypeError("Function expecting of type list")
@@ -144,17 +274,152 @@ def is_weight_list_same_dim(weightList1, weightList2):
             return False
     return True
 
-def merge_models(weights):
-    """Given a list of Keras models, takes the weights and returns the weights averaged 
+def delta_keras_weights(keras_weights, base_weights, threshold=0.0, keep_all=False):
+    """Computes the per layer difference between two sets of weights, dropping layers that barely changed
+
+        Args:
+            keras_weights (list): list of numpy arrays, current weights
+            base_weights (list): list of numpy arrays, weights the difference is taken against
+            threshold (float): layers whose largest absolute change is <= threshold are returned as None
+            keep_all (bool): return every layer, ignoring threshold
+        Returns:
+            delta_weights (list): list of float32 numpy arrays (or None for skipped layers)
+    """
+    delta_weights = []
+    for layer, base in zip(keras_weights, base_weights):
+        delta = np.subtract(layer, base, dtype=np.float32)
+        delta_weights.append(delta if keep_all or np.max(np.abs(delta), initial=0.0) > threshold else None)
+    return delta_weights
+
+def apply_keras_weights_delta(base_weights, delta_weights):
+    """Inverse of delta_keras_weights, None layers are taken from base_weights unchanged
+
+        Returns:
+            keras_weights (list): list of float32 numpy arrays
+    """
+    return [np.asarray(base, dtype=np.float32) if delta is None else np.add(base, delta, dtype=np.float32)
+            for base, delta in zip(base_weights, delta_weights)]
+
+SparseUpdate = namedtuple('SparseUpdate', ['base_weights', 'indices', 'values'])
+SparseUpdate.__doc__ = """Sparse model update: base_weights plus values scattered at the flat per layer indices (None = layer unchanged)"""
+
+def topk_sparsify(keras_weights, ratio):
+    """Selects the ratio largest magnitude entries across all layers
+
+        Args:
+            keras_weights (list): list of numpy arrays, typically a model update
+            ratio (float): fraction of entries to keep, in (0.0, 1.0]
+        Returns:
+            values (list): per layer float32 1-D arrays of the kept entries (None if a layer has none)
+            indices (list): per layer int32 flat indices of the kept entries (None if a layer has none)
+            residual (list): per layer float32 arrays holding the entries that were not kept
+    """
+    flat = np.concatenate([np.ravel(layer) for layer in keras_weights])
+    k = min(flat.size, max(1, int(np.ceil(ratio * flat.size))))
+    selected = np.argpartition(np.abs(flat), flat.size - k)[flat.size - k:]
+    selected.sort()
+    offsets = np.cumsum([0] + [np.size(layer) for layer in keras_weights])
+    bounds = np.searchsorted(selected, offsets)
+    values, indices, residual = [], [], []
+    for i, layer in enumerate(keras_weights):
+        remainder = np.array(layer, dtype=np.float32)
+        index = (selected[bounds[i]:bounds[i+1]] - offsets[i]).astype(np.int32)
+        if index.size:
+            values.append(remainder.reshape(-1)[index])
+            indices.append(index)
+            remainder.reshape(-1)[index] = 0.0
+        else:
+            values.append(None)
+            indices.append(None)
+        residual.append(remainder)
+    return values, indices, residual
+
+def apply_sparse_delta(base_weights, indices, values):
+    """Returns float32 copies of base_weights with values added at the flat per layer indices (None = layer unchanged)"""
+    new_weights = []
+    for base, index, value in zip(base_weights, indices, values):
+        layer = np.array(base, dtype=np.float32)
+        if index is not None:
+            layer.reshape(-1)[index] += value
+        new_weights.append(layer)
+    return new_weights
+
+class FlatLayout():
+    """Layer-offset index mapping a list of weight arrays to one contiguous float32 vector and back. Merging, clipping and
+        norm statistics then run as single vectorized passes over the flat vectors; shapes are only restored by unflatten
+
+        Args:
+            keras_weights (list): list of numpy arrays (or shapes) defining the layout
+    """
+    def __init__(self, keras_weights):
+        self.shapes = [tuple(np.shape(layer)) for layer in keras_weights]
+        self.offsets = np.cumsum([0] + [int(np.prod(shape)) for shape in self.shapes])
+        self.size = int(self.offsets[-1])
+
+    def matches(self, keras_weights):
+        return len(keras_weights) == len(self.shapes) and all(np.shape(l) == s for l, s in zip(keras_weights, self.shapes))
+
+    def flatten(self, keras_weights, out=None):
+        """Copies the layers into out (a preallocated float32 vector of self.size) or a new vector"""
+        if not self.matches(keras_weights):
+            raise ValueError("Weights do not match the layout: {}, {}".format([np.shape(l) for l in keras_weights], self.shapes))
+        out = np.empty(self.size, dtype=np.float32) if out is None else out
+        for layer, start, end in zip(keras_weights, self.offsets[:-1], self.offsets[1:]):
+            out[start:end] = np.ravel(layer)
+        return out
+
+    def unflatten(self, flat):
+        """Returns the layers as reshaped views of flat"""
+        return [flat[start:end].reshape(shape) for shape, start, end in zip(self.shapes, self.offsets[:-1], self.offsets[1:])]
+
+    def flat_indices(self, indices):
+        """Maps per layer flat indices (None = no entries) to indices into the flat vector"""
+        return np.concatenate([np.asarray(index, dtype=np.int64) + start for index, start in zip(indices, self.offsets[:-1]) if index is not None]
+                              or [np.empty(0, dtype=np.int64)])
+
+    def layer_norms(self, flat):
+        """Per layer L2 norms of a flat vector, or of each row of a (models, size) matrix"""
+        sq = np.square(flat, dtype=np.float64)
+        starts = self.offsets[:-1][np.diff(self.offsets) > 0]
+        norms = np.zeros(sq.shape[:-1] + (len(self.shapes),))
+        norms[..., np.diff(self.offsets) > 0] = np.add.reduceat(sq, starts, axis=-1)
+        return np.sqrt(norms)
+
+def clip_by_norm(flat, max_norm, reference=None):
+    """Scales each row of flat (a (models, size) matrix, in place) so that its distance to reference (or its own norm
+        if reference is None) is at most max_norm
+
+        Returns:
+            norms (numpy.array): the norms before clipping
+    """
+    delta = flat if reference is None else flat - reference
+    norms = np.linalg.norm(delta, axis=-1)
+    scale = np.minimum(1.0, max_norm / np.maximum(norms, 1e-12)).astype(np.float32)
+    if reference is None:
+        flat *= scale[..., None]
+    else:
+        delta *= scale[..., None]
+        np.add(reference, delta, out=flat)
+    return norms
+
+def merge_models(weights, sample_weights=None, clip_norm=None, reference=None):
+    """Given a list of Keras models, takes the weights and returns the weights averaged. The models are copied once into
+        a preallocated (models, parameters) float32 matrix and averaged with a single matrix-vector product
     Args:
-        models (list): list of Keras models
+        weights (list): list of models (list of numpy arrays)
+        sample_weights (list) [Optional]: weight of each model in the average
+        clip_norm (float) [Optional]: limit the L2 norm of each model's difference to reference (or of the model itself)
+        reference (list) [Optional]: model the clipped differences are taken against, e.g. the current global model
     Returns:
         new_weights (float): list of float32 NumPy array representative of the new weights
                              can be used to set the weights via model.set_weights(new_weights)
     """
-    #average the weights
-    new_weights = list()
-    for weights_list_tuple in zip(*weights):
-        new_weights.append([np.array(weights_).mean(axis=0) for weights_ in zip(*weights_list_tuple)])
-    return new_weights
-		
+    layout = FlatLayout(weights[0])
+    stacked = np.empty((len(weights), layout.size), dtype=np.float32)
+    for row, model in zip(stacked, weights):
+        layout.flatten(model, out=row)
+    if clip_norm is not None:
+        clip_by_norm(stacked, clip_norm, reference=None if reference is None else layout.flatten(reference))
+    coefficients = np.ones(len(weights), dtype=np.float32) if sample_weights is None else np.asarray(sample_weights, dtype=np.float32)
+    merged = (coefficients / coefficients.sum()) @ stacked
+    return layout.unflatten(merged)
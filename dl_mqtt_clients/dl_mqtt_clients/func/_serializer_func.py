@@ -1,6 +1,132 @@
 import json
+import struct
+import numpy as np
+
+#Binary weight / data frame: magic, frame version, header length (little-endian)
+WEIGHT_FRAME_MAGIC = b'FLW'
+DATA_FRAME_MAGIC = b'FLD'
+WEIGHT_FRAME_VERSION = 1
+_WEIGHT_FRAME_PREFIX = struct.Struct('<3sBI')
+_WEIGHT_FRAME_ALIGN = 8
 
 def decode_bytestr_to_json(value, bytetype='utf8'):
-    unicode_str = value.decode(bytetype).replace("'", '"')
+    #json.loads reads utf8 bytes directly; payloads using python style single quotes are only rewritten if that fails
+    try:
+        return json.loads(value if bytetype == 'utf8' else value.decode(bytetype))
+    except json.decoder.JSONDecodeError:
+        unicode_str = value.decode(bytetype).replace("'", '"')
     data = json.loads(unicode_str)
-    return data
\ No newline at end of file
+    return data
+
+def _align(offset, alignment=_WEIGHT_FRAME_ALIGN):
+    return (offset + alignment - 1) // alignment * alignment
+
+def is_weight_frame(payload):
+    """Returns True if the payload (bytes) starts with the binary weight frame magic"""
+    return isinstance(payload, (bytes, bytearray, memoryview)) and bytes(payload[:len(WEIGHT_FRAME_MAGIC)]) == WEIGHT_FRAME_MAGIC
+
+def is_data_frame(payload):
+    """Returns True if the payload (bytes) starts with the binary data frame magic"""
+    return isinstance(payload, (bytes, bytearray, memoryview)) and bytes(payload[:len(DATA_FRAME_MAGIC)]) == DATA_FRAME_MAGIC
+
+def encode_data_frame(fields, arrays):
+    """Same layout as encode_weight_frame, tagged as a data frame (see payload_serializers/BinarySerializer.py)"""
+    return encode_weight_frame(fields, arrays, magic=DATA_FRAME_MAGIC)
+
+def decode_data_frame(payload):
+    """Decodes a frame generated by encode_data_frame"""
+    return decode_weight_frame(payload, magic=DATA_FRAME_MAGIC)
+
+def encode_weight_frame(fields, arrays, magic=WEIGHT_FRAME_MAGIC):
+    """Packs scalar fields and lists of NumPy arrays into a versioned binary frame.
+
+        Layout: [magic | version | header length | JSON header | padding | raw buffers]
+        Each buffer is stored contiguously (little-endian, 8-byte aligned) and is described in the header by
+        its shape, dtype and offset so the receiver can map it with np.frombuffer without copying.
+
+        Args:
+            fields (dict): JSON serializable values. NumPy scalars are stored with their dtype and restored as such
+            arrays (dict): name -> list of numpy arrays (entries may be None) or a single numpy array
+            magic (bytes): frame type tag
+        Returns:
+            frame (bytes): encoded frame
+    """
+    header = {'fields': {}, 'scalars': {}, 'arrays': {}}
+    for name, value in fields.items():
+        if isinstance(value, np.generic):
+            header['scalars'][name] = {'dtype': value.dtype.str, 'value': value.item()}
+        else:
+            header['fields'][name] = value
+
+    buffers, offset = [], 0
+    for name, group in arrays.items():
+        single = isinstance(group, np.ndarray)
+        items = []
+        for a in ([group] if single else group):
+            if a is None:
+                items.append(None)
+                continue
+            a = np.ascontiguousarray(a)
+            if a.dtype.byteorder == '>':
+                a = a.astype(a.dtype.newbyteorder('<'))
+            offset = _align(offset)
+            items.append({'shape': list(a.shape), 'dtype': a.dtype.str, 'offset': offset})
+            buffers.append((offset, a))
+            offset += a.nbytes
+        header['arrays'][name] = {'single': single, 'items': items}
+
+    header_b = json.dumps(header, separators=(',', ':')).encode('utf8')
+    data_start = _align(_WEIGHT_FRAME_PREFIX.size + len(header_b))
+    parts = [_WEIGHT_FRAME_PREFIX.pack(magic, WEIGHT_FRAME_VERSION, len(header_b)), header_b,
+             bytes(data_start - _WEIGHT_FRAME_PREFIX.size - len(header_b))]
+    position = 0
+    for buf_offset, a in buffers:
+        if buf_offset > position:
+            parts.append(bytes(buf_offset - position))
+        parts.append(memoryview(a).cast('B'))
+        position = buf_offset + a.nbytes
+    return b''.join(parts)
+
+def decode_weight_frame(payload, magic=WEIGHT_FRAME_MAGIC):
+    """Decodes a frame generated by encode_weight_frame. Arrays are returned as read-only np.frombuffer views
+        over the payload, no data is copied.
+
+        Args:
+            payload (bytes): encoded frame
+        Returns:
+            fields (dict): scalar fields
+            arrays (dict): name -> list of numpy arrays (or None entries) / single numpy array
+    """
+    if len(payload) < _WEIGHT_FRAME_PREFIX.size:
+        raise ValueError("Weight frame too short: {} bytes".format(len(payload)))
+    frame_magic, version, header_len = _WEIGHT_FRAME_PREFIX.unpack_from(payload, 0)
+    if frame_magic != magic:
+        raise ValueError("Payload is not a {} frame".format('weight' if magic == WEIGHT_FRAME_MAGIC else 'data'))
+    if version != WEIGHT_FRAME_VERSION:
+        raise ValueError("Unsupported weight frame version: {}".format(version))
+    header_end = _WEIGHT_FRAME_PREFIX.size + header_len
+    try:
+        header = json.loads(bytes(payload[_WEIGHT_FRAME_PREFIX.size:header_end]).decode('utf8'))
+    except (UnicodeDecodeError, json.decoder.JSONDecodeError) as e:
+        raise ValueError("Malformed weight frame header") from e
+    data_start = _align(header_end)
+
+    fields = dict(header['fields'])
+    for name, scalar in header['scalars'].items():
+        fields[name] = np.dtype(scalar['dtype']).type(scalar['value'])
+
+    arrays = {}
+    for name, group in header['arrays'].items():
+        items = []
+        for item in group['items']:
+            if item is None:
+                items.append(None)
+                continue
+            dtype = np.dtype(item['dtype'])
+            count = int(np.prod(item['shape'], dtype=np.int64))
+            start = data_start + item['offset']
+            if start + count * dtype.itemsize > len(payload):
+                raise ValueError("Weight frame truncated while reading '{}'".format(name))
+            items.append(np.frombuffer(payload, dtype=dtype, count=count, offset=start).reshape(item['shape']))
+        arrays[name] = items[0] if group['single'] else items
+    return fields, arrays
@@ -0,0 +1,150 @@
+import struct
+import uuid
+import zlib
+import lzma
+import bz2
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+#Chunk frame: magic, frame version, transfer id, chunk index, chunk count, offset, total length, payload crc32, chunk crc32
+CHUNK_FRAME_MAGIC = b'FLC'
+CHUNK_FRAME_VERSION = 1
+_CHUNK_HEADER = struct.Struct('<3sB16sIIIIII')
+
+#Codec frame: magic, frame version, codec id
+CODEC_FRAME_MAGIC = b'FLZ'
+CODEC_FRAME_VERSION = 1
+_CODEC_HEADER = struct.Struct('<3sBB')
+
+#codec name -> (id, default level, (min level, max level), compress(data, level), decompressor factory)
+#decompressors take a max_length so the output can be bounded
+_CODECS = {'zlib': (1, 6, (0, 9), lambda d, l: zlib.compress(d, l), zlib.decompressobj),
+           'lzma': (2, 6, (0, 9), lambda d, l: lzma.compress(d, preset=l), lzma.LZMADecompressor),
+           'bz2': (3, 9, (1, 9), lambda d, l: bz2.compress(d, l), bz2.BZ2Decompressor)}
+if lz4_frame is not None:
+    _CODECS['lz4'] = (4, 0, (0, 16), lambda d, l: lz4_frame.compress(d, compression_level=l), lz4_frame.LZ4FrameDecompressor)
+_CODEC_IDS = {v[0]: k for k, v in _CODECS.items()}
+
+def chunk_header_size():
+    return _CHUNK_HEADER.size
+
+def is_chunk_frame(payload):
+    """Returns True if the payload (bytes) starts with the chunk frame magic"""
+    return isinstance(payload, (bytes, bytearray, memoryview)) and bytes(payload[:len(CHUNK_FRAME_MAGIC)]) == CHUNK_FRAME_MAGIC
+
+def split_payload(payload, chunk_size):
+    """Splits a payload into chunk frames of at most chunk_size bytes (header included).
+
+        Every chunk carries the transfer id, its index and byte offset, the total length and crc32 checksums of both the
+        chunk data and the full payload so the receiver can reassemble chunks arriving out of order or more than once.
+
+        Args:
+            payload (bytes / str): payload to split. str is encoded as utf8
+            chunk_size (int): maximum size of a chunk frame in bytes
+        Returns:
+            chunks (list): list of chunk frames (bytes)
+    """
+    if isinstance(payload, str):
+        payload = payload.encode('utf8')
+    data_size = chunk_size - _CHUNK_HEADER.size
+    if data_size <= 0:
+        raise ValueError("chunk_size must be larger than the chunk header ({} bytes)".format(_CHUNK_HEADER.size))
+    view = memoryview(payload).cast('B')
+    total = len(view)
+    count = max(1, (total + data_size - 1) // data_size)
+    transfer_id = uuid.uuid4().bytes
+    total_crc = zlib.crc32(view)
+    chunks = []
+    for index in range(count):
+        offset = index * data_size
+        data = view[offset:offset + data_size]
+        header = _CHUNK_HEADER.pack(CHUNK_FRAME_MAGIC, CHUNK_FRAME_VERSION, transfer_id, index, count, offset, total,
+                                    total_crc, zlib.crc32(data))
+        chunks.append(header + data.tobytes())
+    return chunks
+
+def parse_chunk(payload):
+    """Decodes a chunk frame generated by split_payload
+
+        Returns:
+            header (dict): transfer_id, index, count, offset, total, total_crc
+            data (memoryview): chunk data
+    """
+    if len(payload) < _CHUNK_HEADER.size:
+        raise ValueError("Chunk frame too short: {} bytes".format(len(payload)))
+    magic, version, transfer_id, index, count, offset, total, total_crc, chunk_crc = _CHUNK_HEADER.unpack_from(payload, 0)
+    if magic != CHUNK_FRAME_MAGIC:
+        raise ValueError("Payload is not a chunk frame")
+    if version != CHUNK_FRAME_VERSION:
+        raise ValueError("Unsupported chunk frame version: {}".format(version))
+    data = memoryview(payload)[_CHUNK_HEADER.size:]
+    if zlib.crc32(data) != chunk_crc:
+        raise ValueError("Chunk {} of {} failed checksum".format(index, count))
+    if index >= count or offset + len(data) > total:
+        raise ValueError("Chunk {} of {} out of range".format(index, count))
+    header = {'transfer_id': transfer_id, 'index': index, 'count': count, 'offset': offset, 'total': total, 'total_crc': total_crc}
+    return header, data
+
+def available_codecs():
+    """Returns the names of the compression codecs usable in this environment (lz4 requires the lz4 package)"""
+    return list(_CODECS.keys())
+
+def codec_level_range(codec):
+    """Returns the (min, max) compression level accepted by a codec"""
+    return _CODECS[codec][2]
+
+def is_codec_frame(payload):
+    """Returns True if the payload (bytes) starts with the codec frame magic"""
+    return isinstance(payload, (bytes, bytearray, memoryview)) and bytes(payload[:len(CODEC_FRAME_MAGIC)]) == CODEC_FRAME_MAGIC
+
+def compress_payload(payload, codec, level=None):
+    """Compresses a payload and prefixes it with a header identifying the codec so receivers can detect it.
+
+        Args:
+            payload (bytes / str): payload to compress. str is encoded as utf8
+            codec (str): one of available_codecs()
+            level (int) [Optional]: compression level, codec default if None
+        Returns:
+            frame (bytes): codec frame
+    """
+    if codec not in _CODECS:
+        raise ValueError("Unknown or unavailable codec: {}".format(codec))
+    if isinstance(payload, str):
+        payload = payload.encode('utf8')
+    codec_id, default_level, _, compress, _ = _CODECS[codec]
+    return _CODEC_HEADER.pack(CODEC_FRAME_MAGIC, CODEC_FRAME_VERSION, codec_id) + compress(payload, default_level if level is None else level)
+
+def decompress_payload(payload, max_bytes=None):
+    """Decodes a frame generated by compress_payload
+
+        Args:
+            payload (bytes): codec frame
+            max_bytes (int) [Optional]: largest decompressed size accepted, larger payloads raise ValueError without
+                                        being inflated further
+        Returns:
+            codec (str): codec the payload was compressed with
+            payload (bytes): decompressed payload
+    """
+    if len(payload) < _CODEC_HEADER.size:
+        raise ValueError("Codec frame too short: {} bytes".format(len(payload)))
+    magic, version, codec_id = _CODEC_HEADER.unpack_from(payload, 0)
+    if magic != CODEC_FRAME_MAGIC:
+        raise ValueError("Payload is not a codec frame")
+    if version != CODEC_FRAME_VERSION:
+        raise ValueError("Unsupported codec frame version: {}".format(version))
+    if codec_id not in _CODEC_IDS:
+        raise ValueError("Unknown or unavailable codec id: {}".format(codec_id))
+    codec = _CODEC_IDS[codec_id]
+    decompressor = _CODECS[codec][4]()
+    try:
+        data = bytes(memoryview(payload)[_CODEC_HEADER.size:])
+        raw = decompressor.decompress(data) if max_bytes is None else decompressor.decompress(data, max_bytes + 1)
+    except Exception as e:
+        raise ValueError("Corrupt {} payload".format(codec)) from e
+    if max_bytes is not None and len(raw) > max_bytes:
+        raise ValueError("Decompressed {} payload larger than {} bytes".format(codec, max_bytes))
+    if not decompressor.eof:
+        raise ValueError("Corrupt {} payload: truncated".format(codec))
+    return codec, raw
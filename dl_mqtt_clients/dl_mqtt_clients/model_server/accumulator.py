@@ -0,0 +1,233 @@
+import numpy as np
+from dl_mqtt_clients.func._nn_func import SparseUpdate, FlatLayout, clip_by_norm
+
+def _flatten_update(layout, weights, out):
+    """Writes a full model or SparseUpdate into out, expanding sparse values onto their base model"""
+    _base = weights.base_weights if isinstance(weights, SparseUpdate) else weights
+    _values = layout.flatten(_base, out=out)
+    if isinstance(weights, SparseUpdate):
+        _sparse = [np.ravel(v) for v in weights.values if v is not None]
+        if _sparse:
+            #indices are unique within a layer so a fancy indexed add is a scatter-add
+            _values[layout.flat_indices(weights.indices)] += np.concatenate(_sparse)
+    return _values
+
+class WeightAccumulator():
+    """
+    Streaming weighted average of client models. Each update is flattened (see FlatLayout) and folded into a running
+    flat float32 sum when it arrives, so memory does not grow with the number of clients. With compensated=True the sum
+    carries a Kahan compensation term (one more model sized buffer) so thousands of float32 additions do not lose
+    precision. Layer shapes are only restored by result().
+
+    To merge a random subset of sample_size out of the expected updates of a round, each arriving update is kept with
+    probability (sample_size - kept) / (expected - seen) (selection sampling), which selects a uniform random subset
+    without holding the updates.
+
+    With clip_norm and a reference model (see set_reference), the L2 norm of each update's difference to the reference
+    is limited to clip_norm before it is added.
+
+    Args:
+        expected (int) [Optional]: number of updates per round, required with sample_size
+        sample_size (int) [Optional]: number of updates merged per round, all of them if None
+        compensated (bool): use compensated (Kahan) summation
+        clip_norm (float) [Optional]: maximum L2 norm of an update's difference to the reference model
+    """
+    def __init__(self, expected=None, sample_size=None, compensated=True, clip_norm=None):
+        if sample_size is not None and (expected is None or not 0 < sample_size <= expected):
+            raise ValueError("sample_size must be in (0, expected]")
+        self.expected = expected
+        self.sample_size = sample_size
+        self.compensated = compensated
+        self.clip_norm = clip_norm
+        self.layout = None
+        self._sum = None
+        self._comp = None
+        self._scratch = None
+        self._reference = None
+        self.reset()
+
+    def reset(self):
+        """
+        Starts a new round, buffers are zeroed and reused
+        """
+        self.received = 0
+        self.merged = 0
+        self.total_weight = 0.0
+        self._norms = {'norm_sum': 0.0, 'norm_max': 0.0, 'clipped': 0}
+        self._layer_norm_max = None
+        if self._sum is not None:
+            self._sum.fill(0.0)
+            if self._comp is not None:
+                self._comp.fill(0.0)
+
+    def _allocate(self, keras_weights):
+        self.layout = FlatLayout(keras_weights)
+        self._sum = np.zeros(self.layout.size, dtype=np.float32)
+        self._comp = np.zeros(self.layout.size, dtype=np.float32) if self.compensated else None
+        self._scratch = np.empty(self.layout.size, dtype=np.float32)
+
+    def set_reference(self, keras_weights):
+        """
+        Sets the model update norms are measured (and clipped) against, typically the current global model
+        """
+        if self.layout is None:
+            self._allocate(keras_weights)
+        self._reference = self.layout.flatten(keras_weights)
+
+    def __len__(self):
+        return self.received
+
+    def _select(self):
+        if self.sample_size is None:
+            return True
+        _remaining = self.expected - (self.received - 1)
+        if _remaining <= 0:
+            return False
+        return np.random.random_sample() < (self.sample_size - self.merged) / _remaining
+
+    def add(self, weights, weight=1.0):
+        """
+        Folds a client update into the running sum
+
+        Args:
+            weights (list / SparseUpdate): full model (list of numpy arrays) or sparse update
+            weight (float): weight of the update in the average
+        Returns:
+            bool: False if the update was left out by sampling
+        """
+        _base = weights.base_weights if isinstance(weights, SparseUpdate) else weights
+        if self.layout is not None and not self.layout.matches(_base):
+            raise ValueError("Update layer shapes do not match the accumulated model")
+        self.received += 1
+        if not self._select():
+            return False
+        if self.layout is None:
+            self._allocate(_base)
+        _values = _flatten_update(self.layout, weights, out=self._scratch)
+        if self._reference is not None:
+            self._clip(_values)
+        if weight != 1.0:
+            _values *= np.float32(weight)
+        self._fold(_values)
+        self.merged += 1
+        self.total_weight += weight
+        return True
+
+    def _clip(self, values):
+        #per layer norms of the difference in one pass, the model norm follows from them
+        _layer_norms = self.layout.layer_norms(values - self._reference)
+        _norm = float(np.sqrt(np.square(_layer_norms).sum()))
+        if self.clip_norm is not None and _norm > self.clip_norm:
+            clip_by_norm(values, self.clip_norm, reference=self._reference)
+            self._norms['clipped'] += 1
+        self._norms['norm_sum'] += _norm
+        self._norms['norm_max'] = max(self._norms['norm_max'], _norm)
+        self._layer_norm_max = _layer_norms if self._layer_norm_max is None else np.maximum(self._layer_norm_max, _layer_norms)
+
+    def stats(self):
+        """
+        Returns the updates received / merged this round and, once a reference is set, the mean / max norm of the
+        merged updates' differences to it (and the max per layer, before clipping) and how many were clipped
+        """
+        _stats = {'received': self.received, 'merged': self.merged, 'total_weight': self.total_weight}
+        if self._reference is not None:
+            _stats.update(self._norms, norm_mean=self._norms['norm_sum'] / self.merged if self.merged else 0.0,
+                          layer_norm_max=None if self._layer_norm_max is None else self._layer_norm_max.round(6).tolist())
+        return _stats
+
+    def _fold(self, values):
+        if not self.compensated:
+            self._sum += values
+            return
+        #Kahan: values becomes y = values - comp, comp = (t - sum) - y, sum = t
+        values -= self._comp
+        np.add(self._sum, values, out=self._comp)
+        self._sum, self._comp = self._comp, self._sum
+        np.subtract(self._comp, self._sum, out=self._comp)
+        np.negative(self._comp, out=self._comp)
+        self._comp -= values
+
+    def result(self):
+        """
+        Returns the weighted average of the merged updates as a list of float32 numpy arrays
+        """
+        if not self.merged or self.total_weight <= 0:
+            raise ValueError("No updates merged")
+        return self.layout.unflatten(self._sum / np.float32(self.total_weight))
+
+class StalenessMixer():
+    """
+    Asynchronous aggregation: each update is mixed into the global model as soon as it arrives,
+    w = (1 - a) * w + a * update with a = alpha * (1 + staleness) ** -exponent, where staleness is the number of global
+    versions published since the model the client trained from. Stale updates still count, but less. The model is kept
+    as one flat float32 vector (see FlatLayout).
+
+    With clip_norm the L2 norm of each update's difference to the current model is limited to clip_norm before mixing.
+
+    Args:
+        keras_weights (list): initial global model
+        alpha (float): mixing weight of an update with no staleness, in (0, 1]
+        exponent (float): staleness decay, 0 weights every update alike
+        clip_norm (float) [Optional]: maximum L2 norm of an update's difference to the current model
+    """
+    def __init__(self, keras_weights, alpha, exponent=0.5, clip_norm=None):
+        if not 0.0 < alpha <= 1.0:
+            raise ValueError("alpha must be in (0, 1]")
+        if exponent < 0:
+            raise ValueError("exponent must be >= 0")
+        self.alpha = alpha
+        self.exponent = exponent
+        self.clip_norm = clip_norm
+        self.layout = FlatLayout(keras_weights)
+        self._model = self.layout.flatten(keras_weights)
+        self._scratch = np.empty(self.layout.size, dtype=np.float32)
+        self.reset_stats()
+
+    def reset_stats(self):
+        """
+        Starts counting the updates mixed since the last publish
+        """
+        self.pending = 0
+        self._stats = {'staleness_sum': 0, 'staleness_max': 0, 'clipped': 0}
+
+    def mixing_weight(self, staleness):
+        return self.alpha * (1.0 + max(staleness, 0)) ** -self.exponent
+
+    def mix(self, weights, staleness):
+        """
+        Mixes a client update into the global model
+
+        Args:
+            weights (list / SparseUpdate): full model (list of numpy arrays) or sparse update
+            staleness (int): global versions published since the client's base model
+        Returns:
+            float: the mixing weight used
+        """
+        _base = weights.base_weights if isinstance(weights, SparseUpdate) else weights
+        if not self.layout.matches(_base):
+            raise ValueError("Update layer shapes do not match the global model")
+        _values = _flatten_update(self.layout, weights, out=self._scratch)
+        if self.clip_norm is not None and clip_by_norm(_values, self.clip_norm, reference=self._model) > self.clip_norm:
+            self._stats['clipped'] += 1
+        _weight = self.mixing_weight(staleness)
+        #w += a * (update - w)
+        _values -= self._model
+        _values *= np.float32(_weight)
+        self._model += _values
+        self.pending += 1
+        self._stats['staleness_sum'] += staleness
+        self._stats['staleness_max'] = max(self._stats['staleness_max'], staleness)
+        return _weight
+
+    def stats(self):
+        """
+        Returns the updates mixed since the last publish, their mean / max staleness and how many were clipped
+        """
+        return dict(self._stats, mixed=self.pending,
+                    staleness_mean=self._stats['staleness_sum'] / self.pending if self.pending else 0.0)
+
+    def weights(self):
+        """
+        Returns a copy of the global model as a list of float32 numpy arrays
+        """
+        return self.layout.unflatten(self._model.copy())
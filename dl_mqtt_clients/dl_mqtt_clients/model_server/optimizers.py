@@ -0,0 +1,186 @@
+import os
+import logging
+import numpy as np
+from dl_mqtt_clients.func._nn_func import FlatLayout
+
+logger = logging.getLogger(__name__)
+
+class ServerOptimizer():
+    """
+    Server side optimizer stage of the merge. The difference between the averaged client models and the current global
+    model is treated as a pseudo-gradient (the negative of a gradient) and applied to the global model with the optimizer's
+    update rule. Weights are handled as flat float32 vectors (see FlatLayout), the state (per parameter moments and the
+    step count) can be saved to / restored from an .npz file so it survives restarts.
+
+    The base class is plain FedAvg: with lr=1.0 the new global model is the average itself.
+
+    Args:
+        lr (float): server learning rate
+    """
+    name = 'fedavg'
+    #per parameter state buffers, allocated on the first step
+    _state_names = ()
+
+    def __init__(self, lr=1.0):
+        if lr <= 0:
+            raise ValueError("lr must be > 0")
+        self.lr = lr
+        self.reset()
+
+    def reset(self):
+        """Drops the state, the next step starts from scratch"""
+        self.steps = 0
+        self.layout = None
+        self._state = {}
+
+    def _allocate(self, keras_weights):
+        self.layout = FlatLayout(keras_weights)
+        self._state = {name: np.zeros(self.layout.size, dtype=np.float32) for name in self._state_names}
+
+    def step(self, weights, averaged):
+        """
+        Applies one round of client updates to the global model
+
+        Args:
+            weights (list): current global model, list of numpy arrays
+            averaged (list): average of the client models of the round
+        Returns:
+            new_weights (list): list of float32 numpy arrays
+        """
+        if not self._state_names and self.lr == 1.0:
+            #plain FedAvg, the average is the new model
+            if self.layout is None:
+                self.layout = FlatLayout(weights)
+            self.steps += 1
+            return [np.asarray(layer, dtype=np.float32) for layer in averaged]
+        if self.layout is None or not self.layout.matches(weights):
+            if self.layout is not None:
+                logger.warning("Model layout changed, resetting {} state".format(self.name))
+            self._allocate(weights)
+        _weights = self.layout.flatten(weights)
+        _delta = self.layout.flatten(averaged)
+        _delta -= _weights
+        self.steps += 1
+        _weights += self._update(_delta)
+        return self.layout.unflatten(_weights)
+
+    def _update(self, delta):
+        """Returns the change applied to the global model for the (in place modifiable) pseudo-gradient delta"""
+        if self.lr != 1.0:
+            delta *= np.float32(self.lr)
+        return delta
+
+    def save(self, path):
+        """Writes the state to path, through a temporary file so a crash mid-write leaves the previous state intact"""
+        _tmp = path + '.tmp'
+        with open(_tmp, 'wb') as f:
+            np.savez(f, name=self.name, steps=self.steps, shapes=np.array([str(s) for s in self.layout.shapes]) if self.layout else np.array([]),
+                     **self._state)
+        os.replace(_tmp, path)
+
+    def load(self, path, keras_weights):
+        """
+        Restores the state saved by save() for a model shaped like keras_weights. Returns False (leaving the state
+        empty) if the file was written by another optimizer or for another model
+        """
+        with np.load(path) as f:
+            if str(f['name']) != self.name or list(f['shapes']) != [str(tuple(np.shape(l))) for l in keras_weights]:
+                logger.warning("Ignoring optimizer state {}: saved for another optimizer or model".format(path))
+                return False
+            self._allocate(keras_weights)
+            for name in self._state_names:
+                self._state[name][:] = f[name]
+            self.steps = int(f['steps'])
+        return True
+
+class FedAvgM(ServerOptimizer):
+    """
+    Server momentum: v = momentum * v + delta, w = w + lr * v
+
+    Args:
+        lr (float): server learning rate
+        momentum (float): momentum in [0, 1)
+    """
+    name = 'fedavgm'
+    _state_names = ('velocity',)
+
+    def __init__(self, lr=1.0, momentum=0.9):
+        super().__init__(lr=lr)
+        if not 0.0 <= momentum < 1.0:
+            raise ValueError("momentum must be in [0, 1)")
+        self.momentum = momentum
+
+    def _update(self, delta):
+        _v = self._state['velocity']
+        _v *= np.float32(self.momentum)
+        _v += delta
+        np.multiply(_v, np.float32(self.lr), out=delta)
+        return delta
+
+class FedAdam(ServerOptimizer):
+    """
+    Adam on the pseudo-gradient, without bias correction: m = beta1 * m + (1 - beta1) * delta,
+    v = beta2 * v + (1 - beta2) * delta^2, w = w + lr * m / (sqrt(v) + epsilon). epsilon bounds the step of parameters
+    that barely move, larger values make it behave more like FedAvgM
+
+    Args:
+        lr (float): server learning rate
+        beta1 (float): first moment decay in [0, 1)
+        beta2 (float): second moment decay in [0, 1)
+        epsilon (float): adaptivity
+    """
+    name = 'fedadam'
+    _state_names = ('m', 'v')
+
+    def __init__(self, lr=0.01, beta1=0.9, beta2=0.99, epsilon=1e-3):
+        super().__init__(lr=lr)
+        if not (0.0 <= beta1 < 1.0 and 0.0 <= beta2 < 1.0):
+            raise ValueError("beta1 and beta2 must be in [0, 1)")
+        if epsilon <= 0:
+            raise ValueError("epsilon must be > 0")
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.epsilon = epsilon
+
+    def _update(self, delta):
+        _m, _v = self._state['m'], self._state['v']
+        _m *= np.float32(self.beta1)
+        _m += np.float32(1.0 - self.beta1) * delta
+        _v *= np.float32(self.beta2)
+        np.square(delta, out=delta)
+        _v += np.float32(1.0 - self.beta2) * delta
+        np.sqrt(_v, out=delta)
+        delta += np.float32(self.epsilon)
+        np.divide(_m, delta, out=delta)
+        delta *= np.float32(self.lr)
+        return delta
+
+_OPTIMIZERS = {c.name: c for c in [ServerOptimizer, FedAvgM, FedAdam]}
+
+def get_server_optimizer(name, lr=None, momentum=0.9, beta2=0.99, epsilon=1e-3):
+    """
+    Builds the optimizer selected by name ('fedavg', 'fedavgm' or 'fedadam'). momentum is FedAdam's beta1, lr defaults
+    to 1.0 for fedavg / fedavgm and 0.01 for fedadam
+    """
+    if name not in _OPTIMIZERS:
+        raise ValueError("Unknown server optimizer: {}".format(name))
+    if name == 'fedadam':
+        return FedAdam(lr=0.01 if lr is None else lr, beta1=momentum, beta2=beta2, epsilon=epsilon)
+    if name == 'fedavgm':
+        return FedAvgM(lr=1.0 if lr is None else lr, momentum=momentum)
+    return ServerOptimizer(lr=1.0 if lr is None else lr)
+
+def load_server_optimizer(optimizer, path, keras_weights):
+    """
+    Restores the optimizer state from path if the file exists. An unreadable file is logged and the optimizer starts
+    from scratch
+    """
+    if not path or not os.path.exists(path):
+        return optimizer
+    try:
+        if optimizer.load(path, keras_weights):
+            logger.info("Restored {} state from {} ({} steps)".format(optimizer.name, path, optimizer.steps))
+    except Exception as e:
+        logger.warning("Ignoring unreadable optimizer state {}: {}".format(path, e))
+        optimizer.reset()
+    return optimizer
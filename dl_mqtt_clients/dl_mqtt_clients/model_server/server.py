@@ -1,9 +1,13 @@
 from dl_mqtt_clients.clients import _mosq_client
-from dl_mqtt_clients.net.net import SerializableWeights
-from dl_mqtt_clients.func._nn_func import getMinMaxVals, compress_keras_weights, inflate_keras_weights, is_weight_list_same_dim, merge_models
+from dl_mqtt_clients.net.weights import SerializableWeights
+from dl_mqtt_clients.func._nn_func import apply_keras_weights_delta, SparseUpdate, delta_keras_weights, topk_sparsify, apply_sparse_delta
+from dl_mqtt_clients.model_server.accumulator import WeightAccumulator, StalenessMixer
+from dl_mqtt_clients.model_server.optimizers import get_server_optimizer, load_server_optimizer
 import logging
 import numpy as np
 import json
+import uuid
+from collections import OrderedDict
 import jsonpickle
 import jsonpickle.ext.numpy as jsonpickle_numpy
 import time
@@ -18,7 +22,30 @@ class ModelAggregator():
     MQTT Application that reads Keras Weights over MQTT then aggregates them based on class parameters
 
     Attributes
-        weight_cache (list): cached weights that trigger behavior when filled (e.g. >= server_config.model_cache_size())
+        weight_cache (WeightAccumulator): running sum of the updates received this round, merged once it holds
+                                          server_config.model_cache_size() updates. With merge_ratio < 1 a random subset
+                                          of round(merge_ratio * model_cache_size) of them is summed. With
+                                          server_config.update_clip_norm() the difference of each update to the last
+                                          published model is clipped to that L2 norm. With
+                                          server_config.update_weighting() == 'samples' each update is weighted by the
+                                          number of samples the client trained on (updates without it count as 1)
+
+    The merged average is applied to the last published model by the server optimizer selected with
+    server_config.server_optimizer() (see optimizers.py), its state is saved to server_config.optimizer_state_path() after
+    every round.
+
+    With server_config.aggregation_mode() == 'async' updates are not cached: each one is mixed into the global model as it
+    arrives by a StalenessMixer, weighted down by how many versions were published since the model the client trained
+    from, and the global model is republished every server_config.publish_interval() seconds if updates arrived.
+    Each publish counts as a round.
+
+    The sample weighted mean of the training loss reported with the merged updates is logged every round. With
+    server_config.target_loss() the number of rounds (and time) until it first reaches the target is logged as well.
+
+    Every published model is tagged with this aggregator's session id and an increasing version. The decoded form of the
+    last server_config.version_history_size() versions is kept so delta encoded client updates can be rebuilt.
+    With server_config.downlink_mode() == 'delta' models on the update topic are sent as the difference to the previously
+    published version, with a full keyframe every server_config.keyframe_interval() publishes.
 
     Args:
         mqtt_config (MQTTConnectionConfig): MQTT Connection info parameters. See configurations.py
@@ -32,9 +59,33 @@ class ModelAggregator():
         self.model_client = _mosq_client(config=mqtt_config, on_message_callb=self.on_message_model)
 		
         #data struct
-        self.weight_cache = []
+        self.weight_cache = self._new_accumulator()
+        #the first round's updates are clipped against the initial model
+        self.weight_cache.set_reference(self.model.get_weights())
+        self.server_optimizer = load_server_optimizer(get_server_optimizer(server_config.server_optimizer(), lr=server_config.server_lr(),
+                                                                           momentum=server_config.server_momentum(),
+                                                                           beta2=server_config.server_beta2(),
+                                                                           epsilon=server_config.server_epsilon()),
+                                                      path=server_config.optimizer_state_path(), keras_weights=self.model.get_weights())
         self._round_counter = 0
         self._time_last_model_received = time.time()
+        self._session = uuid.uuid4().hex[:8]
+        self._model_version = 0
+        self._version_history = OrderedDict()
+        self._downlink_version = None
+        self._downlink_deltas = 0
+        self._loss_sum = 0.0
+        self._loss_weight = 0.0
+        self._rounds_total = 0
+        self._time_started = time.time()
+        self.loss_history = []
+        self.target_loss_round = None
+        self._lock = threading.Lock()
+        self._stop_publishing = threading.Event()
+        self._mixer = None
+        if server_config.aggregation_mode() == 'async':
+            self._mixer = StalenessMixer(self.model.get_weights(), alpha=server_config.async_alpha(),
+                                         exponent=server_config.staleness_exponent(), clip_norm=server_config.update_clip_norm())
 
     def _publish_status_update(self, json_d: Dict):
         if self.status_update_topic:
@@ -44,15 +95,56 @@ class ModelAggregator():
             logger.warning('status_update_topic not set ({}) no messages will be sent'.format(self.status_update_topic))
         return
 
+    def _new_accumulator(self):
+        _expected = self.server_config.model_cache_size()
+        _sample_size = None
+        if self.server_config.merge_ratio() < 1.0:
+            _sample_size = max(1, round(self.server_config.merge_ratio() * _expected))
+        return WeightAccumulator(expected=_expected, sample_size=_sample_size, clip_norm=self.server_config.update_clip_norm())
+
+    def _update_weight(self, serialW):
+        """
+        Returns the weight of a client update in the merge
+        """
+        if self.server_config.update_weighting() == 'samples' and serialW.num_samples:
+            return float(serialW.num_samples)
+        return 1.0
+
+    def _track_loss(self, serialW):
+        if serialW.loss is not None and np.isfinite(serialW.loss):
+            _weight = serialW.num_samples or 1
+            self._loss_sum += _weight * serialW.loss
+            self._loss_weight += _weight
+
+    def _log_round_loss(self):
+        """
+        Logs the sample weighted mean training loss of the round just merged and whether the target loss was reached
+        """
+        self._rounds_total += 1
+        if not self._loss_weight:
+            return
+        _loss = self._loss_sum / self._loss_weight
+        self._loss_sum, self._loss_weight = 0.0, 0.0
+        self.loss_history.append(_loss)
+        logger.info("Round {} mean client training loss: {}".format(self._rounds_total, _loss))
+        _target = self.server_config.target_loss()
+        if _target is not None and self.target_loss_round is None and _loss <= _target:
+            self.target_loss_round = self._rounds_total
+            logger.info("Target loss {} reached after {} rounds ({:.1f}s)".format(_target, self._rounds_total, time.time() - self._time_started))
+
     def _run_merge_models(self):
         """
-        Merges a ratio of models from the model cache 
+        Averages the updates folded into the weight cache and applies the average to the global model with the server optimizer
         """	
-        _nModelsMerge = round(self.server_config.merge_ratio() * len(self.weight_cache))
-        _index = np.random.choice(len(self.weight_cache), _nModelsMerge, replace=False)
-        _merged_model = merge_models(weights=[self.weight_cache[i] for i in _index])
-        logger.debug("Running merge models on indexes: {}".format(_index))
-        return _merged_model
+        logger.info("Merging updates: {}".format(self.weight_cache.stats()))
+        _global = self._version_history.get(self._model_version)
+        _weights = self.server_optimizer.step(self.model.get_weights() if _global is None else _global, self.weight_cache.result())
+        if self.server_config.optimizer_state_path():
+            try:
+                self.server_optimizer.save(self.server_config.optimizer_state_path())
+            except OSError as e:
+                logger.warning("Cannot save server optimizer state: {}".format(e))
+        return _weights
 		
     def check_cache(self):
         """
@@ -62,34 +154,154 @@ class ModelAggregator():
         #check cache fill
         if self.server_config.model_cache_size() <= len(self.weight_cache):
             _pubModel = self._run_merge_models()
-            self._publish_status_update(json_d={'mode': 3, 'color': 'yellow', 'percent': 0})
-            logger.debug("Serializing model weights")
-            _min, _max = getMinMaxVals(_pubModel)
-            s = SerializableWeights(keras_weights=_pubModel, precision=self.server_config.precision(), minV=_min, maxV=_max)
+            self._log_round_loss()
             logger.info("Publishing model weights and clearing weight cache (round {} of {})".format(self._round_counter+1, self.server_config.num_rounds()))
-            self._round_counter += 1
-            if self._round_counter >= self.server_config.num_rounds():
-                self.model_client.publish_msg(formatted_msg=jsonpickle.encode(s), pub_topic=self.server_config.prod_pub_topic())
-                self._publish_status_update(json_d={'mode': 3, 'color': 'all', 'percent': 0})
-                self._round_counter = 0
-            else:
-                self.model_client.publish_msg(formatted_msg=jsonpickle.encode(s))
-                self._publish_status_update(json_d={'mode': 3, 'color': 'green', 'percent': 0})
-                
-                _weights = []
-                for layer in _pubModel:
-                    _weights.append(np.copy(layer).astype('float32'))
-                   
-                logger.info("Updating Server Model Weights")
-                try:
-                    self.model.update_weights(weights=_weights)
-                except Exception as e:
-                    logger.info(e)
-            self.weight_cache = []
+            self._publish_round(_pubModel)
+            self.weight_cache.reset()
+            #update norms of the next round are measured (and clipped) against the model just published
+            self.weight_cache.set_reference(self._version_history[self._model_version])
         else:
             logger.debug('Checked cache: cache not filled yet')
         return
+
+    def _publish_round(self, weights):
+        """
+        Publishes the model of a finished round, to the prod topic every server_config.num_rounds() rounds
+        """
+        self._publish_status_update(json_d={'mode': 3, 'color': 'yellow', 'percent': 0})
+        logger.debug("Serializing model weights")
+        self._round_counter += 1
+        if self._round_counter >= self.server_config.num_rounds():
+            self._publish_model(weights, pub_topic=self.server_config.prod_pub_topic())
+            self._publish_status_update(json_d={'mode': 3, 'color': 'all', 'percent': 0})
+            self._round_counter = 0
+        else:
+            self._publish_model(weights)
+            self._publish_status_update(json_d={'mode': 3, 'color': 'green', 'percent': 0})
+            
+            _weights = []
+            for layer in weights:
+                _weights.append(np.copy(layer).astype('float32'))
+               
+            logger.info("Updating Server Model Weights")
+            try:
+                self.model.update_weights(weights=_weights)
+            except Exception as e:
+                logger.info(e)
+
+    def _staleness(self, serialW):
+        """
+        Returns the number of global versions published since the model an update was trained from. Updates that do
+        not name a base model of this session are assumed to start from the initial model
+        """
+        if serialW.base_session == self._session and serialW.base_version is not None:
+            return max(0, self._model_version - serialW.base_version)
+        return self._model_version
+
+    def _mix_update(self, serialW):
+        """
+        Mixes an update into the global model (async mode). The update is resolved and its staleness computed under the
+        lock, publishes running on the timer thread change the version history
+        """
+        with self._lock:
+            _weights = self._resolve_update(serialW)
+            if _weights is None:
+                return
+            self._time_last_model_received = time.time()
+            _staleness = self._staleness(serialW)
+            _alpha = self._mixer.mix(_weights, _staleness)
+            self._track_loss(serialW)
+        logger.info("Mixed update (staleness {}, weight {:.3f}), {} since last publish".format(_staleness, _alpha, self._mixer.pending))
+
+    def publish_async(self):
+        """
+        Publishes the global model if updates were mixed into it since the last publish (async mode)
+
+        Returns:
+            bool: True if a model was published
+        """
+        with self._lock:
+            if not self._mixer.pending:
+                return False
+            logger.info("Publishing model weights (round {} of {}, last update {:.1f}s ago): {}".format(
+                self._round_counter+1, self.server_config.num_rounds(), time.time() - self._time_last_model_received, self._mixer.stats()))
+            _pubModel = self._mixer.weights()
+            self._mixer.reset_stats()
+            self._log_round_loss()
+            self._publish_round(_pubModel)
+        return True
+
+    def _publish_loop(self):
+        while not self._stop_publishing.wait(self.server_config.publish_interval()):
+            try:
+                self.publish_async()
+            except Exception as e:
+                logger.error("Publishing model failed: {}".format(e))
 		
+    def _serialize_model(self, weights, pub_topic):
+        """
+        Serializes the global model for publishing, either in full or as a delta against the last version published
+        on the update topic
+
+        Returns:
+            s (SerializableWeights): serialized model
+            view (list): the weights as receivers will hold them after decoding s
+        """
+        _precision, _quant_mode = self.server_config.precision(), self.server_config.quant_mode()
+        _base = self._downlink_version
+        if (pub_topic is not None or self.server_config.downlink_mode() != 'delta' or _base not in self._version_history
+                or self._downlink_deltas + 1 >= self.server_config.keyframe_interval()):
+            s = SerializableWeights.from_keras_weights(keras_weights=weights, precision=_precision, quant_mode=_quant_mode)
+            return s, s.inflate()
+        _base_weights = self._version_history[_base]
+        if self.server_config.downlink_topk_ratio() is not None:
+            #the part left out is still in the difference to the next version, so nothing is lost
+            _values, _indices, _ = topk_sparsify(delta_keras_weights(weights, _base_weights, keep_all=True), self.server_config.downlink_topk_ratio())
+            s = SerializableWeights.from_keras_weights(keras_weights=_values, precision=_precision, quant_mode=_quant_mode)
+            s.set_delta_base(base_session=self._session, base_version=_base, indices=_indices)
+            return s, apply_sparse_delta(_base_weights, _indices, s.inflate())
+        s = SerializableWeights.from_keras_weights(keras_weights=delta_keras_weights(weights, _base_weights), precision=_precision, quant_mode=_quant_mode)
+        s.set_delta_base(base_session=self._session, base_version=_base)
+        return s, apply_keras_weights_delta(_base_weights, s.inflate())
+
+    def _publish_model(self, weights, pub_topic=None):
+        """
+        Serializes the global model, tags it with the next version, records it for rebuilding delta updates and publishes it
+        """
+        s, _view = self._serialize_model(weights, pub_topic)
+        self._model_version += 1
+        s.set_version(session=self._session, version=self._model_version)
+        #keep the weights exactly as receivers will decode them, deltas are computed against those
+        self._version_history[self._model_version] = _view
+        while len(self._version_history) > self.server_config.version_history_size():
+            self._version_history.popitem(last=False)
+        if pub_topic is None:
+            self._downlink_version = self._model_version
+            self._downlink_deltas = self._downlink_deltas + 1 if s.encoding != 'full' else 0
+        logger.info("Publishing model version {} ({})".format(self._model_version, s.encoding))
+        self.model_client.publish_msg(formatted_msg=s.encode(wire_format=self.server_config.wire_format()), pub_topic=pub_topic)
+
+    def _resolve_update(self, serialW):
+        """
+        Returns the full weights of a client update, rebuilding delta encoded updates from the version history.
+        Sparse updates are returned as a SparseUpdate referencing the base version so they are only expanded during the merge.
+        Returns None if the update references a global model version that is no longer (or never was) known
+        """
+        _weights = serialW.inflate()
+        if serialW.encoding == 'full':
+            return _weights
+        _base = self._version_history.get(serialW.base_version) if serialW.base_session == self._session else None
+        if _base is None:
+            logger.warning("Dropping delta update against unknown global model (session {}, version {})".format(serialW.base_session, serialW.base_version))
+            return None
+        if serialW.encoding == 'sparse':
+            for layer, index in zip(_base, serialW.indices):
+                if index is not None and index.size and (index.min() < 0 or index.max() >= np.size(layer)):
+                    logger.warning("Dropping sparse update with out of range indices")
+                    return None
+            return SparseUpdate(base_weights=_base, indices=serialW.indices, values=_weights)
+        return apply_keras_weights_delta(_base, _weights)
+
     def _validate_configs(self):
         pass
 
@@ -100,8 +312,11 @@ class ModelAggregator():
             logger.error("Error with validating configurations, client will not connect")
             raise
         self.model_client.connect_client()
+        if self._mixer is not None:
+            threading.Thread(target=self._publish_loop, daemon=True).start()
 
     def shutdown(self):
+        self._stop_publishing.set()
         self.model_client.shutdown()
 
     def on_message_model(self, client, userdata, msg):
@@ -110,18 +325,23 @@ class ModelAggregator():
         """
         logger.info("Message (sz: {}) received on topic: {}".format(len(msg.payload), msg.topic))
         logger.debug("Msg: {}".format(str(msg.payload)))
-        _serialW = jsonpickle.decode(msg.payload.decode('utf8'))
-        if not isinstance(_serialW, SerializableWeights):
-            raise TypeError("Deserialized object is not of instance Serializable Weights: {}".format(type(_serialW)))
+        serialW = SerializableWeights.decode(msg.payload)
+        if self._mixer is not None:
+            try:
+                self._mix_update(serialW)
+            except ValueError as e:
+                logger.warning("Dropping update: {}".format(e))
+            return
+        _weights = self._resolve_update(serialW)
+        if _weights is None:
+            return
+        self._time_last_model_received = time.time()
         try:
-            _serialW._validate()
-        except AssertionError:
-            raise TypeError("Error validating deserialized weight types")
-        if _serialW.precision != 32:
-            _weights = inflate_keras_weights(keras_weights=_serialW.weights, minV=_serialW.minV, maxV=_serialW.maxV, base_precision=_serialW.precision)
-        else:
-            _weights = _serialW.weights
-        self.weight_cache.append(_weights)
+            if self.weight_cache.add(_weights, weight=self._update_weight(serialW)):
+                self._track_loss(serialW)
+        except ValueError as e:
+            logger.warning("Dropping update: {}".format(e))
+            return
         percent_complete = (len(self.weight_cache)/(self.server_config.model_cache_size()))*100
         logger.info("Weights deserialized and cached. Current Cache: {}. Max:{}".format(len(self.weight_cache), self.server_config.model_cache_size()))
         self._publish_status_update(json_d={'mode': 2, 'color': 'red', 'percent': percent_complete})
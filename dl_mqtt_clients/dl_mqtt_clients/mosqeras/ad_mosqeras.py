@@ -2,37 +2,390 @@ import numpy as np
 import time
 import threading
 import sys
+from collections import deque
 from dl_mqtt_clients.mosqeras import mosqeras
+from dl_mqtt_clients.mosqeras.inference_executor import InferenceExecutor
+from dl_mqtt_clients.mosqeras.score_cache import ScoreCache
 from dl_mqtt_clients.func._nn_func import normalize_data
-from dl_mqtt_clients.func._ad_ae_func import reconstr_error
+
+#fields every batched output message carries, passthrough fields may not reuse them
+_OUTPUT_FIELDS = ('anomaly_score', 'timestamp', 'model_version', 'model_session', 'rows')
+
+def _train_stats(num_samples, history):
+    """
+    Returns the sample count, epochs run and final loss of a training run, for weighting its update on the aggregator
+    """
+    _stats = {'num_samples': num_samples}
+    _losses = getattr(history, 'history', {}).get('loss')
+    if _losses:
+        #early stopping may end the run before the configured number of epochs
+        _stats.update(epochs=len(_losses), loss=float(_losses[-1]))
+    return _stats
+
+def _per_row(value, n_rows, name):
+    """
+    Expands a passthrough field of a data message to one value per row: lists must hold one value per row, scalars
+    (e.g. a message timestamp) apply to every row
+    """
+    if isinstance(value, np.ndarray):
+        value = value.tolist()
+    if isinstance(value, (list, tuple)):
+        if len(value) != n_rows:
+            raise ValueError("Field {} has {} values for {} rows".format(name, len(value), n_rows))
+        return list(value)
+    return [value] * n_rows
 
 class predict_client(mosqeras.mosqeras):
     """Anomaly detection prediction client. Simply uses trained autoencoder to score incoming instances generating anomaly metric
+
+    By default the data cache is processed once cache_sz rows arrived. With set_batching_config a batch is also flushed
+    max_latency_ms after its first row arrived (driven by a timer thread, not by the next message), and optionally the
+    batch size is tuned from the observed arrival rate and processing time to keep the latency under p99_target_ms.
+
+    Batches are scored by a long-lived InferenceExecutor (one worker and a queue of 4 batches unless changed with
+    set_executor_config) and scores are published in arrival order.
+
+    With set_score_cache, scores of rows already seen with the current model weights are reused and only unseen rows
+    are scaled and run through the model.
+
+    With set_output_config, scores are published as columnar batches carrying the model version and per row fields
+    (e.g. an event id) passed through from the input messages, optionally coalescing batches emitted close together.
     """
+    max_latency_ms = None
+    p99_target_ms = None
+    _flusher = None
+    _executor = None
+    _executor_config = {'workers': 1, 'max_queue': 4, 'overflow': 'block'}
+    _score_cache = None
+    passthrough_fields = ()
+    coalesce_ms = None
+    _batched_output = False
+    _row_fields = None
+    _coalesce_timer = None
+    #time source of the batching deadlines and latency stats, replaceable in tests
+    _clock = staticmethod(time.monotonic)
+
+    def set_output_config(self, passthrough_fields=(), coalesce_ms=None):
+        """
+        Switches to batched output messages: one column per passthrough field plus anomaly_score, with model_version,
+        model_session and rows fields
+
+        Args:
+            passthrough_fields (list): fields of the data messages copied to the output, one value per row (a scalar
+                                       field applies to every row of its message). Names of the output fields
+                                       (anomaly_score, timestamp, model_version, model_session, rows) are rejected
+            coalesce_ms (float) [Optional]: batches scored within this many milliseconds of the first unpublished one
+                                            are published as one message
+        """
+        if coalesce_ms is not None and coalesce_ms <= 0:
+            raise ValueError("coalesce_ms must be > 0")
+        _reserved = [name for name in passthrough_fields if name in _OUTPUT_FIELDS]
+        if _reserved:
+            raise ValueError("Passthrough fields {} clash with the output fields {}".format(_reserved, list(_OUTPUT_FIELDS)))
+        with self._cache_lock:
+            self.passthrough_fields = tuple(passthrough_fields)
+            self._row_fields = {name: [] for name in self.passthrough_fields}
+        self.coalesce_ms = coalesce_ms
+        self._output_lock = threading.Lock()
+        self._pending_output = []
+        self._batched_output = True
+        self.logger.info("Batched output enabled, passthrough fields: {}, coalesce: {} ms".format(list(self.passthrough_fields), coalesce_ms))
+
+    def _read_rows(self, payload):
+        if not self.passthrough_fields:
+            return super()._read_rows(payload)
+        data, fields = self.serializer.deserialize_rows(input=payload, field='data', passthrough=self.passthrough_fields, features=self.features)
+        return data, {name: _per_row(value, len(data), name) for name, value in fields.items()}
+
+    def _cache_rows_written(self, row_fields, start, n):
+        if row_fields is None or self._row_fields is None:
+            return
+        for name, values in self._row_fields.items():
+            values.extend(row_fields[name][start:start + n])
+
+    def _take_batch(self):
+        """
+        Takes the cached rows and their passthrough fields (None without passthrough fields)
+        """
+        data = self.data_cache.take()
+        if self._row_fields is None:
+            return data, None
+        row_fields, self._row_fields = self._row_fields, {name: [] for name in self.passthrough_fields}
+        #rows cached before set_output_config have no fields
+        return data, {name: [None] * (len(data) - len(values)) + values for name, values in row_fields.items()}
+
+    def set_score_cache(self, max_size):
+        """
+        Enables the score cache (see ScoreCache), max_size of 0 / None disables it
+
+        Args:
+            max_size (int): number of distinct rows whose score is kept
+        """
+        self._score_cache = ScoreCache(max_size=max_size) if max_size else None
+        self.logger.info("Score cache size: {}".format(max_size))
+
+    def score_cache_stats(self):
+        """
+        Returns the score cache statistics (see ScoreCache.stats), None if it is disabled
+        """
+        return None if self._score_cache is None else self._score_cache.stats()
+
+    def set_executor_config(self, workers=1, max_queue=4, overflow='block'):
+        """
+        Sets up the inference workers
+
+        Args:
+            workers (int): number of inference worker threads
+            max_queue (int): number of filled batches that may wait for a worker
+            overflow (str): what to do with a batch when the queue is full, one of InferenceExecutor.overflow_policies.
+                            'block' waits on the MQTT network thread with the cache lock held, see InferenceExecutor
+        """
+        _executor = self._build_executor(workers=workers, max_queue=max_queue, overflow=overflow)
+        if self._executor is not None:
+            self._executor.shutdown()
+        self._executor_config = {'workers': workers, 'max_queue': max_queue, 'overflow': overflow}
+        self._executor = _executor
+
+    def _build_executor(self, workers, max_queue, overflow):
+        return InferenceExecutor(process_fn=self._score_batch, emit_fn=self._emit_batch, workers=workers, max_queue=max_queue,
+                                 overflow=overflow, on_drop=lambda data, *args: self.data_cache.release(data))
+
+    def _submit(self, data, first_row_time=None, row_fields=None):
+        if self._executor is None:
+            self._executor = self._build_executor(**self._executor_config)
+        self._executor.submit(data, first_row_time, row_fields)
+
+    def executor_stats(self):
+        """
+        Returns the inference queue statistics (see InferenceExecutor.stats), None before the first batch
+        """
+        return None if self._executor is None else self._executor.stats()
+
+    def set_batching_config(self, max_latency_ms, p99_target_ms=None):
+        """
+        Enables deadline based micro-batching
+
+        Args:
+            max_latency_ms (float): flush a partial batch this many milliseconds after its first row arrived
+            p99_target_ms (float) [Optional]: if set, the batch size is tuned (up to cache_sz) so that 99% of rows are
+                                              scored within this many milliseconds of arriving
+        """
+        if not max_latency_ms or max_latency_ms <= 0:
+            raise ValueError("max_latency_ms must be > 0")
+        if p99_target_ms is not None and p99_target_ms <= 0:
+            raise ValueError("p99_target_ms must be > 0")
+        self.max_latency_ms = max_latency_ms
+        self.p99_target_ms = p99_target_ms
+        self._batch_target = self.cache_sz
+        self._first_row_time = None
+        self._arrival_rate = None
+        self._row_cost = 0.0
+        self._latencies = deque(maxlen=1000)
+        #guards the tuning state shared with the inference workers; taken after _cache_lock, never held while blocking
+        self._tuning_lock = threading.Lock()
+        self._flush_cond = threading.Condition(self._cache_lock)
+        self._stopped = False
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, name='predict_flush', daemon=True)
+            self._flusher.start()
+        self.logger.info("Micro-batching enabled: max {} rows or {} ms (p99 target: {} ms)".format(self.cache_sz, max_latency_ms, p99_target_ms))
+
+    def _flush_loop(self):
+        with self._flush_cond:
+            while not self._stopped:
+                self._flush_cond.wait(self._flush_due())
+
+    def _flush_due(self):
+        """
+        Flushes the cached rows if the latency deadline of the first one has passed, called with _cache_lock held
+
+        Returns:
+            float: seconds until the next deadline, None if no row is waiting
+        """
+        if self._first_row_time is None:
+            return None
+        _remaining = self._first_row_time + self.max_latency_ms / 1000.0 - self._clock()
+        if _remaining > 0:
+            return _remaining
+        self.logger.debug("Latency deadline reached, flushing {} rows".format(len(self.data_cache)))
+        self._dispatch()
+        return None
+
+    def _dispatch(self):
+        _first_row_time, self._first_row_time = self._first_row_time, None
+        if _first_row_time is not None and len(self.data_cache):
+            _elapsed = self._clock() - _first_row_time
+            _rate = len(self.data_cache) / max(_elapsed, 1e-6)
+            with self._tuning_lock:
+                self._arrival_rate = _rate if self._arrival_rate is None else 0.8 * self._arrival_rate + 0.2 * _rate
+        data, row_fields = self._take_batch()
+        self._submit(data, _first_row_time, row_fields)
+
+    def _score_batch(self, data, first_row_time, row_fields=None):
+        """
+        Runs on an inference worker: scores a batch taken from the data cache and hands the buffer back. The scores are
+        labelled with the global model they were computed with, read before scoring
+        """
+        _start, _rows = self._clock(), len(data)
+        _model = self._model_tag()
+        try:
+            scores = self._score(data)
+        finally:
+            self.data_cache.release(data)
+        return scores, row_fields, first_row_time, _rows, self._clock() - _start, _model
+
+    def _emit_batch(self, result):
+        """
+        Publishes the scores of a batch, called in batch arrival order
+        """
+        scores, row_fields, first_row_time, _rows, _elapsed, _model = result
+        self._publish_scores(scores, row_fields, _model)
+        if self.max_latency_ms is None or first_row_time is None or not _rows:
+            return
+        _latency = self._clock() - first_row_time
+        #not _cache_lock: the MQTT thread may hold it while blocked on a full inference queue
+        with self._tuning_lock:
+            self._latencies.append(_latency)
+            self._row_cost = 0.8 * self._row_cost + 0.2 * _elapsed / _rows if self._row_cost else _elapsed / _rows
+            if self.p99_target_ms is not None and self._arrival_rate:
+                #a row waits for the batch to fill (n / rate) and for the batch to be scored (n * row_cost)
+                _target_s = self.p99_target_ms / 1000.0
+                self._batch_target = int(max(1, min(self.cache_sz, self._arrival_rate * _target_s / (1.0 + self._arrival_rate * self._row_cost))))
+
+    def latency_stats(self):
+        """
+        Returns the batch target size, arrival rate (rows/s) and p50 / p99 latency (ms) from a row arriving to its score
+        being published, over the last 1000 batches
+        """
+        if self.max_latency_ms is None:
+            return None
+        with self._tuning_lock:
+            if not self._latencies:
+                return None
+            _lat = np.array(self._latencies) * 1000.0
+            _batch_target, _arrival_rate = self._batch_target, self._arrival_rate
+        return {'batch_target': _batch_target, 'arrival_rate': _arrival_rate,
+                'p50_ms': float(np.percentile(_lat, 50)), 'p99_ms': float(np.percentile(_lat, 99))}
+
+    def _model_tag(self):
+        return self.model.global_session, self.model.global_version
+
+    def _publish_scores(self, scores, row_fields, model):
+        if self.coalesce_ms is None:
+            self.dataClient.publish_msg(formatted_msg=self._format_output(scores, row_fields, model))
+            return
+        with self._output_lock:
+            self._pending_output.append((scores, row_fields, model))
+            if self._coalesce_timer is None:
+                self._coalesce_timer = threading.Timer(self.coalesce_ms / 1000.0, self._flush_output)
+                self._coalesce_timer.daemon = True
+                self._coalesce_timer.start()
+
+    def _flush_output(self):
+        """
+        Publishes the batches held back for coalescing, one message per run of batches scored by the same model
+        """
+        with self._output_lock:
+            pending, self._pending_output = self._pending_output, []
+            self._coalesce_timer = None
+        while pending:
+            _model = pending[0][2]
+            _n = next((i for i, p in enumerate(pending) if p[2] != _model), len(pending))
+            run, pending = pending[:_n], pending[_n:]
+            scores = np.concatenate([np.atleast_1d(np.asarray(s, dtype=np.float32)) for s, _, _ in run])
+            row_fields = None
+            if self.passthrough_fields:
+                row_fields = {name: [] for name in self.passthrough_fields}
+                for s, fields, _ in run:
+                    for name, values in row_fields.items():
+                        values.extend(fields[name] if fields is not None else [None] * len(np.atleast_1d(s)))
+            self.logger.debug("Publishing {} coalesced batches ({} rows)".format(len(run), len(scores)))
+            self.dataClient.publish_msg(formatted_msg=self._format_output(scores, row_fields, _model))
+
+    def _format_output(self, scores, row_fields, model=None):
+        """
+        Formats scores for publishing, model is the (session, version) of the global model that computed them
+        """
+        #TODO: configurable output field name
+        if not self._batched_output:
+            return self.serializer.serialize(data=scores, output_field_name='anomaly_score')
+        _session, _version = self._model_tag() if model is None else model
+        columns = dict(row_fields or {}, anomaly_score=np.atleast_1d(scores))
+        return self.serializer.serialize_batch(columns=columns, fields={'model_version': _version,
+                                                                        'model_session': _session,
+                                                                        'rows': len(columns['anomaly_score'])})
+
+    def shutdown(self):
+        if self._flusher is not None:
+            with self._flush_cond:
+                self._stopped = True
+                self._flush_cond.notify()
+        if self._executor is not None:
+            self._executor.shutdown()
+        if self._coalesce_timer is not None:
+            self._coalesce_timer.cancel()
+            self._flush_output()
+        super().shutdown()
+
     def _preprocess(self, data):
-        return normalize_data(np.array(data).astype(np.float), self.sk_scaler)
+        #batches are taken from the data cache, an AffineScaler scales them in place
+        return normalize_data(np.asarray(data, dtype=np.float32), self.sk_scaler, copy=False)
 
-    def _postprocess(self, predicted, expected):
-        return reconstr_error(predicted, expected)
+    def _postprocess(self):
+        #the model computes the reconstruction error itself, see _model_scores
+        return
 	
-    def _process_data(self, data):
+    def _model_scores(self, data):
         prepro_data = self._preprocess(data=data)
         #prepro_data = data
         _start_time = time.time()
-        res = self.model.predict(data=prepro_data)
+        #the reconstruction error is computed by the model in one pass
+        postpro_data = self.model.reconstruction_error(data=prepro_data)
         self.logger.info("Model prediction finished in {} seconds".format(time.time()-_start_time))
-        postpro_data = self._postprocess(res, prepro_data)
-        #TODO: configurable output field name
-        out_msg = self.serializer.serialize(data=postpro_data, output_field_name='anomaly_score')
-        self.dataClient.publish_msg(formatted_msg=out_msg)
+        return postpro_data
+
+    def _cached_scores(self, data):
+        """
+        Scores a batch through the score cache, only distinct unseen rows are run through the model
+        """
+        _version = self.model.weight_version
+        scores, misses = self._score_cache.lookup(data, _version)
+        if misses:
+            _positions = list(misses.values())
+            _scores = self._model_scores(data[[p[0] for p in _positions]])
+            for p, score in zip(_positions, _scores):
+                scores[p] = score
+            self._score_cache.store(misses.keys(), _scores, _version)
+        self.logger.debug("Score cache: {} of {} rows scored by the model".format(len(misses), len(data)))
+        return scores
+
+    def _score(self, data):
+        """
+        Returns the anomaly score of each row of data
+        """
+        if self._score_cache is None:
+            return self._model_scores(data)
+        return self._cached_scores(data)
+
+    def _process_data(self, data):
+        _model = self._model_tag()
+        self.dataClient.publish_msg(formatted_msg=self._format_output(self._score(data), None, _model))
 
     def _check_cache(self):
-        if len(self.data_cache) < self.cache_sz:            
+        if self.max_latency_ms is not None:
+            if self._first_row_time is None and len(self.data_cache):
+                self._first_row_time = self._clock()
+                self._flush_cond.notify()
+            with self._tuning_lock:
+                _batch_target = self._batch_target
+            if len(self.data_cache) >= _batch_target:
+                self._dispatch()
+            return
+        if not self.data_cache.full():
             return
         self.logger.info("Data cache filled ({}), processing data ...".format(self.cache_sz))
-        thread_data = self.data_cache.copy()
-        self.data_cache = None
-        threading.Thread(target = self._process_data, args = (thread_data,)).start()
+        data, row_fields = self._take_batch()
+        self._submit(data, None, row_fields)
 
     def _validate_configs(self):
         return True
@@ -51,7 +404,7 @@ class train_client(mosqeras.mosqeras):
         self.train_config._validate_config()
 	
     def _preprocess(self, data):
-        return normalize_data(data=data, scaler=self.sk_scaler)
+        return normalize_data(data=data, scaler=self.sk_scaler, copy=False)
 
     def _postprocess(self):
         return
@@ -67,15 +420,19 @@ class train_client(mosqeras.mosqeras):
                                lr_cooldown=self.train_config.lr_cooldown(), 
                                min_lr=self.train_config.min_lr())
         _start_time = time.time()
-        self.model.fit_model(train_data=prepro_data, labels=prepro_data, batch_size=self.train_config.train_bs(), epochs=self.train_config.train_epochs(), verbose=2)
+        history = self.model.fit_model(train_data=prepro_data, labels=prepro_data, batch_size=self.train_config.train_bs(), epochs=self.train_config.train_epochs(), verbose=2)
         self.logger.info("Training Complete. Time Elapsed: {}s".format(time.time()-_start_time))
-        self.dataClient.publish_msg(formatted_msg=self.model.serialize_model_weights(precision=self.train_config.precision()))
+        self.dataClient.publish_msg(formatted_msg=self.model.serialize_model_weights(precision=self.train_config.precision(),
+                                                                                   wire_format=self.train_config.wire_format(),
+                                                                                   quant_mode=self.train_config.quant_mode(),
+                                                                                   delta=self.train_config.delta_updates(),
+                                                                                   delta_threshold=self.train_config.delta_threshold(),
+                                                                                   topk_ratio=self.train_config.topk_ratio(),
+                                                                                   train_stats=_train_stats(len(prepro_data), history)))
 
     def _check_cache(self):
-        if len(self.data_cache) < self.cache_sz:
+        if not self.data_cache.full():
             return
         self._validate_configs()
         self.logger.info("Data cache filled ({}), processing data ...".format(self.cache_sz))
-        thread_data = self.data_cache.copy()
-        self.data_cache = None
-        threading.Thread(target = self._process_data, args = (thread_data,)).start()
\ No newline at end of file
+        threading.Thread(target = self._process_and_release, args = (self.data_cache.take(),)).start()
\ No newline at end of file
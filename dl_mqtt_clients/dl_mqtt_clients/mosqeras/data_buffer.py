@@ -0,0 +1,80 @@
+import threading
+import numpy as np
+
+class DataBuffer():
+    """
+    Preallocated, dtype-fixed row buffer used as the mosqeras data cache.
+
+    Rows are copied into the current buffer in place (O(1) per row, no reallocation). Once it holds capacity rows, take()
+    hands the whole array to the caller and continues writing into a spare buffer, so nothing is copied when data is
+    passed to a processing thread. Buffers are recycled with release() once processed; a new one is only allocated when
+    every spare is still in use.
+
+    Args:
+        capacity (int): number of rows per buffer
+        row_shape (tuple) [Optional]: shape of a row (e.g. model input shape without the batch dimension). If None the
+                                      buffer is allocated from the shape of the first rows written
+        dtype (numpy.dtype): dtype rows are stored as
+        max_spare (int): number of released buffers kept for reuse
+    """
+    def __init__(self, capacity, row_shape=None, dtype=np.float32, max_spare=2):
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        self.max_spare = max_spare
+        self.row_shape = None
+        self._buffer = None
+        self._size = 0
+        self._spare = []
+        self._lock = threading.Lock()
+        if row_shape is not None:
+            self._allocate(tuple(row_shape))
+
+    def _allocate(self, row_shape):
+        self.row_shape = row_shape
+        self._buffer = np.empty((self.capacity,) + row_shape, dtype=self.dtype)
+
+    def __len__(self):
+        return self._size
+
+    def full(self):
+        return self._size >= self.capacity
+
+    def write(self, rows):
+        """
+        Copies as many rows as fit into the current buffer
+
+        Args:
+            rows (numpy.array): array of shape (n,) + row_shape
+        Returns:
+            n_written (int): number of rows written, less than len(rows) if the buffer filled up
+        """
+        if self.row_shape is None:
+            self._allocate(tuple(rows.shape[1:]))
+        if tuple(rows.shape[1:]) != self.row_shape:
+            raise ValueError("Data shape {} doesn't match buffer row shape {}".format(rows.shape[1:], self.row_shape))
+        n = min(len(rows), self.capacity - self._size)
+        self._buffer[self._size:self._size + n] = rows[:n]
+        self._size += n
+        return n
+
+    def take(self):
+        """
+        Returns the current buffer (trimmed to the rows written) and switches writing to a spare buffer.
+        Pass the returned array to release() once it is no longer used
+        """
+        with self._lock:
+            data = self._buffer[:self._size]
+            self._buffer = self._spare.pop() if self._spare else np.empty_like(self._buffer)
+        self._size = 0
+        return data
+
+    def release(self, data):
+        """
+        Returns a buffer obtained from take() for reuse
+        """
+        base = data if data.base is None else data.base
+        if not isinstance(base, np.ndarray) or base.shape != self._buffer.shape or base.dtype != self.dtype:
+            return
+        with self._lock:
+            if len(self._spare) < self.max_spare:
+                self._spare.append(base)
@@ -0,0 +1,154 @@
+import logging
+import threading
+import time
+from collections import deque
+import numpy as np
+
+class InferenceExecutor():
+    """
+    Long-lived worker pool fed by a bounded queue. Batches are processed by process_fn on one of the workers and the
+    results are handed to emit_fn in submission order, whatever order the workers finish in.
+
+    When the queue is full the overflow policy decides what happens to a new batch:
+        block: the submitting thread waits for space (back pressure on the MQTT callback). A batch still waiting when
+               the executor is shut down is discarded. Note that the predict client submits from the paho network thread
+               while holding its cache lock, so a blocked submit also holds up keepalives and model updates; use a drop
+               policy if a slow model must not stall the connection
+        drop_oldest: the oldest queued batch is discarded to make room
+        drop_newest: the new batch is discarded
+    Discarded batches are passed to on_drop (e.g. to recycle their buffers).
+
+    Args:
+        process_fn (function): process_fn(*args) -> result, runs on a worker thread
+        emit_fn (function): emit_fn(result), called in submission order
+        workers (int): number of worker threads
+        max_queue (int): maximum number of batches waiting for a worker
+        overflow (str): one of InferenceExecutor.overflow_policies
+        on_drop (function) [Optional]: on_drop(*args) for discarded batches
+    """
+    overflow_policies = ['block', 'drop_oldest', 'drop_newest']
+
+    def __init__(self, process_fn, emit_fn, workers=1, max_queue=4, overflow='block', on_drop=None):
+        if overflow not in self.overflow_policies:
+            raise ValueError("overflow must be one of {}".format(self.overflow_policies))
+        if workers < 1 or max_queue < 1:
+            raise ValueError("workers and max_queue must be >= 1")
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.process_fn = process_fn
+        self.emit_fn = emit_fn
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.on_drop = on_drop
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._next_seq = 0
+        self._next_emit = 0
+        self._results = {}
+        self._emit_lock = threading.Lock()
+        self._wait_times = deque(maxlen=1000)
+        self._stats = {'submitted': 0, 'processed': 0, 'dropped': 0, 'errors': 0, 'max_depth': 0}
+        self._workers = [threading.Thread(target=self._work, name='inference_{}'.format(i), daemon=True) for i in range(workers)]
+        for w in self._workers:
+            w.start()
+
+    def submit(self, *args):
+        """
+        Queues a batch. Returns False if it was discarded by the drop_newest policy or by a shutdown while blocked
+        """
+        _dropped, _rejected = None, False
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("InferenceExecutor is shut down")
+            _full = len(self._queue) >= self.max_queue
+            if _full and self.overflow == 'drop_oldest':
+                _dropped = self._queue.popleft()
+                self._stats['dropped'] += 1
+            elif _full and self.overflow == 'block':
+                while len(self._queue) >= self.max_queue and not self._stopped:
+                    self._cond.wait()
+            #the workers may have exited while waiting
+            _rejected = (_full and self.overflow == 'drop_newest') or self._stopped
+            if _rejected:
+                self._stats['dropped'] += 1
+            else:
+                self._queue.append((self._next_seq, time.monotonic(), args))
+                self._next_seq += 1
+                self._stats['submitted'] += 1
+                self._stats['max_depth'] = max(self._stats['max_depth'], len(self._queue))
+                self._cond.notify_all()
+        if _rejected:
+            self._drop(args)
+            return False
+        if _dropped is not None:
+            #the dropped batch keeps its place in the output order as an empty result
+            self._complete(_dropped[0], None)
+            self._drop(_dropped[2])
+        return True
+
+    def _drop(self, args):
+        self.logger.warning("Inference queue full ({}), dropping batch ({})".format(self.max_queue, self.overflow))
+        if self.on_drop is not None:
+            self.on_drop(*args)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopped:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                _seq, _queued, _args = self._queue.popleft()
+                self._wait_times.append(time.monotonic() - _queued)
+                self._cond.notify_all()
+            _outcome = 'processed'
+            try:
+                _result = self.process_fn(*_args)
+            except Exception as e:
+                self.logger.error("Error processing batch", exc_info=e)
+                _outcome, _result = 'errors', None
+            with self._cond:
+                self._stats[_outcome] += 1
+            self._complete(_seq, _result)
+
+    def _complete(self, seq, result):
+        """
+        Stores a result and emits every result that is next in submission order
+        """
+        with self._emit_lock:
+            self._results[seq] = result
+            while self._next_emit in self._results:
+                _result = self._results.pop(self._next_emit)
+                self._next_emit += 1
+                if _result is None:
+                    continue
+                try:
+                    self.emit_fn(_result)
+                except Exception as e:
+                    self.logger.error("Error emitting result", exc_info=e)
+
+    def depth(self):
+        return len(self._queue)
+
+    def stats(self):
+        """
+        Returns queue depth (current / max seen), batch counts and the p50 / p99 time (ms) batches waited for a worker
+        """
+        with self._cond:
+            _stats = dict(self._stats, depth=len(self._queue))
+        if self._wait_times:
+            _wait = np.array(self._wait_times) * 1000.0
+            _stats.update(wait_p50_ms=float(np.percentile(_wait, 50)), wait_p99_ms=float(np.percentile(_wait, 99)))
+        return _stats
+
+    def shutdown(self, wait=True):
+        """
+        Stops the workers once the queued batches are processed
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if wait:
+            for w in self._workers:
+                if w is not threading.current_thread():
+                    w.join()
@@ -4,12 +4,13 @@ import ssl
 import logging
 import json
 import time
+import threading
 import numpy as np
 
 from dl_mqtt_clients.microservice import microservice
-from dl_mqtt_clients.func._general_func import parse_json_field
 from dl_mqtt_clients.clients import _mosq_client
-from dl_mqtt_clients import KerasNN
+from dl_mqtt_clients.mosqeras.data_buffer import DataBuffer
+from dl_mqtt_clients.net.base import NeuralNet
 
 
 class mosqeras(microservice, metaclass=abc.ABCMeta):
@@ -19,10 +20,10 @@ class mosqeras(microservice, metaclass=abc.ABCMeta):
         logger (logger): logging module for class instance
 		    dataClient (_mosq_client, paho.mqtt.client): wrapper around mqtt client for data 
 		    configClient (_mosq_client, paho.mqtt.client): wrapper around mqtt client for config updates
-		    model (net.net): wrapped Keras model
+		    model (net.base.NeuralNet): wrapped model (KerasNN or NumpyNN)
 		    sk_scaler (sklearn.preprocessing.scaler): preprocessing module
 		    serializer (PayloadSerializer): Serializes / deserialzies data received
-		    data_cache (list, numpy): data structure that caches data, cleared once processed
+		    data_cache (DataBuffer): preallocated buffer caching cache_sz rows, handed off to processing once filled
 		
 	  Args:
 		    model (net.net): wrapped Keras model with convenience functions to run predictions on cached data
@@ -30,8 +31,11 @@ class mosqeras(microservice, metaclass=abc.ABCMeta):
 		    mqtt_config (MQTTConnectionConfig): MQTT Connection Info for the data client. See configurations.py
 		    serializer (PayloadSerializer): Payload serializer that transforms data received on the data / config client. Assumes both are same format.
 		    model_update_topic (str): topic (on the broker listened to by the config client) from which model updates will be received from the server
-		    cache_size (int): define the number of messages data to store before processing it with the model
+		    cache_size (int): define the number of data rows to store before processing it with the model
     """
+    #model input feature names, columnar data messages are stacked in this order (see set_feature_order)
+    features = None
+
     #TODO:
     def _status(self):
         self.logger.info('Client Status')
@@ -39,7 +43,7 @@ class mosqeras(microservice, metaclass=abc.ABCMeta):
     def _validate(self):
         assert(type(self.model_update_topic)==str)
         assert(len(self.model_update_topic) > 0)
-        assert(type(self.model)==KerasNN) 
+        assert(isinstance(self.model, NeuralNet))
 
     def __init__(self, model, sk_scaler, mqtt_config, serializer, model_update_topic, cache_sz = 10):
         #MQTT Configs
@@ -51,7 +55,9 @@ class mosqeras(microservice, metaclass=abc.ABCMeta):
         self.model = model                  
         self.sk_scaler = sk_scaler
         self.serializer = serializer
-        self.data_cache = None
+        self.data_cache = DataBuffer(capacity=cache_sz, row_shape=model.inputShape[1:] if model.inputShape else None)
+        #guards data_cache, message callbacks and timer driven flushes may both take it
+        self._cache_lock = threading.RLock()
         self._validate()
         self.logger.info("Created instance of Mosqeras. Cache Size: {}".format(cache_sz))
 
@@ -67,35 +73,77 @@ class mosqeras(microservice, metaclass=abc.ABCMeta):
         self.logger.debug("Message (sz: {}) received on topic: {}".format(len(msg.payload), msg.topic))
         self.logger.debug("Msg: {}".format(str(msg.payload)))
    
+        #a message holds a single row or a batch of rows, see parse_data_field
         try:
-            json_d = self.serializer.deserialize(input=msg.payload)
-        except json.decoder.JSONDecodeError:
-            self.logger.error("Error decoding payload from bytes to json, attempting json.loads()")
-      
-        try:
-            if json_d is None:
-                json_d = json.loads(msg.payload)
+            data, row_fields = self._read_rows(msg.payload)
         except json.decoder.JSONDecodeError:
             self.logger.error("Error decoding payload to json, ignoring...")
-        
-        data = parse_json_field(values=json_d["data"]) #TODO: make field configurable
-        if self.data_cache is None:
-            self.data_cache = data
-        else:
-            self.data_cache = np.append(self.data_cache, data, axis=0)
-        self._check_cache()
+            return
+        except (KeyError, TypeError, ValueError) as e:
+            self.logger.error("Error reading data field from payload, ignoring... ({})".format(e))
+            return
+        #batches larger than the space left are split over consecutive buffers
+        _written = 0
+        with self._cache_lock:
+            while _written < len(data):
+                try:
+                    _n = self.data_cache.write(data[_written:])
+                except ValueError as e:
+                    self.logger.error("{}, ignoring...".format(e))
+                    return
+                self._cache_rows_written(row_fields, _written, _n)
+                _written += _n
+                self._check_cache()
+
+    def set_feature_order(self, features):
+        """
+        Sets the names of the model's input features in order. Columnar data messages (a dict of feature name -> values)
+        are stacked in this order; those whose columns differ, and all of them while no order is set, are dropped
+
+        Args:
+            features (list): feature names
+        """
+        if self.model.inputShape and len(features) != self.model.inputShape[-1]:
+            raise ValueError("{} features given, the model takes {}".format(len(features), self.model.inputShape[-1]))
+        self.features = tuple(features)
+        self.logger.info("Feature order: {}".format(list(self.features)))
+
+    def _read_rows(self, payload):
+        """
+        Deserializes a data message into (rows, per row fields). Subclasses keeping fields alongside the rows
+        (see _cache_rows_written) override it, rows only by default
+        """
+        return self.serializer.deserialize_array(input=payload, field='data', features=self.features), None #TODO: make field configurable
+
+    def _cache_rows_written(self, row_fields, start, n):
+        """
+        Called with the data cache lock held once rows [start, start + n) of a message were written to the data cache
+        """
+        pass
 
     def _on_message_model_upd(self, client, userdata, msg):
         """
-        MQTT Message callback for when msg is received on module update topic. Model serial/deserialization occurs via JSONPickle Library 
+        MQTT Message callback for when msg is received on module update topic. Payloads are either binary weight frames
+        or JSONPickle strings, the format is detected by SerializableWeights.decode
         """
         self.logger.info("[Model Update] Message (sz: {}) received on topic: {}".format(len(msg.payload), msg.topic))
         try:
-            _weights = self.model.deserialize_json_weights(json_msg=msg.payload.decode('utf8'))
+            self.model.update_weights_from_payload(payload=msg.payload)
         except json.decoder.JSONDecodeError:
             self.logger.error("Error decoding payload from bytes to json, ignoring.. ")
             return
-        self.model.update_weights(weights=_weights)
+        except (TypeError, ValueError, IndexError) as e:
+            self.logger.error("Error decoding model update payload, ignoring.. ({})".format(e))
+            return
+
+    def _process_and_release(self, data):
+        """
+        Runs _process_data on a buffer taken from the data cache and hands the buffer back for reuse
+        """
+        try:
+            self._process_data(data)
+        finally:
+            self.data_cache.release(data)
 
     @abc.abstractmethod
     def _preprocess(self):
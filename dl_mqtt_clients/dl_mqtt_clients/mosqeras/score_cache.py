@@ -0,0 +1,78 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+
+class ScoreCache():
+    """
+    LRU cache of per-row scores keyed on the raw bytes of the feature vector. Entries belong to one model weight version,
+    looking up rows for another version clears the cache so scores of replaced weights are never returned.
+
+    Args:
+        max_size (int): number of distinct rows kept
+    """
+    def __init__(self, max_size):
+        if max_size < 1:
+            raise ValueError("max_size must be >= 1")
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def __len__(self):
+        return len(self._cache)
+
+    def lookup(self, rows, version):
+        """
+        Splits a batch into cached and unseen rows
+
+        Args:
+            rows (numpy.array): raw rows of shape (batch_size, features)
+            version: model weight version the scores must belong to
+        Returns:
+            scores (numpy.array): float32 scores, filled in for the cached rows
+            misses (OrderedDict): raw row bytes -> positions in rows, one entry per distinct unseen row
+        """
+        rows = np.ascontiguousarray(rows)
+        scores = np.empty(len(rows), dtype=np.float32)
+        misses = OrderedDict()
+        with self._lock:
+            if version != self._version:
+                if self._cache:
+                    self._stats['invalidations'] += 1
+                self._cache.clear()
+                self._version = version
+            for i, row in enumerate(rows):
+                key = row.tobytes()
+                score = self._cache.get(key)
+                if score is None:
+                    misses.setdefault(key, []).append(i)
+                else:
+                    self._cache.move_to_end(key)
+                    scores[i] = score
+            #repeats of an unseen row within the batch are not scored either
+            self._stats['hits'] += len(rows) - len(misses)
+            self._stats['misses'] += len(misses)
+        return scores, misses
+
+    def store(self, keys, scores, version):
+        """
+        Adds the scores of rows returned as misses by lookup, unless the weights changed in the meantime
+        """
+        with self._lock:
+            if version != self._version:
+                return
+            for key, score in zip(keys, scores):
+                self._cache[key] = float(score)
+                self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def stats(self):
+        """
+        Returns hit / miss counts, the hit rate (rows not sent to the model), invalidations and the number of entries
+        """
+        _stats = dict(self._stats, size=len(self._cache))
+        _total = _stats['hits'] + _stats['misses']
+        _stats['hit_rate'] = _stats['hits'] / _total if _total else 0.0
+        return _stats
@@ -0,0 +1,179 @@
+import abc
+import threading
+from collections import OrderedDict
+from dl_mqtt_clients.func._nn_func import is_weight_list_same_dim, delta_keras_weights, topk_sparsify, apply_keras_weights_delta, apply_sparse_delta
+from dl_mqtt_clients.net.weights import SerializableWeights
+
+class NeuralNet(metaclass=abc.ABCMeta):
+    """
+    Base class of the model backends. Implements syncing to the global model published by the aggregator and
+    serializing the local weights on top of get_weights / update_weights, so it does not depend on a framework
+    """
+    #global model (as published by the aggregator) the current weights were last synced to
+    global_session = None
+    global_version = None
+    _global_weights = None
+    #part of the local update not sent yet by top-k sparsified updates (error feedback) and the (session, version)
+    #of the global model it was computed against
+    _sparse_residual = None
+    _sparse_residual_base = None
+    #bumped whenever the weights change through this class; serialized payloads are memoized per weight version
+    weight_version = 0
+    payload_cache_size = 4
+    _payload_cache = None
+
+    def __init__(self):
+        self._payload_cache = OrderedDict()
+        self._payload_lock = threading.Lock()
+
+    @property
+    def model(self):
+        """Neural Network Model, typically of shape (batch_size, dimension1, dimensions2, etc.)"""
+        pass
+    @property
+    def logger(self):
+        pass
+    @property
+    def inputShape(self):
+        pass
+    def outputShape(self):
+        pass
+
+    @abc.abstractmethod
+    def load_model(self):
+        pass
+    @abc.abstractmethod
+    def predict(self, data):
+        pass
+    @abc.abstractmethod
+    def get_weights(self):
+        """Returns the weights as a list of numpy arrays, in Keras get_weights order"""
+        pass
+    @abc.abstractmethod
+    def update_weights(self, weights, session=None, version=None):
+        """Sets the weights, returns True on success. session / version identify the global model the weights belong to, if any"""
+        pass
+
+    def _bump_weight_version(self):
+        """
+        Marks the weights as changed, invalidating memoized payloads. Call it after changing the model weights directly
+        """
+        self.weight_version += 1
+        with self._payload_lock:
+            self._payload_cache.clear()
+
+    def _set_global_weights(self, weights, session, version):
+        if version is None:
+            self.global_session, self.global_version, self._global_weights = None, None, None
+            return
+        self.global_session, self.global_version, self._global_weights = session, version, weights
+        self.logger.info("Synced to global model version {} (session {})".format(version, session))
+
+    def update_weights_from_payload(self, payload):
+        """
+        Decodes a global model payload published by the aggregator and applies it.
+        Delta / sparse payloads are applied to the global model they reference; if that is not the global model this
+        instance holds (e.g. a message was missed or the node just started) the payload is ignored until the next keyframe
+
+        Args:
+            payload (bytes / str): binary weight frame or jsonpickle payload
+        Returns:
+            bool: True if the weights were updated
+        """
+        serialW = SerializableWeights.decode(payload)
+        if serialW.encoding == 'full':
+            return self.update_weights(weights=serialW.inflate(), session=serialW.session, version=serialW.version)
+        if self._global_weights is None or serialW.base_session != self.global_session or serialW.base_version != self.global_version:
+            self.logger.warning("Global model delta against version {} (session {}) does not match local version {} (session {}), waiting for keyframe".format(
+                serialW.base_version, serialW.base_session, self.global_version, self.global_session))
+            return False
+        if serialW.encoding == 'sparse':
+            _weights = apply_sparse_delta(self._global_weights, serialW.indices, serialW.inflate())
+        else:
+            _weights = apply_keras_weights_delta(self._global_weights, serialW.inflate())
+        return self.update_weights(weights=_weights, session=serialW.session, version=serialW.version)
+
+    def serialize_model_weights(self, precision, wire_format='binary', quant_mode='global', delta=False, delta_threshold=0.0, topk_ratio=None,
+                                train_stats=None):
+        """
+        Serializes the current model weights. Full and delta payloads are memoized per weight version and
+        parameters (LRU of payload_cache_size entries) so repeated publishes reuse one encode; top-k payloads carry
+        the error feedback residual and are always rebuilt
+
+        Args:
+            precision (int): compression precision
+            wire_format (str): one of SerializableWeights.wire_formats
+            quant_mode (str): one of SerializableWeights.quant_modes
+            delta (bool): if a global model has been received, send only the difference to it
+            delta_threshold (float): layers whose largest absolute change is <= delta_threshold are not sent
+            topk_ratio (float) [Optional]: if a global model has been received, send only this fraction of the largest
+                                           magnitude changes. The rest is carried over to the next call (error feedback)
+            train_stats (dict) [Optional]: num_samples, epochs and loss of the local training, see SerializableWeights.set_train_stats
+        Returns:
+            payload (bytes / str)
+        """
+        if topk_ratio is not None and self._global_weights is not None:
+            serialW = self._sparsify_weights(self.get_weights(), precision=precision, quant_mode=quant_mode, ratio=topk_ratio)
+            if train_stats:
+                serialW.set_train_stats(**train_stats)
+            return serialW.encode(wire_format=wire_format)
+        delta = delta and self._global_weights is not None
+        key = (self.weight_version, precision, wire_format, quant_mode, delta, delta_threshold if delta else None,
+               tuple(sorted(train_stats.items())) if train_stats else None)
+        with self._payload_lock:
+            if key in self._payload_cache:
+                self._payload_cache.move_to_end(key)
+                return self._payload_cache[key]
+        _weights = self.get_weights()
+        if delta:
+            serialW = SerializableWeights.from_keras_weights(keras_weights=delta_keras_weights(_weights, self._global_weights, threshold=delta_threshold),
+                                                             precision=precision, quant_mode=quant_mode)
+            serialW.set_delta_base(base_session=self.global_session, base_version=self.global_version)
+        else:
+            serialW = SerializableWeights.from_keras_weights(keras_weights=_weights, precision=precision, quant_mode=quant_mode)
+            if self.global_version is not None:
+                #lets the aggregator tell how stale the update is
+                serialW.base_session, serialW.base_version = self.global_session, self.global_version
+        if train_stats:
+            serialW.set_train_stats(**train_stats)
+        payload = serialW.encode(wire_format=wire_format)
+        with self._payload_lock:
+            #the weights may have changed while encoding, only keep the payload if the version still matches
+            if key[0] == self.weight_version:
+                self._payload_cache[key] = payload
+                while len(self._payload_cache) > self.payload_cache_size:
+                    self._payload_cache.popitem(last=False)
+        return payload
+
+    def _sparsify_weights(self, weights, precision, quant_mode, ratio):
+        """
+        Builds a sparse update holding the top ratio changes since the last global model. The residual left by the
+        last update sent against an older global model is added; against the same global model the difference already
+        holds the entries that were not sent, so the residual is dropped
+        """
+        _update = delta_keras_weights(weights, self._global_weights, keep_all=True)
+        _base = (self.global_session, self.global_version)
+        if (self._sparse_residual is not None and self._sparse_residual_base != _base
+                and is_weight_list_same_dim(self._sparse_residual, _update)):
+            for layer, residual in zip(_update, self._sparse_residual):
+                layer += residual
+        _values, _indices, _residual = topk_sparsify(_update, ratio)
+        serialW = SerializableWeights.from_keras_weights(keras_weights=_values, precision=precision, quant_mode=quant_mode)
+        serialW.set_delta_base(base_session=self.global_session, base_version=self.global_version, indices=_indices)
+        if precision != 32:
+            #quantization error is fed back as well
+            for residual, index, value, sent in zip(_residual, _indices, _values, serialW.inflate()):
+                if index is not None:
+                    residual.reshape(-1)[index] += value - sent
+        self._sparse_residual = _residual
+        self._sparse_residual_base = _base
+        return serialW
+
+    def deserialize_weights(self, payload):
+        """
+        Decodes a weight payload (binary frame or jsonpickle str/bytes) into a list of float32 numpy arrays
+        """
+        return SerializableWeights.decode(payload).inflate()
+
+    def deserialize_json_weights(self, json_msg):
+        return self.deserialize_weights(payload=json_msg)
@@ -3,14 +3,13 @@ import tensorflow as tf
 import numpy as np
 import logging
 import threading
+import time
 import sys
-import abc
-from dl_mqtt_clients.func._nn_func import getMinMaxVals, compress_keras_weights, inflate_keras_weights, is_weight_list_same_dim
-import logging
-
-import jsonpickle
-import jsonpickle.ext.numpy as jsonpickle_numpy
-jsonpickle_numpy.register_handlers()
+from dl_mqtt_clients.func._nn_func import is_weight_list_same_dim
+from dl_mqtt_clients.func._ad_ae_func import reconstr_error
+from dl_mqtt_clients.net.weights import SerializableWeights
+from dl_mqtt_clients.net.base import NeuralNet
+from dl_mqtt_clients.net.quantized import Reservoir, Int8Model
 
 def print_keras_model_summary(model):
     model.summary()
@@ -18,50 +17,6 @@ def print_keras_model_summary(model):
     print("Outputs: {}".format(model.output_shape))
     return
 
-class SerializableWeights():
-    def __init__(self, keras_weights, precision, minV, maxV):
-        self.weights = keras_weights
-        self.precision = precision
-        self.minV = minV
-        self.maxV = maxV
-        self._validate()
-
-    def _validate(self):
-        if type(self.weights) != list:
-            raise TypeError("Weights type not valid")
-        if type(self.precision)!=int:
-            raise TypeError("Precision type not valid")
-        if type(self.minV)!= (np.float32 or float):
-            raise TypeError("min type not valid")
-        if type(self.maxV)!= (np.float32 or float):
-            raise TypeError("max type not valid")
-        return True
-
-class NeuralNet(metaclass=abc.ABCMeta):
-    def __init__(self):
-        pass
-
-    @property
-    def model(self):
-        """Neural Network Model, typically of shape (batch_size, dimension1, dimensions2, etc.)"""
-        pass
-    @property
-    def logger(self):
-        pass
-    @property
-    def inputShape(self):
-        pass
-    def outputShape(self):
-        pass
-
-    @abc.abstractmethod
-    def load_model(self):
-        pass
-    @abc.abstractmethod
-    def predict(self, data):
-        pass
-
-
 class KerasNN(NeuralNet):
     model = None
     logger = logging.getLogger(__name__)
@@ -69,81 +24,192 @@ class KerasNN(NeuralNet):
     outputShape = None
     _callbacks_list = []
     lock = None
+    #batches up to this many rows run through compiled tf.functions instead of Model.predict
+    fast_path_max_batch = 1024
+    _predict_fn = None
+    _error_fn = None
+    #int8 inference copy, rebuilt in the background on weight changes (see enable_int8_inference)
+    _int8 = None
+    _int8_reservoir = None
+    _int8_threads = 1
+    _int8_building = False
+    _int8_dirty = False
+    _int8_failed_version = None
+    #guards the int8 copy and its build state
+    _int8_lock = None
 
     def __init__(self):
+        super().__init__()
         self.lock = threading.Lock()
 		
 	
     def load_model(self, hdf5_filename):
         try: 
             self.model = keras.models.load_model(hdf5_filename)
+            self._bump_weight_version()
             self.inputShape, self.outputShape = self.model.input_shape, self.model.output_shape
             self.logger.info('Input Shape: {}, Output Shape: {}'.format(self.inputShape, self.outputShape))
             self.logger.info('Loaded model from disk')
             self.model.make_predict_function()
+            self._predict_fn, self._error_fn = None, None
         except OSError:
             self.logger.error('Cannot load file: {}'.format(hdf5_filename))
             sys.exit(1)
 
-    def update_weights(self, weights):
+    def get_weights(self):
+        return self.model.get_weights()
+
+    def enable_int8_inference(self, calibration_size=256, num_threads=1):
+        """
+        Scores through an int8 post-training quantized copy of the model. Rows passed to predict / reconstruction_error
+        are sampled into a calibration reservoir; once it is full, and after every weight change, the quantized copy is
+        rebuilt on a background thread. Until it is ready the float model is used, it also remains the one trained,
+        serialized and updated
+
+        Args:
+            calibration_size (int): number of recent (preprocessed) input rows the quantization ranges are calibrated on
+            num_threads (int): interpreter threads per call
+        """
+        #recent rows are favoured: the sample covers roughly the last 4 * calibration_size rows
+        self._int8_reservoir = Reservoir(capacity=calibration_size, window=4 * calibration_size)
+        self._int8_threads = num_threads
+        self._int8_lock = threading.Lock()
+        with self._int8_lock:
+            self._int8 = None
+        self.logger.info("Int8 inference enabled, calibrating on {} rows".format(calibration_size))
+
+    def _bump_weight_version(self):
+        super()._bump_weight_version()
+        if self._int8_reservoir is not None:
+            #the quantized copy no longer matches the float weights
+            with self._int8_lock:
+                self._int8 = None
+            self._schedule_int8_build()
+
+    def _schedule_int8_build(self):
+        with self._int8_lock:
+            if len(self._int8_reservoir) < self._int8_reservoir.capacity or self._int8_failed_version == self.weight_version:
+                return
+            if self._int8_building:
+                #rerun once the current build is done
+                self._int8_dirty = True
+                return
+            self._int8_building = True
+        threading.Thread(target=self._build_int8, name='int8_build', daemon=True).start()
+
+    def _build_int8(self):
+        while True:
+            _version, _weights = self.weight_version, self.get_weights()
+            _start_time = time.time()
+            try:
+                _int8 = Int8Model.from_keras_model(self.model, _weights, self._int8_reservoir.sample(), num_threads=self._int8_threads)
+                with self._int8_lock:
+                    if _version == self.weight_version:
+                        self._int8 = _int8
+                self.logger.info("Int8 model built for weight version {} in {:.2f} seconds".format(_version, time.time()-_start_time))
+            except Exception as e:
+                with self._int8_lock:
+                    self._int8_failed_version = _version
+                self.logger.error("Int8 conversion failed, scoring with the float model", exc_info=e)
+            with self._int8_lock:
+                if not self._int8_dirty:
+                    self._int8_building = False
+                    return
+                self._int8_dirty = False
+
+    def _int8_model(self, data):
+        """
+        Samples data into the calibration reservoir and returns the int8 model to score it with, None for the float model
+        """
+        if self._int8_reservoir is None:
+            return None
+        self._int8_reservoir.add(data)
+        _int8 = self._int8
+        if _int8 is None and not self._int8_building:
+            self._schedule_int8_build()
+        return _int8
+
+    def update_weights(self, weights, session=None, version=None):
+        """
+        Sets the model weights. session / version identify the global model the weights belong to, if any
+        """
         self.logger.info("Starting to update weights!")
         if is_weight_list_same_dim(self.model.get_weights(), weights):	
             try:
                 self.model.set_weights(weights)	
+                self._set_global_weights(weights, session, version)
+                self._bump_weight_version()
                 return True
             except Exception as e:
                 self.logger.info(e)
             try:
                 self.model.set_weights(weights[0])	
+                self._set_global_weights(weights[0], session, version)
+                self._bump_weight_version()
                 return True
             except Exception as e:
                 self.logger.info(e)
         else:
             self.logger.error("On updating weights: dimensions do not match")
             return False
-		
+
     def set_model(self, keras_model):
         self.model = keras_model
+        self._bump_weight_version()
         self.inputShape, self.outputShape = self.model.input_shape, self.model.output_shape
         self.logger.info('Input Shape: {}, Output Shape: {}'.format(self.inputShape, self.outputShape))
         self.model.make_predict_function()
+        self._predict_fn, self._error_fn = None, None
+
+    def _build_fast_path(self):
+        """
+        Traces the forward pass and the reconstruction error once for a fixed (None, features) float32 signature.
+        The functions read the model variables, so weight updates do not require retracing
+        """
+        _signature = [tf.TensorSpec(shape=(None,) + tuple(self.inputShape[1:]), dtype=tf.float32)]
+        model = self.model
+        @tf.function(input_signature=_signature)
+        def _predict(x):
+            return model(x, training=False)
+        @tf.function(input_signature=_signature)
+        def _error(x):
+            _diff = tf.reshape(model(x, training=False) - x, (tf.shape(x)[0], -1))
+            return tf.norm(_diff, axis=1)
+        self._predict_fn, self._error_fn = _predict, _error
+
+    def _use_fast_path(self, data):
+        if len(data) > self.fast_path_max_batch:
+            return False
+        if self._predict_fn is None:
+            self._build_fast_path()
+        return True
 
-    def serialize_model_weights(self, precision):		
-        _min, _max = getMinMaxVals(self.model.get_weights())
-        if precision != 32:
-            _weights = compress_keras_weights(keras_weights=self.model.get_weights(), precision=precision, minW=_min, maxW=_max)
-        else:
-           _weights = []
-           for layer in self.model.get_weights():
-               _weights.append(np.copy(layer).astype('float32'))
-        serialW = SerializableWeights(keras_weights=_weights, precision=precision, minV=_min, maxV=_max)
-        encoded = jsonpickle.encode(serialW)
-        return encoded
-	
-    def deserialize_json_weights(self, json_msg):
-        _serialW = jsonpickle.decode(json_msg)
-        if not isinstance(_serialW, SerializableWeights):
-            raise TypeError("Deserialized object is not of instance Serializable Weights: {}".format(type(_serialW)))
-        try:
-            _serialW._validate()
-        except AssertionError:
-            raise TypeError("Error validating deserialized weight types")
-        if _serialW.precision != 32:
-            _infaltedW = inflate_keras_weights(keras_weights=_serialW.weights, minV=_serialW.minV, maxV=_serialW.maxV, base_precision=_serialW.precision)
-            return _infaltedW
-        else:
-            normalized_weights = []
-            for layer in _serialW.weights:
-                normalized_weights.append(np.copy(layer).astype('float32'))
-            return normalized_weights
-		
     def predict(self, data):
         if not data.shape[1:]==self.inputShape[1:]:
             raise ValueError("Data shape doesn't match networks expected input shape: {}, {}".format(data.shape[1:], self.inputShape[1:]))
-        self.lock.acquire()
-        results = self.model.predict(data, batch_size=32)
-        self.lock.release()
-        return results
+        _int8 = self._int8_model(data)
+        if _int8 is not None:
+            return _int8.predict(data)
+        with self.lock:
+            if self._use_fast_path(data):
+                return self._predict_fn(np.asarray(data, dtype=np.float32)).numpy()
+            return self.model.predict(data, batch_size=32)
+
+    def reconstruction_error(self, data):
+        """
+        Returns the L2 norm of (model(data) - data) per row, for autoencoders. Small batches compute it inside the
+        compiled graph so only one value per row is copied out of TensorFlow
+        """
+        if not data.shape[1:]==self.inputShape[1:]:
+            raise ValueError("Data shape doesn't match networks expected input shape: {}, {}".format(data.shape[1:], self.inputShape[1:]))
+        _int8 = self._int8_model(data)
+        if _int8 is not None:
+            return reconstr_error(_int8.predict(data), data)
+        with self.lock:
+            if self._use_fast_path(data):
+                return self._error_fn(np.asarray(data, dtype=np.float32)).numpy()
+            results = self.model.predict(data, batch_size=32)
+        return reconstr_error(results, data)
 	
     def setup_train(self, 
                     early_stopping, 
@@ -169,9 +235,12 @@ class KerasNN(NeuralNet):
         if not labels.shape[1:]==self.outputShape[1:]:
             raise ValueError("Data shape doesn't match networks expected input shape: {}, {}".format(labels.shape[1:], self.outputShape[1:]))
         self.lock.acquire()
-        self.logger.info(self.model.fit(train_data, labels, batch_size=batch_size, epochs=epochs, verbose=verbose, callbacks=self._callbacks_list))
+        history = self.model.fit(train_data, labels, batch_size=batch_size, epochs=epochs, verbose=verbose, callbacks=self._callbacks_list)
+        self.logger.info(history)
+        self._bump_weight_version()
         self.logger.info('Done fitting model to data')
         self.lock.release()
+        return history
         
     def save_model(self, filePath):
         self.model.save(f"{filePath}/model.h5")
@@ -0,0 +1,141 @@
+import numpy as np
+import logging
+import json
+import sys
+from dl_mqtt_clients.func._nn_func import is_weight_list_same_dim
+from dl_mqtt_clients.net.base import NeuralNet
+
+def _sigmoid(x):
+    #tanh form, does not overflow for large negative inputs
+    np.multiply(x, 0.5, out=x)
+    np.tanh(x, out=x)
+    x += 1.0
+    np.multiply(x, 0.5, out=x)
+    return x
+
+def _relu(x):
+    return np.maximum(x, 0.0, out=x)
+
+def _tanh(x):
+    return np.tanh(x, out=x)
+
+def _softmax(x):
+    x -= x.max(axis=-1, keepdims=True)
+    np.exp(x, out=x)
+    x /= x.sum(axis=-1, keepdims=True)
+    return x
+
+def _elu(x):
+    return np.where(x > 0, x, np.expm1(np.minimum(x, 0.0))).astype(x.dtype, copy=False)
+
+def _softplus(x):
+    return np.logaddexp(x, 0.0).astype(x.dtype, copy=False)
+
+_ACTIVATIONS = {'linear': lambda x: x, 'relu': _relu, 'sigmoid': _sigmoid, 'tanh': _tanh, 'softmax': _softmax, 'elu': _elu, 'softplus': _softplus}
+#layers without weights that are the identity at inference time
+_PASSTHROUGH_LAYERS = ['InputLayer', 'Dropout', 'GaussianNoise', 'GaussianDropout', 'ActivityRegularization']
+
+def _attr_str(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+class NumpyNN(NeuralNet):
+    """
+    TensorFlow-free inference backend for stacks of Dense layers (e.g. the BETH autoencoder), reading the architecture
+    and weights from a Keras h5 file with h5py. The forward pass is one matmul + bias + activation per layer on float32
+    arrays, so predict nodes do not need to import TensorFlow.
+
+    Weights are exchanged in Keras get_weights order (kernel, bias per layer), so it accepts the same updates as
+    KerasNN. Training is not supported.
+    """
+    model = None
+    logger = logging.getLogger(__name__)
+    inputShape = None
+    outputShape = None
+    #(activation name, use_bias) per Dense layer
+    _layer_spec = None
+    #(kernel, bias, activation function) per Dense layer, replaced as a whole on weight updates
+    _layers = None
+
+    def load_model(self, hdf5_filename):
+        try:
+            import h5py
+            with h5py.File(hdf5_filename, 'r') as f:
+                config = json.loads(_attr_str(f.attrs['model_config']))
+                group = f['model_weights'] if 'model_weights' in f else f
+                spec, weights = [], []
+                for layer in config['config']['layers']:
+                    if layer['class_name'] in _PASSTHROUGH_LAYERS:
+                        continue
+                    if layer['class_name'] != 'Dense':
+                        raise ValueError("Layer type not supported by NumpyNN: {}".format(layer['class_name']))
+                    activation = layer['config'].get('activation', 'linear')
+                    if activation not in _ACTIVATIONS:
+                        raise ValueError("Activation not supported by NumpyNN: {}".format(activation))
+                    layer_group = group[layer['config']['name']]
+                    weight_names = [_attr_str(n) for n in layer_group.attrs['weight_names']]
+                    spec.append((activation, len(weight_names) > 1))
+                    weights.extend(np.asarray(layer_group[n], dtype=np.float32) for n in weight_names)
+        except (OSError, KeyError) as e:
+            self.logger.error('Cannot load file: {} ({})'.format(hdf5_filename, e))
+            sys.exit(1)
+        if not spec:
+            raise ValueError("No Dense layers found in {}".format(hdf5_filename))
+        self._layer_spec = spec
+        self._layers = self._build_layers(weights)
+        self._bump_weight_version()
+        self.inputShape, self.outputShape = (None, self._layers[0][0].shape[0]), (None, self._layers[-1][0].shape[1])
+        self.logger.info('Input Shape: {}, Output Shape: {}'.format(self.inputShape, self.outputShape))
+        self.logger.info('Loaded model from disk')
+
+    def _build_layers(self, weights):
+        layers, i = [], 0
+        for activation, use_bias in self._layer_spec:
+            kernel = np.ascontiguousarray(weights[i], dtype=np.float32)
+            bias = np.asarray(weights[i + 1], dtype=np.float32) if use_bias else None
+            i += 2 if use_bias else 1
+            layers.append((kernel, bias, _ACTIVATIONS[activation]))
+        return layers
+
+    def get_weights(self):
+        weights = []
+        for kernel, bias, _ in self._layers:
+            weights.append(kernel.copy())
+            if bias is not None:
+                weights.append(bias.copy())
+        return weights
+
+    def update_weights(self, weights, session=None, version=None):
+        """
+        Sets the model weights. session / version identify the global model the weights belong to, if any
+        """
+        self.logger.info("Starting to update weights!")
+        if not is_weight_list_same_dim(self.get_weights(), weights):
+            self.logger.error("On updating weights: dimensions do not match")
+            return False
+        #predictions running concurrently keep using the previous layer list
+        self._layers = self._build_layers(weights)
+        self._set_global_weights(weights, session, version)
+        self._bump_weight_version()
+        return True
+
+    def _forward(self, data):
+        x = np.asarray(data, dtype=np.float32)
+        for kernel, bias, activation in self._layers:
+            x = x @ kernel
+            if bias is not None:
+                x += bias
+            x = activation(x)
+        return x
+
+    def predict(self, data):
+        if not data.shape[1:]==self.inputShape[1:]:
+            raise ValueError("Data shape doesn't match networks expected input shape: {}, {}".format(data.shape[1:], self.inputShape[1:]))
+        return self._forward(data)
+
+    def reconstruction_error(self, data):
+        """
+        Returns the L2 norm of (model(data) - data) per row, for autoencoders
+        """
+        results = self.predict(data)
+        results -= data
+        return np.linalg.norm(results.reshape(len(data), -1), axis=1)
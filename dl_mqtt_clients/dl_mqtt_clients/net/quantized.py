@@ -0,0 +1,105 @@
+import numpy as np
+import logging
+import threading
+
+class Reservoir():
+    """
+    Fixed size uniform sample of the rows seen so far (reservoir sampling, algorithm R), used to calibrate quantized models.
+    With window set, the row count used for the replacement probability stops growing at window, so each new row
+    replaces a slot with probability capacity / window and the sample follows recent data instead of all history
+
+    Args:
+        capacity (int): number of rows kept
+        window (int) [Optional]: approximate number of recent rows the sample is drawn from
+    """
+    def __init__(self, capacity, window=None):
+        if capacity < 1:
+            raise ValueError("capacity must be >= 1")
+        if window is not None and window < capacity:
+            raise ValueError("window must be >= capacity")
+        self.capacity = capacity
+        self.window = window
+        self.seen = 0
+        self._rows = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.seen, self.capacity)
+
+    def add(self, rows):
+        """
+        Offers a batch of rows, each row seen so far is kept with probability capacity / min(seen, window)
+        """
+        rows = np.asarray(rows, dtype=np.float32)
+        with self._lock:
+            if self._rows is None or self._rows.shape[1:] != rows.shape[1:]:
+                self._rows, self.seen = np.empty((self.capacity,) + rows.shape[1:], dtype=np.float32), 0
+            _pos = np.arange(self.seen, self.seen + len(rows))
+            if self.window is not None:
+                _pos = np.minimum(_pos, self.window - 1)
+            #rows still filling the reservoir go to their own slot, later ones replace a random slot (or are skipped)
+            _slots = np.where(_pos < self.capacity, _pos, np.random.randint(0, _pos + 1))
+            _keep = _slots < self.capacity
+            self._rows[_slots[_keep]] = rows[_keep]
+            self.seen += len(rows)
+
+    def sample(self):
+        with self._lock:
+            return None if self._rows is None else self._rows[:len(self)].copy()
+
+def _load_interpreter_class():
+    #LiteRT replaces tf.lite.Interpreter in recent TensorFlow releases, use it when installed
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+    return Interpreter
+
+class Int8Model():
+    """
+    Int8 post-training quantized copy of a Keras model, run with the TFLite interpreter. Inputs and outputs stay float32,
+    the interpreter is resized only when the batch size changes and calls are serialized (interpreters are not thread safe)
+
+    Args:
+        tflite_model (bytes): converted model
+        num_threads (int): interpreter threads
+    """
+    def __init__(self, tflite_model, num_threads=1):
+        self.logger = logging.getLogger(__name__)
+        self._interpreter = _load_interpreter_class()(model_content=tflite_model, num_threads=num_threads)
+        self._input = self._interpreter.get_input_details()[0]
+        self._output = self._interpreter.get_output_details()[0]
+        self._batch_size = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_keras_model(cls, model, weights, calibration, num_threads=1, calibration_batches=16):
+        """
+        Quantizes a copy of model holding weights, so the source model may keep changing during the conversion
+
+        Args:
+            model (keras.Model): float model
+            weights (list): weights to quantize, in get_weights order
+            calibration (numpy.array): representative (preprocessed) input rows
+        """
+        import tensorflow as tf
+        _model = tf.keras.models.clone_model(model)
+        _model.set_weights(weights)
+        converter = tf.lite.TFLiteConverter.from_keras_model(_model)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        _batches = np.array_split(calibration, min(calibration_batches, len(calibration)))
+        converter.representative_dataset = lambda: ([b] for b in _batches)
+        return cls(converter.convert(), num_threads=num_threads)
+
+    def predict(self, data):
+        data = np.asarray(data, dtype=np.float32)
+        with self._lock:
+            if self._batch_size != len(data):
+                self._interpreter.resize_tensor_input(self._input['index'], (len(data),) + data.shape[1:])
+                self._interpreter.allocate_tensors()
+                self._batch_size = len(data)
+            self._interpreter.set_tensor(self._input['index'], data)
+            self._interpreter.invoke()
+            return self._interpreter.get_tensor(self._output['index'])
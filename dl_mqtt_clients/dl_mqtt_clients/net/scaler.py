@@ -0,0 +1,68 @@
+import numpy as np
+import argparse
+
+class AffineScaler():
+    """
+    Feature scaling reduced to data * scale + offset, the form both sklearn MinMaxScaler and StandardScaler take once
+    fitted. Transforms are one vectorized float32 multiply-add, optionally in place, and loading the exported .npz file
+    does not import sklearn.
+
+    Args:
+        scale (numpy.array): per feature scale
+        offset (numpy.array): per feature offset
+    """
+    def __init__(self, scale, offset):
+        self.scale = np.asarray(scale, dtype=np.float32)
+        self.offset = np.asarray(offset, dtype=np.float32)
+        if self.scale.shape != self.offset.shape:
+            raise ValueError("scale and offset shapes do not match: {}, {}".format(self.scale.shape, self.offset.shape))
+
+    @classmethod
+    def from_sklearn(cls, scaler):
+        """
+        Converts a fitted sklearn MinMaxScaler or StandardScaler
+        """
+        if hasattr(scaler, 'min_') and hasattr(scaler, 'scale_'):
+            return cls(scale=scaler.scale_, offset=scaler.min_)
+        if hasattr(scaler, 'mean_') or hasattr(scaler, 'var_'):
+            n_features = scaler.n_features_in_
+            #mean_ is set even when with_mean is off
+            scale = 1.0 / scaler.scale_ if getattr(scaler, 'with_std', True) and scaler.scale_ is not None else np.ones(n_features)
+            offset = -scaler.mean_ * scale if getattr(scaler, 'with_mean', True) and scaler.mean_ is not None else np.zeros(n_features)
+            return cls(scale=scale, offset=offset)
+        raise ValueError("Unsupported scaler type: {}".format(type(scaler).__name__))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(scale=f['scale'], offset=f['offset'])
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f, scale=self.scale, offset=self.offset)
+
+    def transform(self, data, copy=True):
+        """
+        Scales data of shape (batch_size, features). With copy=False a float32 array is scaled in place
+        """
+        if copy or not isinstance(data, np.ndarray) or data.dtype != np.float32:
+            data = np.array(data, dtype=np.float32)
+        np.multiply(data, self.scale, out=data)
+        data += self.offset
+        return data
+
+def export_scaler(scaler_path, output_path):
+    """
+    Writes the scale / offset of a pickled (joblib) sklearn scaler to an .npz file that AffineScaler.load reads
+    """
+    from dl_mqtt_clients.func._nn_func import load_sklearn_scaler
+    scaler = AffineScaler.from_sklearn(load_sklearn_scaler(scaler_path))
+    scaler.save(output_path)
+    return scaler
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a fitted sklearn scaler as an affine scale / offset .npz file')
+    parser.add_argument('scaler_path', type=str, help='pickled sklearn MinMaxScaler or StandardScaler')
+    parser.add_argument('output_path', type=str, help='.npz file to write')
+    args = parser.parse_args()
+    export_scaler(args.scaler_path, args.output_path)
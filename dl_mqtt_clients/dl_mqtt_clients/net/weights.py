@@ -0,0 +1,216 @@
+import numpy as np
+from dl_mqtt_clients.func._nn_func import getMinMaxVals, compress_keras_weights, compress_keras_weights_scaled, inflate_keras_weights
+from dl_mqtt_clients.func._serializer_func import is_weight_frame, encode_weight_frame, decode_weight_frame
+
+import jsonpickle
+import jsonpickle.ext.numpy as jsonpickle_numpy
+jsonpickle_numpy.register_handlers()
+
+def _scatter_layers(layers, index, n):
+    """Places layers at positions index of a list of length n, the other entries are None"""
+    out = [None] * n
+    for i, layer in zip(index, layers):
+        out[i] = layer
+    return out
+
+class SerializableWeights():
+    """
+    Container for (optionally compressed) Keras weights sent over MQTT
+
+    Two wire formats are supported: 'binary' (see encode_weight_frame) and 'jsonpickle' (legacy).
+    Receivers detect the format from the payload itself, so peers can be moved over one at a time.
+
+    Compressed weights are quantized against either the global minV/maxV ('global') or a scale and zero point
+    stored per layer ('layer') or per output channel ('channel') in scales / zero_points.
+    Precisions below 8 bits are bit packed, the original layer shapes are kept in shapes.
+
+    Published global models are tagged with the (session, version) of the aggregator that produced them.
+    A 'delta' encoding carries the difference to the global model identified by (base_session, base_version);
+    layers set to None were not sent and are taken from the base unchanged. A 'sparse' encoding is a delta where each
+    layer only carries the values at the flat positions listed in indices. Full training updates may carry the
+    (base_session, base_version) of the global model they were trained from as well.
+
+    Training updates may carry the number of samples, epochs and final loss of the local training (see set_train_stats),
+    the aggregator weights and tracks the merge with them.
+    """
+    wire_formats = ['binary', 'jsonpickle']
+    quant_modes = ['global', 'layer', 'channel']
+    encodings = ['full', 'delta', 'sparse']
+    #class level defaults so payloads from peers that predate these fields still decode
+    quant_mode = 'global'
+    scales = None
+    zero_points = None
+    shapes = None
+    encoding = 'full'
+    session = None
+    version = None
+    base_session = None
+    base_version = None
+    indices = None
+    num_samples = None
+    epochs = None
+    loss = None
+
+    def __init__(self, keras_weights, precision, minV, maxV, quant_mode='global', scales=None, zero_points=None, shapes=None):
+        self.weights = keras_weights
+        self.precision = precision
+        self.minV = minV
+        self.maxV = maxV
+        self.quant_mode = quant_mode
+        self.scales = scales
+        self.zero_points = zero_points
+        self.shapes = shapes
+        self._validate()
+
+    @classmethod
+    def from_keras_weights(cls, keras_weights, precision, quant_mode='global'):
+        """
+        Compresses float weights (e.g. from model.get_weights()) to the given precision
+
+        Args:
+            keras_weights (list): list of numpy arrays
+            precision (int): target precision, 32 leaves the weights uncompressed
+            quant_mode (str): one of SerializableWeights.quant_modes
+        Returns:
+            serialW (SerializableWeights)
+        """
+        #None entries (layers that are not sent) are skipped and kept as None in every per layer list
+        _index = [i for i, layer in enumerate(keras_weights) if layer is not None]
+        _layers = [keras_weights[i] for i in _index]
+        _n = len(keras_weights)
+        _min, _max = getMinMaxVals(_layers) if _layers else (0.0, 0.0)
+        _min, _max = np.float32(_min), np.float32(_max)
+        if precision == 32:
+            _weights = [None if layer is None else np.asarray(layer, dtype=np.float32) for layer in keras_weights]
+            return cls(keras_weights=_weights, precision=precision, minV=_min, maxV=_max)
+        _shapes = _scatter_layers([list(np.shape(layer)) for layer in _layers], _index, _n) if precision < 8 else None
+        if not _layers:
+            return cls(keras_weights=[None] * _n, precision=precision, minV=_min, maxV=_max, quant_mode=quant_mode,
+                       scales=[None] * _n, zero_points=[None] * _n, shapes=_shapes)
+        if quant_mode == 'global':
+            _weights = compress_keras_weights(keras_weights=_layers, precision=precision, minW=_min, maxW=_max)
+            return cls(keras_weights=_scatter_layers(_weights, _index, _n), precision=precision, minV=_min, maxV=_max, shapes=_shapes)
+        _weights, _scales, _zero_points = compress_keras_weights_scaled(keras_weights=_layers, precision=precision,
+                                                                        per_channel=(quant_mode == 'channel'))
+        return cls(keras_weights=_scatter_layers(_weights, _index, _n), precision=precision, minV=_min, maxV=_max,
+                   quant_mode=quant_mode, scales=_scatter_layers(_scales, _index, _n),
+                   zero_points=_scatter_layers(_zero_points, _index, _n), shapes=_shapes)
+
+    def set_version(self, session, version):
+        """Tags a global model with the aggregator session and version that produced it"""
+        self.session = session
+        self.version = version
+
+    def set_delta_base(self, base_session, base_version, indices=None):
+        """Marks the weights as a delta against the global model (base_session, base_version).
+        If indices (per layer flat positions) are given the delta is sparse"""
+        self.encoding = 'delta' if indices is None else 'sparse'
+        self.base_session = base_session
+        self.base_version = base_version
+        self.indices = indices
+
+    def set_train_stats(self, num_samples, epochs=None, loss=None):
+        """Attaches the number of samples, epochs and final loss of the local training that produced the weights"""
+        self.num_samples = int(num_samples)
+        self.epochs = None if epochs is None else int(epochs)
+        self.loss = None if loss is None else float(loss)
+
+    def _validate(self):
+        if type(self.weights) != list:
+            raise TypeError("Weights type not valid")
+        if type(self.precision)!=int:
+            raise TypeError("Precision type not valid")
+        if type(self.minV)!= (np.float32 or float):
+            raise TypeError("min type not valid")
+        if type(self.maxV)!= (np.float32 or float):
+            raise TypeError("max type not valid")
+        if self.quant_mode not in self.quant_modes:
+            raise TypeError("Quantization mode not valid: {}".format(self.quant_mode))
+        if self.quant_mode != 'global' and self.precision != 32:
+            if type(self.scales) != list or type(self.zero_points) != list:
+                raise TypeError("Scales / zero points type not valid")
+            if not len(self.scales) == len(self.zero_points) == len(self.weights):
+                raise TypeError("Scales / zero points must have one entry per layer")
+        if self.precision < 8:
+            if type(self.shapes) != list or len(self.shapes) != len(self.weights):
+                raise TypeError("Packed weights require one shape per layer")
+        if self.encoding not in self.encodings:
+            raise TypeError("Encoding not valid: {}".format(self.encoding))
+        if self.encoding != 'full' and type(self.base_version) != int:
+            raise TypeError("Delta encoded weights require an int base_version")
+        if self.encoding == 'sparse':
+            if type(self.indices) != list or len(self.indices) != len(self.weights):
+                raise TypeError("Sparse weights require one index array per layer")
+        if self.num_samples is not None and (type(self.num_samples) != int or self.num_samples < 0):
+            raise TypeError("num_samples must be a non-negative int")
+        return True
+
+    def encode(self, wire_format='binary'):
+        """
+        Encodes the object for publishing
+
+        Args:
+            wire_format (str): one of SerializableWeights.wire_formats
+        Returns:
+            payload (bytes / str): bytes for 'binary', str for 'jsonpickle'
+        """
+        if wire_format == 'jsonpickle':
+            return jsonpickle.encode(self)
+        if wire_format != 'binary':
+            raise ValueError("Unknown wire format: {}".format(wire_format))
+        fields, arrays = {}, {}
+        for name, value in vars(self).items():
+            if isinstance(value, np.ndarray) or (type(value) == list and
+                    any(isinstance(v, np.ndarray) for v in value) and
+                    all(v is None or isinstance(v, np.ndarray) for v in value)):
+                arrays[name] = value
+            else:
+                fields[name] = value
+        return encode_weight_frame(fields=fields, arrays=arrays)
+
+    @classmethod
+    def decode(cls, payload):
+        """
+        Decodes a payload generated by encode(), detecting the wire format
+
+        Args:
+            payload (bytes / str): received payload
+        Returns:
+            serialW (SerializableWeights): validated object
+        """
+        if is_weight_frame(payload):
+            fields, arrays = decode_weight_frame(payload)
+            serialW = cls.__new__(cls)
+            serialW.__dict__.update(fields)
+            serialW.__dict__.update(arrays)
+        else:
+            if isinstance(payload, (bytes, bytearray)):
+                payload = payload.decode('utf8')
+            serialW = jsonpickle.decode(payload)
+            if not isinstance(serialW, SerializableWeights):
+                raise TypeError("Deserialized object is not of instance Serializable Weights: {}".format(type(serialW)))
+        try:
+            serialW._validate()
+        except AssertionError:
+            raise TypeError("Error validating deserialized weight types")
+        return serialW
+
+    def inflate(self):
+        """
+        Returns the weights as a list of float32 numpy arrays, inflating them if they were compressed.
+        Layers that were not sent stay None
+        """
+        if self.precision == 32:
+            return [None if layer is None else np.asarray(layer, dtype=np.float32) for layer in self.weights]
+        _index = [i for i, layer in enumerate(self.weights) if layer is not None]
+        if not _index:
+            return [None] * len(self.weights)
+        def _gather(values):
+            return None if values is None else [values[i] for i in _index]
+        if self.quant_mode != 'global':
+            _weights = inflate_keras_weights(keras_weights=_gather(self.weights), minV=self.minV, maxV=self.maxV, base_precision=self.precision,
+                                             scales=_gather(self.scales), zero_points=_gather(self.zero_points), shapes=_gather(self.shapes))
+        else:
+            _weights = inflate_keras_weights(keras_weights=_gather(self.weights), minV=self.minV, maxV=self.maxV, base_precision=self.precision,
+                                             shapes=_gather(self.shapes))
+        return _scatter_layers(_weights, _index, len(self.weights))
@@ -0,0 +1,75 @@
+import logging
+import numpy as np
+from dl_mqtt_clients.payload_serializers.serializer import SerializerBase
+from dl_mqtt_clients.func._general_func import get_time_unix, parse_data_field
+from dl_mqtt_clients.func._serializer_func import decode_bytestr_to_json, is_data_frame, encode_data_frame, decode_data_frame
+
+class BinarySerializer(SerializerBase):
+    """
+    Serializes typed NumPy arrays into binary data frames: a small JSON schema header (field names, dtypes, shapes)
+    followed by the raw little-endian buffers (see func/_serializer_func.py). Decoding maps the buffers with
+    np.frombuffer, no Python lists are built in either direction.
+
+    A field holds either a single array (one row or a row-major batch) or a list of 1-D arrays (a columnar batch).
+    Payloads that are not data frames are decoded as JSON so JSON publishers can feed binary clients.
+    """
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.logger.info("Serializer initialized")
+
+    def deserialize(self, input):
+        """
+        Returns a dict of field name -> numpy array (or list of column arrays) and scalar fields such as timestamp
+        """
+        if not is_data_frame(input):
+            return decode_bytestr_to_json(value=input)
+        fields, arrays = decode_data_frame(input)
+        fields.update(arrays)
+        return fields
+
+    def deserialize_array(self, input, field='data', features=None):
+        if not is_data_frame(input):
+            return parse_data_field(decode_bytestr_to_json(value=input)[field], features=features)
+        _, arrays = decode_data_frame(input)
+        return self._rows(arrays[field])
+
+    def deserialize_rows(self, input, field='data', passthrough=(), features=None):
+        if not is_data_frame(input):
+            return super().deserialize_rows(input, field=field, passthrough=passthrough, features=features)
+        fields, arrays = decode_data_frame(input)
+        fields.update(arrays)
+        return self._rows(fields[field]), {name: fields.get(name) for name in passthrough}
+
+    def _rows(self, values):
+        if isinstance(values, list):
+            data = np.stack(values, axis=1).astype(np.float32, copy=False)
+        else:
+            data = values.astype(np.float32, copy=False)
+        if data.ndim == 1:
+            data = data.reshape(1, -1)
+        if data.ndim != 2:
+            raise ValueError("Data field must be a row, a list of rows or a list of columns; got {} dims".format(data.ndim))
+        return data
+
+    def serialize(self, data, output_field_name):
+        """
+        Serializes data (numpy array, list of column arrays or list of values) with the current timestamp
+        """
+        if isinstance(data, (list, tuple)) and len(data) and all(isinstance(c, np.ndarray) for c in data):
+            data = list(data)
+        else:
+            data = np.asarray(data)
+        return encode_data_frame(fields={'timestamp': get_time_unix()}, arrays={output_field_name: data})
+
+    def serialize_batch(self, columns, fields):
+        """
+        Numeric columns are sent as arrays, others (e.g. string ids or columns with missing values) in the JSON header
+        """
+        _fields, _arrays = self._batch_fields(columns, fields, get_time_unix()), {}
+        for name, values in columns.items():
+            values = np.asarray(values)
+            if values.dtype.kind in 'biuf':
+                _arrays[name] = values
+            else:
+                _fields[name] = values.tolist()
+        return encode_data_frame(fields=_fields, arrays=_arrays)
@@ -5,6 +5,12 @@ from dl_mqtt_clients.payload_serializers.serializer import SerializerBase
 from dl_mqtt_clients.func._general_func import get_time_unix
 from dl_mqtt_clients.func._serializer_func import decode_bytestr_to_json
 
+class _NumpyEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        return json.JSONEncoder.default(self, obj)
+
 class JSONSerializer(SerializerBase):
     def __init__(self):
         self.schema = None
@@ -34,9 +40,7 @@ class JSONSerializer(SerializerBase):
         return output
 		
     def serialize(self, data, output_field_name):
-        class NumpyEncoder(json.JSONEncoder):
-            def default(self, obj):
-                if isinstance(obj, np.ndarray):
-                    return obj.tolist()
-                return json.JSONEncoder.default(self, obj)
-        return json.dumps({'timestamp': get_time_unix(), output_field_name: data}, cls=NumpyEncoder)
\ No newline at end of file
+        return json.dumps({'timestamp': get_time_unix(), output_field_name: data}, cls=_NumpyEncoder)
+
+    def serialize_batch(self, columns, fields):
+        return json.dumps(dict(self._batch_fields(columns, fields, get_time_unix()), **columns), cls=_NumpyEncoder)
\ No newline at end of file
@@ -0,0 +1,14 @@
+def get_serializer(name):
+    """
+    Returns a new payload serializer by configuration name (see MQTTConnectionConfig.serializer())
+
+    Args:
+        name (str): json or binary
+    """
+    if name == 'json':
+        from dl_mqtt_clients.payload_serializers.JSONSerializer import JSONSerializer
+        return JSONSerializer()
+    if name == 'binary':
+        from dl_mqtt_clients.payload_serializers.BinarySerializer import BinarySerializer
+        return BinarySerializer()
+    raise ValueError("Unknown serializer: {}".format(name))
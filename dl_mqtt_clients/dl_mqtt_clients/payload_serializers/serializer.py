@@ -1,5 +1,6 @@
 import abc
 import json
+from dl_mqtt_clients.func._general_func import parse_data_field
 
 class SerializerBase(metaclass=abc.ABCMeta):
     @abc.abstractmethod
@@ -8,4 +9,23 @@ class SerializerBase(metaclass=abc.ABCMeta):
         return an appropriate formatted object representing the data"""
     @abc.abstractmethod
     def serialize(self, data):
-        """Serializes data to json output byte string"""
\ No newline at end of file
+        """Serializes data to json output byte string"""
+    def deserialize_array(self, input, field='data', features=None):
+        """Parses data (bytearray) holding one or many rows in field, columnar batches are ordered by features
+        return a float32 numpy array of shape (rows, features)"""
+        return parse_data_field(self.deserialize(input)[field], features=features)
+    def deserialize_rows(self, input, field='data', passthrough=(), features=None):
+        """Parses data (bytearray) like deserialize_array and also returns the passthrough fields of the message
+        return (float32 numpy array of shape (rows, features), dict of field name -> value, None if absent)"""
+        msg = self.deserialize(input)
+        return parse_data_field(msg[field], features=features), {name: msg.get(name) for name in passthrough}
+    def serialize_batch(self, columns, fields):
+        """Serializes a columnar batch: columns (dict of name -> one value per row) plus scalar fields, with a timestamp"""
+        raise NotImplementedError("{} does not support batched output".format(type(self).__name__))
+    def _batch_fields(self, columns, fields, timestamp):
+        """Returns the scalar fields of a batch with its timestamp, raising ValueError if a column reuses their names"""
+        _fields = dict(fields, timestamp=timestamp)
+        _clash = set(columns) & set(_fields)
+        if _clash:
+            raise ValueError("Batch columns clash with message fields: {}".format(sorted(_clash)))
+        return _fields
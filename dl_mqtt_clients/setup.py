@@ -24,5 +24,7 @@ setuptools.setup(
                       'tensorflow == 2.2.0+nv20.6',
                       'h5py >= 2.10.0',
                       'scikit-learn >= 0.20.3',
+                      'joblib >= 0.12',
                       'jsonpickle == 0.9.6'],
+    extras_require={'lz4': ['lz4 >= 3.0']},
 )
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+import dl_mqtt_clients.func._nn_func as nn_f
+from dl_mqtt_clients.model_server.accumulator import WeightAccumulator, StalenessMixer
+
+def random_model():
+    return [np.random.randn(8, 4).astype(np.float32), np.random.randn(4).astype(np.float32)]
+
+@pytest.mark.server
+def test_accumulator_mean():
+    models = [random_model() for i in range(5)]
+    acc = WeightAccumulator()
+    for m in models:
+        assert(acc.add(m))
+    assert(len(acc) == 5)
+    for merged, layers in zip(acc.result(), zip(*models)):
+        assert(merged.dtype == np.float32)
+        assert(np.allclose(merged, np.mean(layers, axis=0), atol=1e-6))
+    with pytest.raises(ValueError):
+        acc.add([np.zeros((3, 3))])
+    acc.reset()
+    with pytest.raises(ValueError):
+        acc.result()
+
+@pytest.mark.server
+def test_accumulator_compensated():
+    #many small updates around a large offset lose precision in a plain float32 sum
+    updates = [[np.full(16, 1000.0, dtype=np.float32) + np.float32(np.random.rand() * 1e-3)] for i in range(5000)]
+    expected = np.mean([u[0].astype(np.float64) for u in updates], axis=0)
+    plain, compensated = WeightAccumulator(compensated=False), WeightAccumulator()
+    for u in updates:
+        plain.add(u)
+        compensated.add(u)
+    assert(np.abs(compensated.result()[0] - expected).max() <= np.abs(plain.result()[0] - expected).max())
+    assert(np.allclose(compensated.result()[0], expected, atol=1e-4))
+
+@pytest.mark.server
+def test_accumulator_sampling():
+    counts = np.zeros(10)
+    for trial in range(300):
+        acc = WeightAccumulator(expected=10, sample_size=3)
+        for i in range(10):
+            if acc.add([np.full(2, i, dtype=np.float32)]):
+                counts[i] += 1
+        assert(acc.merged == 3)
+    #every update is equally likely to be merged
+    assert(np.all(np.abs(counts / 300 - 0.3) < 0.12))
+    with pytest.raises(ValueError):
+        WeightAccumulator(sample_size=3)
+
+@pytest.mark.server
+def test_accumulator_sparse_weighted():
+    base, dense = random_model(), random_model()
+    indices = [np.array([1, 5, 9], dtype=np.int32), None]
+    values = [np.random.randn(3).astype(np.float32), None]
+    update = nn_f.SparseUpdate(base_weights=base, indices=indices, values=values)
+    acc = WeightAccumulator()
+    acc.add(dense)
+    acc.add(update)
+    expanded = nn_f.apply_sparse_delta(base, indices, values)
+    for merged, d, e in zip(acc.result(), dense, expanded):
+        assert(np.allclose(merged, (d + e) / 2, atol=1e-6))
+    acc = WeightAccumulator()
+    acc.add(dense, weight=3.0)
+    acc.add(base, weight=1.0)
+    assert(np.allclose(acc.result()[1], (3 * dense[1] + base[1]) / 4, atol=1e-6))
+
+@pytest.mark.server
+def test_accumulator_clip_and_reset():
+    reference = [np.zeros((8, 4), dtype=np.float32), np.zeros(4, dtype=np.float32)]
+    acc = WeightAccumulator(clip_norm=1.0)
+    acc.set_reference(reference)
+    acc.add([np.full((8, 4), 5.0, dtype=np.float32), np.full(4, 5.0, dtype=np.float32)])
+    acc.add(reference)
+    merged = acc.result()
+    assert(np.isclose(np.sqrt(sum(np.sum(np.square(l)) for l in merged)), 0.5, atol=1e-5))
+    assert(acc.stats()['clipped'] == 1 and acc.stats()['norm_max'] > 1.0)
+    assert(np.allclose(acc.stats()['layer_norm_max'], [np.sqrt(32 * 25.0), 10.0], atol=1e-4))
+    acc.reset()
+    acc.add(reference)
+    assert(np.allclose(acc.result()[0], 0.0))
+    assert(acc.stats()['merged'] == 1)
+    assert(acc.stats()['layer_norm_max'] == [0.0, 0.0])
+
+@pytest.mark.server
+def test_staleness_mixer():
+    model = random_model()
+    mixer = StalenessMixer(model, alpha=0.5, exponent=1.0)
+    update = [layer + 1.0 for layer in model]
+    assert(mixer.mix(update, staleness=0) == 0.5)
+    for mixed, layer in zip(mixer.weights(), model):
+        assert(np.allclose(mixed, layer + 0.5, atol=1e-6))
+    #an update 3 versions behind is mixed with a quarter of the weight
+    assert(mixer.mix(update, staleness=3) == 0.125)
+    for mixed, layer in zip(mixer.weights(), model):
+        assert(np.allclose(mixed, layer + 0.5 + 0.125 * 0.5, atol=1e-6))
+    assert(mixer.stats()['mixed'] == 2 and mixer.stats()['staleness_max'] == 3)
+    mixer.reset_stats()
+    assert(mixer.pending == 0)
+    with pytest.raises(ValueError):
+        mixer.mix([np.zeros((3, 3))], staleness=0)
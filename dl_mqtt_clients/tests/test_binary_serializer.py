@@ -0,0 +1,71 @@
+import json
+import numpy as np
+import pytest
+from dl_mqtt_clients.payload_serializers import get_serializer
+from dl_mqtt_clients.payload_serializers.BinarySerializer import BinarySerializer
+from dl_mqtt_clients.func._general_func import logging_format
+import logging
+logging.basicConfig(format=logging_format(), level=logging.INFO)
+
+
+def test_serialize_scores():
+    b = BinarySerializer()
+    scores = np.random.rand(32).astype(np.float32)
+    payload = b.serialize(scores, output_field_name='anomaly_score')
+    assert(len(payload) < len(get_serializer('json').serialize(scores, output_field_name='anomaly_score')))
+    out = b.deserialize(payload)
+    assert(np.array_equal(out['anomaly_score'], scores))
+    assert(out['anomaly_score'].dtype == np.float32)
+    assert('timestamp' in out)
+
+def test_deserialize_array():
+    b = BinarySerializer()
+    rows = np.random.rand(16, 7)
+    data = b.deserialize_array(b.serialize(rows, output_field_name='data'))
+    assert(data.shape == (16, 7) and data.dtype == np.float32)
+    assert(np.allclose(data, rows))
+    #columnar batch
+    columns = b.deserialize_array(b.serialize([rows[:, i] for i in range(7)], output_field_name='data'))
+    assert(np.array_equal(columns, data))
+    #single row
+    assert(b.deserialize_array(b.serialize(rows[0], output_field_name='data')).shape == (1, 7))
+
+def test_deserialize_json_fallback():
+    b = BinarySerializer()
+    data = b.deserialize_array(json.dumps({'data': [[0.21, 0.22], [1, 2]]}).encode('utf8'))
+    assert(data.shape == (2, 2))
+    with pytest.raises(json.decoder.JSONDecodeError):
+        b.deserialize('{"data": [0.21}'.encode('utf8'))
+
+def test_deserialize_truncated():
+    b = BinarySerializer()
+    payload = b.serialize(np.random.rand(16, 7), output_field_name='data')
+    with pytest.raises(ValueError):
+        b.deserialize_array(payload[:-8])
+
+def test_get_serializer():
+    assert(isinstance(get_serializer('binary'), BinarySerializer))
+    with pytest.raises(ValueError):
+        get_serializer('xml')
+
+def test_serialize_batch_rows():
+    b = BinarySerializer()
+    scores = np.random.rand(3).astype(np.float32)
+    out = b.deserialize(b.serialize_batch(columns={'id': ['a', 'b', None], 'seq': [1, 2, 3], 'anomaly_score': scores},
+                                          fields={'model_version': 4}))
+    assert(out['id'] == ['a', 'b', None])
+    assert(np.array_equal(out['seq'], [1, 2, 3]))
+    assert(np.array_equal(out['anomaly_score'], scores))
+    assert(out['model_version'] == 4)
+    rows = np.random.rand(3, 7).astype(np.float32)
+    frame = b.serialize_batch(columns={'data': rows, 'id': np.arange(3)}, fields={})
+    data, fields = b.deserialize_rows(frame, passthrough=['id', 'missing'])
+    assert(np.array_equal(data, rows))
+    assert(np.array_equal(fields['id'], np.arange(3)) and fields['missing'] is None)
+
+def test_serialize_batch_reserved_fields():
+    for serializer in [BinarySerializer(), get_serializer('json')]:
+        with pytest.raises(ValueError):
+            serializer.serialize_batch(columns={'timestamp': np.arange(3)}, fields={'rows': 3})
+        with pytest.raises(ValueError):
+            serializer.serialize_batch(columns={'rows': np.arange(3)}, fields={'rows': 3})
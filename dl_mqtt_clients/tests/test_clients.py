@@ -1,10 +1,13 @@
 from dl_mqtt_clients.func._general_func import simple_logging_format
 from dl_mqtt_clients.clients import _mosq_client
+from dl_mqtt_clients.func._transport_func import compress_payload, decompress_payload
 from dl_mqtt_clients import configurations
 import mock 
 import pytest
 from pytest_mock import mocker 
 import logging
+import threading
+import time
 logging.basicConfig(format=simple_logging_format, level=logging.INFO)
 logger = logging.getLogger()
 
@@ -100,4 +103,133 @@ def test_publish_msg(mqtt_config_d, mocker):
 	mqtt_config = configurations.MQTTConnectionConfig(mqtt_config_d)
 	client = _mosq_client(config=mqtt_config)
 	mocker.patch.object(client.client, 'publish', return_value=True)
-	client.publish_msg(formatted_msg='{test:value}', pub_topic='test')
\ No newline at end of file
+	sent = client.publish_msg(formatted_msg='{test:value}', pub_topic='test')
+	assert(sent.done() and sent.result() is None)
+
+class FakeMsg():
+	def __init__(self, payload, topic='global/model'):
+		self.payload = payload
+		self.topic = topic
+		self.qos = 0
+		self.retain = False
+
+def test_publish_chunked(mqtt_config_d, mocker):
+	mqtt_config = configurations.MQTTConnectionConfig(dict(mqtt_config_d, chunk_size=256))
+	client = _mosq_client(config=mqtt_config)
+	published = []
+	mocker.patch.object(client.client, 'publish', side_effect=lambda topic, payload, qos: published.append(payload))
+	payload = bytes(range(256)) * 10
+	client.publish_msg(formatted_msg=payload, pub_topic='test')
+	assert(len(published)>1)
+	assert(all(len(p)<=256 for p in published))
+	received = []
+	callback = client._wrap_callback(lambda client, userdata, msg: received.append(msg.payload))
+	#out of order and duplicated chunks are reassembled
+	for p in reversed(published + published[:2]):
+		callback(None, None, FakeMsg(p))
+	assert(received==[payload])
+	assert(client.reassembler.pending()==0)
+
+def test_chunk_reassembly_errors(mqtt_config_d, mocker):
+	mqtt_config = configurations.MQTTConnectionConfig(dict(mqtt_config_d, chunk_size=256, chunk_timeout=1.0, max_reassembly_bytes=4096))
+	client = _mosq_client(config=mqtt_config)
+	published = []
+	mocker.patch.object(client.client, 'publish', side_effect=lambda topic, payload, qos: published.append(payload))
+	received = []
+	callback = client._wrap_callback(lambda client, userdata, msg: received.append(msg.payload))
+	#corrupted chunk
+	client.publish_msg(formatted_msg=b'a' * 1000, pub_topic='test')
+	corrupted = published[0][:-1] + b'b'
+	callback(None, None, FakeMsg(corrupted))
+	assert(client.reassembler.pending()==0)
+	#missing chunk times out
+	for p in published[:-1]:
+		callback(None, None, FakeMsg(p))
+	assert(client.reassembler.pending()==1)
+	client.reassembler.expire(now=time.time() + 2.0)
+	assert(client.reassembler.pending()==0)
+	#transfers larger than the reassembly buffer are ignored
+	published.clear()
+	client.publish_msg(formatted_msg=b'a' * 5000, pub_topic='test')
+	for p in published:
+		callback(None, None, FakeMsg(p))
+	assert(received==[])
+	#small payloads are passed through
+	callback(None, None, FakeMsg(b'{"test": 1}'))
+	assert(received==[b'{"test": 1}'])
+
+def test_chunk_expiry_without_traffic(mqtt_config_d, mocker):
+	mqtt_config = configurations.MQTTConnectionConfig(dict(mqtt_config_d, chunk_size=256, chunk_timeout=0.2))
+	client = _mosq_client(config=mqtt_config)
+	published = []
+	mocker.patch.object(client.client, 'publish', side_effect=lambda topic, payload, qos: published.append(payload))
+	callback = client._wrap_callback(lambda client, userdata, msg: None)
+	client.publish_msg(formatted_msg=b'a' * 1000, pub_topic='test')
+	for p in published[:-1]:
+		callback(None, None, FakeMsg(p))
+	assert(client.reassembler.pending()==1)
+	#no further chunk arrives, the sweeper drops the transfer
+	deadline = time.time() + 5.0
+	while client.reassembler.pending() and time.time() < deadline:
+		time.sleep(0.05)
+	assert(client.reassembler.pending()==0)
+	client.reassembler.close()
+
+@pytest.mark.compression
+def test_publish_compressed(mqtt_config_d, mocker):
+	mqtt_config = configurations.MQTTConnectionConfig(dict(mqtt_config_d, chunk_size=256, compression={'model/#': {'codec': 'zlib', 'level': 9}, 'data': {'codec': 'lzma'}}))
+	client = _mosq_client(config=mqtt_config)
+	published = []
+	mocker.patch.object(client.client, 'publish', side_effect=lambda topic, payload, qos: published.append((topic, payload)))
+	payload = b'0123456789' * 1000
+	client.publish_msg(formatted_msg=payload, pub_topic='model/update').result()
+	client.publish_msg(formatted_msg='{"data": [1, 2, 3]}', pub_topic='data').result()
+	assert(client.publish_msg(formatted_msg=payload, pub_topic='other').done())
+	#the compressed model payload fits in a single chunk
+	assert([t for t, p in published[:3]]==['model/update', 'data', 'other'])
+	assert(len(published) > 3)
+	received = []
+	threads = {}
+	def on_message(client, userdata, msg):
+		received.append(msg.payload)
+		threads[msg.topic] = threading.current_thread()
+	callback = client._wrap_callback(on_message)
+	#compressed messages are decompressed on the receive worker, the wrapper returns its future
+	futures = [callback(None, None, FakeMsg(p, topic=t)) for t, p in published]
+	for f in futures[:2]:
+		f.result()
+	assert(sorted(received)==sorted([payload, b'{"data": [1, 2, 3]}', payload]))
+	assert(threads['model/update'] is threads['data'] and threads['data'] is not threading.current_thread())
+	assert(threads['other'] is threading.current_thread())
+	stats = client.codec_stats()
+	assert(stats['publish']['model/update']['raw_bytes']==len(payload))
+	assert(stats['publish']['model/update']['bytes_saved'] > 0)
+	assert(stats['receive']['data']['codec']=='lzma')
+	client.log_codec_stats()
+	client.shutdown()
+
+@pytest.mark.compression
+def test_decompression_limit(mqtt_config_d, mocker):
+	mqtt_config = configurations.MQTTConnectionConfig(dict(mqtt_config_d, max_reassembly_bytes=4096))
+	client = _mosq_client(config=mqtt_config)
+	received = []
+	callback = client._wrap_callback(lambda client, userdata, msg: received.append(msg.payload))
+	for codec in ['zlib', 'lzma', 'bz2']:
+		#a few hundred bytes inflating to 10 MB are dropped, not inflated
+		bomb = compress_payload(b'\0' * 10000000, codec)
+		with pytest.raises(ValueError):
+			decompress_payload(bomb, max_bytes=4096)
+		assert(callback(None, None, FakeMsg(bomb)).result() is None)
+		assert(decompress_payload(compress_payload(b'a' * 4096, codec), max_bytes=4096)[1] == b'a' * 4096)
+		#truncated frames are rejected
+		with pytest.raises(ValueError):
+			decompress_payload(compress_payload(bytes(range(256)) * 16, codec)[:-8])
+	assert(received == [])
+	client.shutdown()
+
+@pytest.mark.compression
+def test_compression_config_invalid(mqtt_config_d):
+	with pytest.raises(AssertionError):
+		configurations.MQTTConnectionConfig(dict(mqtt_config_d, compression={'model/#': {'codec': 'unknown'}}))
+	with pytest.raises(AssertionError):
+		configurations.MQTTConnectionConfig(dict(mqtt_config_d, compression={'model/#': {'codec': 'zlib', 'level': 12}}))
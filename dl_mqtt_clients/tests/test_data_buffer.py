@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+from dl_mqtt_clients.mosqeras.data_buffer import DataBuffer
+
+
+def test_write_take():
+    buf = DataBuffer(capacity=4, row_shape=(3,))
+    assert(buf.write(np.ones((3, 3))) == 3)
+    assert(not buf.full())
+    #only the rows that fit are written
+    assert(buf.write(np.full((2, 3), 2.0)) == 1)
+    assert(buf.full())
+    data = buf.take()
+    assert(data.shape == (4, 3) and data.dtype == np.float32)
+    assert(np.array_equal(data[-1], [2, 2, 2]))
+    assert(len(buf) == 0)
+    #writing continues in another buffer, the taken one is untouched
+    buf.write(np.zeros((4, 3)))
+    assert(np.array_equal(data[-1], [2, 2, 2]))
+
+def test_release_reuse():
+    buf = DataBuffer(capacity=2)
+    buf.write(np.ones((2, 5)))
+    assert(buf.row_shape == (5,))
+    first = buf.take()
+    buf.release(first)
+    buf.write(np.ones((2, 5)))
+    second = buf.take()
+    buf.write(np.ones((2, 5)))
+    third = buf.take()
+    #the released buffer is reused instead of allocating
+    assert(np.shares_memory(first, third))
+    assert(not np.shares_memory(second, third))
+
+def test_write_bad_shape():
+    buf = DataBuffer(capacity=2, row_shape=(5,))
+    with pytest.raises(ValueError):
+        buf.write(np.ones((1, 4)))
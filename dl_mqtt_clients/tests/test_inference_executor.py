@@ -0,0 +1,73 @@
+import threading
+import time
+import pytest
+from dl_mqtt_clients.mosqeras.inference_executor import InferenceExecutor
+
+
+def test_executor_order():
+    emitted = []
+    executor = InferenceExecutor(process_fn=lambda i, delay: time.sleep(delay) or i, emit_fn=emitted.append, workers=4, max_queue=8)
+    for i in range(8):
+        executor.submit(i, 0.05 * (8 - i))
+    executor.shutdown()
+    assert(emitted == list(range(8)))
+    assert(executor.stats()['processed'] == 8)
+
+def test_executor_drop_policies():
+    for overflow, expected in [('drop_newest', [0, 1, 2]), ('drop_oldest', [0, 2, 3])]:
+        gate = threading.Event()
+        emitted, dropped = [], []
+        executor = InferenceExecutor(process_fn=lambda i: gate.wait() and i, emit_fn=emitted.append, workers=1, max_queue=2,
+                                     overflow=overflow, on_drop=dropped.append)
+        executor.submit(0)
+        time.sleep(0.05)
+        #0 is being processed, 1 and 2 fill the queue
+        executor.submit(1)
+        executor.submit(2)
+        assert(executor.submit(3) == (overflow != 'drop_newest'))
+        gate.set()
+        executor.shutdown()
+        assert(emitted == expected)
+        assert(len(dropped) == 1 and executor.stats()['dropped'] == 1)
+
+def test_executor_block():
+    gate = threading.Event()
+    executor = InferenceExecutor(process_fn=lambda i: gate.wait() and i, emit_fn=lambda r: None, workers=1, max_queue=1)
+    executor.submit(0)
+    time.sleep(0.05)
+    executor.submit(1)
+    submitted = threading.Thread(target=executor.submit, args=(2,))
+    submitted.start()
+    submitted.join(0.1)
+    assert(submitted.is_alive())
+    gate.set()
+    submitted.join(1.0)
+    assert(not submitted.is_alive())
+    executor.shutdown()
+    assert(executor.stats()['max_depth'] == 1)
+
+def test_executor_block_shutdown():
+    gate = threading.Event()
+    emitted, dropped = [], []
+    executor = InferenceExecutor(process_fn=lambda i: gate.wait() and i, emit_fn=emitted.append, workers=1, max_queue=1,
+                                 on_drop=dropped.append)
+    executor.submit(0)
+    while executor.depth():
+        time.sleep(0.01)
+    executor.submit(1)
+    results = []
+    submitter = threading.Thread(target=lambda: results.append(executor.submit(2)))
+    submitter.start()
+    time.sleep(0.05)
+    #the blocked batch is released to on_drop instead of being queued behind the exiting workers
+    executor.shutdown(wait=False)
+    submitter.join(1.0)
+    assert(results == [False] and dropped == [2])
+    gate.set()
+    executor.shutdown()
+    assert(emitted == [0, 1])
+    assert(executor.stats()['dropped'] == 1 and executor.stats()['processed'] == 2)
+
+def test_executor_invalid():
+    with pytest.raises(ValueError):
+        InferenceExecutor(process_fn=None, emit_fn=None, overflow='drop_all')
@@ -1,4 +1,5 @@
 import json
+import numpy as np
 import pytest
 from dl_mqtt_clients.payload_serializers.JSONSerializer import JSONSerializer
 from dl_mqtt_clients.func._general_func import logging_format
@@ -79,4 +80,24 @@ def test_validate_warning(json_payload, schema):
     data = json.loads(json_payload.decode('utf8'))
     j = JSONSerializer()
     j._validate(json_data=data)
-    assert(j.has_warned)
\ No newline at end of file
+    assert(j.has_warned)
+
+def test_deserialize_array_batched():
+    j = JSONSerializer()
+    row = j.deserialize_array('{"data": [0.21, 0.22, 0.23]}'.encode('utf8'))
+    assert(row.shape == (1, 3) and row.dtype == np.float32)
+    rows = j.deserialize_array('{"data": [[0.21, 0.22, 0.23], [1, 2, 3]]}'.encode('utf8'))
+    assert(rows.shape == (2, 3))
+    columns = j.deserialize_array('{"data": {"a": [0.21, 1], "b": [0.22, 2], "c": [0.23, 3]}}'.encode('utf8'), features=['a', 'b', 'c'])
+    assert(np.array_equal(rows, columns))
+    #columns are stacked in the feature order, not the order the sender wrote them in
+    columns = j.deserialize_array('{"data": {"c": [0.23, 3], "a": [0.21, 1], "b": [0.22, 2]}}'.encode('utf8'), features=['a', 'b', 'c'])
+    assert(np.array_equal(rows, columns))
+    for features in [None, ['a', 'b'], ['a', 'b', 'd']]:
+        with pytest.raises(ValueError):
+            j.deserialize_array('{"data": {"a": [0.21, 1], "b": [0.22, 2], "c": [0.23, 3]}}'.encode('utf8'), features=features)
+    #python repr style payloads are still accepted
+    legacy = j.deserialize_array("{'data': [[0.21, 0.22, 0.23], [1, 2, 3]]}".encode('utf8'))
+    assert(np.array_equal(rows, legacy))
+    with pytest.raises(ValueError):
+        j.deserialize_array('{"data": [[[0.21]]]}'.encode('utf8'))
@@ -1,8 +1,14 @@
 import pytest
+import json
+import time
 from dl_mqtt_clients import ad_mosqeras
 from dl_mqtt_clients import KerasNN
 from dl_mqtt_clients import configurations
 import logging
+import numpy as np
+from tests.test_net import build_model, INPUT_DATA_SHAPE
+from dl_mqtt_clients.payload_serializers.JSONSerializer import JSONSerializer
+from pytest_mock import mocker
 
 mqtt_data_d = {'host': 'localhost','port': 1883,'sub_topics':['test'],'pub_topic':'output','ssl_protocol': 'tls_12','keepalive': 10,'sub_qos': 1,'pub_qos': 0,'mqtt_protocol': 311}
 mqtt_config_d = {'host': 'localhost','port': 1883,'sub_topics':['update'],'pub_topic': '','ssl_protocol': 'tls_12','keepalive': 10,'pub_qos': 0,'sub_qos': 2,'mqtt_protocol': 311}
@@ -34,4 +40,226 @@ def test_train_update_config():
 	m.set_train_config(k_c)
 	sample_update_config = {'train_bs': 10}
 	m._update_mqtt(sample_update_config)
-	assert(m.train_config.train_bs()==10)
\ No newline at end of file
+	assert(m.train_config.train_bs()==10)
+
+def test_data_cache_batches(mocker):
+	data_mqtt_c = configurations.MQTTConnectionConfig(c=mqtt_data_d)
+	k = KerasNN()
+	k.set_model(keras_model=build_model())
+	m = ad_mosqeras.predict_client(model = k,
+								sk_scaler = None,
+								mqtt_config = data_mqtt_c,
+								serializer = JSONSerializer(),
+								model_update_topic = 'update',
+								cache_sz = 5)
+	processed = []
+	mocker.patch.object(m, '_score', side_effect=lambda data: processed.append(data.copy()))
+	mocker.patch.object(m.dataClient, 'publish_msg')
+	class Msg():
+		topic = 'test'
+		def __init__(self, rows):
+			self.payload = json.dumps({'data': rows}).encode('utf8')
+	rows = np.random.rand(12, INPUT_DATA_SHAPE).round(4)
+	m._on_message(None, None, Msg(rows[0].tolist()))
+	m._on_message(None, None, Msg(rows[1:].tolist()))
+	m.shutdown()
+	assert(len(processed) == 2)
+	assert(np.allclose(np.concatenate(processed), rows[:10]))
+	assert(len(m.data_cache) == 2)
+
+def build_predict_client(mocker, cache_sz):
+	k = KerasNN()
+	k.set_model(keras_model=build_model())
+	m = ad_mosqeras.predict_client(model = k,
+								sk_scaler = None,
+								mqtt_config = configurations.MQTTConnectionConfig(c=mqtt_data_d),
+								serializer = JSONSerializer(),
+								model_update_topic = 'update',
+								cache_sz = cache_sz)
+	processed = []
+	mocker.patch.object(m, '_score', side_effect=lambda data: processed.append(data.copy()) or len(processed))
+	mocker.patch.object(m.dataClient, 'publish_msg')
+	return m, processed
+
+class DataMsg():
+	topic = 'test'
+	def __init__(self, rows):
+		self.payload = json.dumps({'data': rows}).encode('utf8')
+
+def test_columnar_feature_order(mocker):
+	m, processed = build_predict_client(mocker, cache_sz=2)
+	features = ['f{}'.format(i) for i in range(INPUT_DATA_SHAPE)]
+	rows = np.random.rand(2, INPUT_DATA_SHAPE).round(4)
+	columns = {name: rows[:, i].tolist() for i, name in reversed(list(enumerate(features)))}
+	#without a feature order columnar messages are dropped
+	m._on_message(None, None, DataMsg(columns))
+	assert(len(m.data_cache) == 0)
+	with pytest.raises(ValueError):
+		m.set_feature_order(features[1:])
+	m.set_feature_order(features)
+	m._on_message(None, None, DataMsg(dict(columns, extra=[0, 0])))
+	assert(len(m.data_cache) == 0)
+	#columns are stacked in the configured order whatever order the sender used
+	m._on_message(None, None, DataMsg(columns))
+	m.shutdown()
+	assert(len(processed) == 1)
+	assert(np.allclose(processed[0], rows))
+
+class FakeClock():
+	def __init__(self):
+		self.now = 0.0
+	def __call__(self):
+		return self.now
+
+def wait_until(condition, timeout=10.0):
+	#only waits for the inference worker, batching decisions follow the fake clock
+	deadline = time.time() + timeout
+	while not condition() and time.time() < deadline:
+		time.sleep(0.01)
+	return condition()
+
+def build_batching_client(mocker, cache_sz, **batching):
+	m, processed = build_predict_client(mocker, cache_sz=cache_sz)
+	clock = FakeClock()
+	m._clock = clock
+	m.set_batching_config(**batching)
+	return m, processed, clock
+
+def test_predict_latency_flush(mocker):
+	m, processed, clock = build_batching_client(mocker, cache_sz=100, max_latency_ms=50)
+	rows = np.random.rand(3, INPUT_DATA_SHAPE).round(4)
+	for r in rows:
+		m._on_message(None, None, DataMsg(r.tolist()))
+		clock.now += 0.01
+	with m._cache_lock:
+		assert(m._flush_due() > 0)
+	#flushed at the deadline, no further message needed
+	clock.now = 0.05
+	with m._cache_lock:
+		assert(m._flush_due() is None)
+	assert(wait_until(lambda: m.latency_stats() is not None))
+	assert(len(processed) == 1)
+	assert(np.allclose(processed[0], rows))
+	assert(m.latency_stats()['p99_ms'] >= 50)
+	m.shutdown()
+
+def test_predict_autotune(mocker):
+	m, processed, clock = build_batching_client(mocker, cache_sz=1000, max_latency_ms=1000, p99_target_ms=20)
+	#the first batch waits for the deadline, the observed rate then shrinks the batch size to meet the target
+	for i in range(60):
+		m._on_message(None, None, DataMsg(np.random.rand(INPUT_DATA_SHAPE).tolist()))
+		clock.now += 0.01
+	clock.now = 1.0
+	with m._cache_lock:
+		m._flush_due()
+	assert(wait_until(lambda: m.latency_stats() is not None))
+	assert(len(processed) == 1)
+	assert(m.latency_stats()['batch_target'] < 60)
+	for i in range(m.latency_stats()['batch_target']):
+		m._on_message(None, None, DataMsg(np.random.rand(INPUT_DATA_SHAPE).tolist()))
+	#dispatched on size, before any deadline
+	assert(wait_until(lambda: len(processed) == 2))
+	m.shutdown()
+
+def test_predict_executor_order(mocker):
+	m, processed = build_predict_client(mocker, cache_sz=2)
+	m.set_executor_config(workers=3, max_queue=8)
+	#later batches finish first, scores are still published in arrival order
+	delays = {1: 0.2, 2: 0.1, 3: 0.0}
+	scored = []
+	def score(data):
+		scored.append(data.copy())
+		n = len(scored)
+		time.sleep(delays.get(n, 0.0))
+		return n
+	mocker.patch.object(m, '_score', side_effect=score)
+	for i in range(6):
+		m._on_message(None, None, DataMsg(np.random.rand(INPUT_DATA_SHAPE).tolist()))
+	m.shutdown()
+	assert([json.loads(c.kwargs['formatted_msg'])['anomaly_score'] for c in m.dataClient.publish_msg.call_args_list] == [1, 2, 3])
+	assert(m.executor_stats()['submitted'] == 3)
+
+def test_predict_score_cache(mocker):
+	m, _ = build_predict_client(mocker, cache_sz=6)
+	m.set_score_cache(max_size=100)
+	modeled = []
+	mocker.patch.object(m, '_model_scores', side_effect=lambda data: modeled.append(data.copy()) or data.sum(axis=1))
+	rows = np.random.rand(2, INPUT_DATA_SHAPE).astype(np.float32)
+	batch = rows[[0, 1, 0, 0, 1, 0]]
+	assert(np.allclose(m._cached_scores(batch), batch.sum(axis=1)))
+	#repeats within a batch are scored once
+	assert(len(modeled[0]) == 2)
+	assert(np.allclose(m._cached_scores(batch), batch.sum(axis=1)))
+	assert(len(modeled) == 1)
+	assert(m.score_cache_stats()['hit_rate'] > 0.8)
+	#new weights invalidate the cached scores
+	m.model.update_weights(weights=m.model.get_weights())
+	m._cached_scores(batch)
+	assert(len(modeled) == 2)
+	assert(m.score_cache_stats()['invalidations'] == 1)
+
+class IdMsg():
+	topic = 'test'
+	def __init__(self, rows, ids, timestamp):
+		self.payload = json.dumps({'data': rows, 'id': ids, 'ts': timestamp}).encode('utf8')
+
+def test_predict_passthrough_output(mocker):
+	m, _ = build_predict_client(mocker, cache_sz=3)
+	m.set_output_config(passthrough_fields=['id', 'ts'])
+	mocker.patch.object(m, '_score', side_effect=lambda data: data[:, 0])
+	rows = np.random.rand(4, INPUT_DATA_SHAPE).round(4)
+	#the first message is split over two batches
+	m._on_message(None, None, IdMsg(rows[:2].tolist(), ['a', 'b'], 10))
+	m._on_message(None, None, IdMsg(rows[2:].tolist(), ['c', 'd'], 11))
+	m._on_message(None, None, IdMsg(rows[:2].tolist(), ['e'], 12))
+	m.shutdown()
+	out = json.loads(m.dataClient.publish_msg.call_args_list[0].kwargs['formatted_msg'])
+	assert(out['id'] == ['a', 'b', 'c'])
+	assert(out['ts'] == [10, 10, 11])
+	assert(np.allclose(out['anomaly_score'], rows[:3, 0]))
+	assert(out['rows'] == 3 and 'model_version' in out)
+	#the message with a mismatching id count was ignored
+	assert(len(m.data_cache) == 1)
+	assert(m._row_fields['id'] == ['d'])
+
+def test_predict_output_reserved_fields(mocker):
+	m, _ = build_predict_client(mocker, cache_sz=3)
+	for name in ['timestamp', 'rows', 'model_version']:
+		with pytest.raises(ValueError):
+			m.set_output_config(passthrough_fields=['id', name])
+	m.shutdown()
+
+def test_predict_output_scoring_version(mocker):
+	m, _ = build_predict_client(mocker, cache_sz=4)
+	m.set_output_config(passthrough_fields=['id'], coalesce_ms=10000)
+	mocker.patch.object(m, '_score', side_effect=lambda data: data[:, 0])
+	m._on_message(None, None, IdMsg(np.random.rand(2, INPUT_DATA_SHAPE).tolist(), ['a', 'b'], 0))
+	data, row_fields = m._take_batch()
+	result = m._score_batch(data, None, row_fields)
+	#a model update between scoring and publishing does not relabel the scores
+	m.model.update_weights(weights=m.model.get_weights(), session='s', version=2)
+	m._emit_batch(result)
+	m._on_message(None, None, IdMsg(np.random.rand(1, INPUT_DATA_SHAPE).tolist(), ['c'], 0))
+	data, row_fields = m._take_batch()
+	m._emit_batch(m._score_batch(data, None, row_fields))
+	#batches scored by different models are not coalesced
+	m._flush_output()
+	outs = [json.loads(c.kwargs['formatted_msg']) for c in m.dataClient.publish_msg.call_args_list]
+	assert([(o['model_version'], o['id']) for o in outs] == [(None, ['a', 'b']), (2, ['c'])])
+	m.shutdown()
+
+def test_predict_coalesced_output(mocker):
+	m, _ = build_predict_client(mocker, cache_sz=1)
+	m.set_output_config(passthrough_fields=['id'], coalesce_ms=10000)
+	mocker.patch.object(m, '_score', side_effect=lambda data: data[:, 0])
+	for i in range(3):
+		m._on_message(None, None, IdMsg(np.random.rand(INPUT_DATA_SHAPE).tolist(), i, 0))
+	assert(wait_until(lambda: len(m._pending_output) == 3))
+	assert(m.dataClient.publish_msg.call_count == 0)
+	#the coalescing timer fires _flush_output
+	m._flush_output()
+	assert(m.dataClient.publish_msg.call_count == 1)
+	out = json.loads(m.dataClient.publish_msg.call_args.kwargs['formatted_msg'])
+	assert(out['id'] == [0, 1, 2])
+	assert(len(out['anomaly_score']) == 3)
+	m.shutdown()
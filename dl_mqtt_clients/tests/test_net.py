@@ -1,5 +1,6 @@
 from tensorflow import keras
 from dl_mqtt_clients import KerasNN
+from dl_mqtt_clients.net.net import SerializableWeights
 import numpy as np
 import pytest
 import logging
@@ -24,8 +25,56 @@ def test_serialize_net():
 	kNN = KerasNN()
 	kNN.set_model(keras_model=model)
 	orig_weights = kNN.model.get_weights()
-	weights = kNN.serialize_model_weights(precision=8)
+	weights = kNN.serialize_model_weights(precision=8, wire_format='jsonpickle')
 	assert(type(weights)==str)
+	weights = kNN.serialize_model_weights(precision=8)
+	assert(type(weights)==bytes)
+
+@pytest.mark.serialize
+def test_deserialize_binary_float():
+	model = build_model()
+	kNN = KerasNN()
+	kNN.set_model(keras_model=model)
+	orig_weights = kNN.model.get_weights()
+	weights = kNN.serialize_model_weights(precision=32, wire_format='binary')
+	ds_weights = kNN.deserialize_weights(payload=weights)
+	assert(len(ds_weights)==len(orig_weights))
+	for i in range(len(ds_weights)):
+		assert(ds_weights[i].dtype==np.float32)
+		assert(np.array_equal(ds_weights[i], orig_weights[i]))
+
+@pytest.mark.serialize
+def test_deserialize_wire_format_detection():
+	model = build_model()
+	kNN = KerasNN()
+	kNN.set_model(keras_model=model)
+	binary = kNN.deserialize_weights(payload=kNN.serialize_model_weights(precision=8, wire_format='binary'))
+	legacy = kNN.deserialize_weights(payload=kNN.serialize_model_weights(precision=8, wire_format='jsonpickle').encode('utf8'))
+	for i in range(len(binary)):
+		assert(np.array_equal(binary[i], legacy[i]))
+
+@pytest.mark.serialize
+def test_serializable_weights_frame():
+	weights = [np.random.randn(4, 3).astype(np.float32), np.random.randn(3).astype(np.float32)]
+	s = SerializableWeights(keras_weights=weights, precision=32, minV=np.float32(-1.0), maxV=np.float32(1.0))
+	ds = SerializableWeights.decode(s.encode(wire_format='binary'))
+	assert(ds.precision==32)
+	assert(type(ds.minV)==np.float32)
+	for i in range(len(weights)):
+		assert(ds.weights[i].shape==weights[i].shape)
+		assert(np.array_equal(ds.weights[i], weights[i]))
+	with pytest.raises(ValueError):
+		SerializableWeights.decode(s.encode(wire_format='binary')[:40])
+
+@pytest.mark.serialize
+def test_serializable_weights_train_stats():
+	weights = [np.random.randn(4, 3).astype(np.float32)]
+	for wire_format in SerializableWeights.wire_formats:
+		s = SerializableWeights.from_keras_weights(keras_weights=weights, precision=8)
+		assert(SerializableWeights.decode(s.encode(wire_format=wire_format)).num_samples is None)
+		s.set_train_stats(num_samples=np.int64(64), epochs=3, loss=np.float32(0.25))
+		ds = SerializableWeights.decode(s.encode(wire_format=wire_format))
+		assert(ds.num_samples==64 and ds.epochs==3 and np.isclose(ds.loss, 0.25))
 
 @pytest.mark.serialize
 def test_deserialize_8bit():
@@ -65,7 +114,8 @@ def test_fit_model():
 	kNN = KerasNN()
 	kNN.set_model(keras_model=model)
 	data = np.random.randn(batch_size, INPUT_DATA_SHAPE)
-	kNN.fit_model(train_data=data, labels=data, batch_size=4, epochs=10, verbose=0)
+	history = kNN.fit_model(train_data=data, labels=data, batch_size=4, epochs=10, verbose=0)
+	assert(len(history.history['loss'])==10)
 
 @pytest.mark.init
 def test_update_weights():
@@ -76,4 +126,69 @@ def test_update_weights():
 	new_weights = [np.random.randn(3, 10) for i in range(7)]
 	assert(not kNN.update_weights(new_weights))
 	new_weights = [np.random.randn(*i.shape) for i in model.get_weights()]
-	assert(kNN.update_weights(new_weights))
\ No newline at end of file
+	assert(kNN.update_weights(new_weights))
+
+@pytest.mark.serialize
+def test_deserialize_quant_modes():
+	model = build_model()
+	kNN = KerasNN()
+	kNN.set_model(keras_model=model)
+	orig_weights = kNN.model.get_weights()
+	for wire_format in SerializableWeights.wire_formats:
+		for quant_mode in SerializableWeights.quant_modes:
+			weights = kNN.serialize_model_weights(precision=8, wire_format=wire_format, quant_mode=quant_mode)
+			ds_weights = kNN.deserialize_weights(payload=weights)
+			assert(len(ds_weights)==len(orig_weights))
+			for i in range(len(ds_weights)):
+				assert(np.allclose(ds_weights[i], orig_weights[i], atol=1e-2))
+
+@pytest.mark.serialize
+def test_deserialize_packed():
+	model = build_model()
+	kNN = KerasNN()
+	kNN.set_model(keras_model=model)
+	orig_weights = kNN.model.get_weights()
+	for precision in [2, 4]:
+		weights = kNN.serialize_model_weights(precision=precision, quant_mode='layer')
+		ds_weights = kNN.deserialize_weights(payload=weights)
+		for i in range(len(ds_weights)):
+			assert(ds_weights[i].shape==orig_weights[i].shape)
+	assert(len(kNN.serialize_model_weights(precision=4)) < len(kNN.serialize_model_weights(precision=8)))
+
+@pytest.mark.serialize
+def test_serialize_payload_cache():
+	kNN = KerasNN()
+	kNN.set_model(keras_model=build_model())
+	version = kNN.weight_version
+	payload = kNN.serialize_model_weights(precision=8)
+	assert(kNN.serialize_model_weights(precision=8) is payload)
+	assert(kNN.serialize_model_weights(precision=16) is not payload)
+	for precision in [2, 4, 32]:
+		kNN.serialize_model_weights(precision=precision)
+	#evicted by the LRU
+	assert(len(kNN._payload_cache)==kNN.payload_cache_size)
+	assert(kNN.serialize_model_weights(precision=8) is not payload)
+	weights = kNN.model.get_weights()
+	weights[0] = weights[0] + 1.0
+	kNN.update_weights(weights)
+	assert(kNN.weight_version > version)
+	assert(len(kNN._payload_cache)==0)
+	assert(np.allclose(kNN.deserialize_weights(kNN.serialize_model_weights(precision=32))[0], weights[0]))
+
+@pytest.mark.init
+def test_predict_fast_path():
+	kNN = KerasNN()
+	kNN.set_model(keras_model=build_model())
+	data = np.random.rand(64, INPUT_DATA_SHAPE).astype(np.float32)
+	expected = kNN.model.predict(data, batch_size=32)
+	assert(np.allclose(kNN.predict(data), expected, atol=1e-5))
+	error = kNN.reconstruction_error(data)
+	assert(error.shape == (64,))
+	assert(np.allclose(error, np.linalg.norm(expected - data, axis=1), atol=1e-5))
+	#weight updates are picked up without retracing
+	weights = [w + 0.1 for w in kNN.model.get_weights()]
+	kNN.update_weights(weights)
+	assert(np.allclose(kNN.predict(data), kNN.model.predict(data, batch_size=32), atol=1e-5))
+	#large batches go through Model.predict
+	kNN.fast_path_max_batch = 16
+	assert(np.allclose(kNN.reconstruction_error(data), np.linalg.norm(kNN.model.predict(data) - data, axis=1), atol=1e-5))
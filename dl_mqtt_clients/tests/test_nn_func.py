@@ -66,6 +66,77 @@ def test_inflate_32bit():
     return
 
 
+@pytest.mark.compression
+def test_compress_16bit_dtype():
+    precision = 16
+    test_data = generate_weights_array(10)
+    wMin, wMax = nn_f.getMinMaxVals(test_data)
+    compress_data = nn_f.compress_keras_weights(test_data, precision, wMin, wMax)
+    for l in compress_data:
+        assert(l.dtype==np.uint16)
+    inflated_data = nn_f.inflate_keras_weights(compress_data, wMin, wMax, precision)
+    for l in range(len(test_data)):
+        assert(np.allclose(inflated_data[l], test_data[l], atol=1e-4))
+    return
+
+@pytest.mark.compression
+def test_pack_bits():
+    for precision in [2, 4]:
+        values = np.random.randint(0, 2**precision, size=(5, 7)).astype(np.uint8)
+        packed = nn_f.pack_bits(values, precision)
+        assert(packed.dtype==np.uint8)
+        assert(packed.size==int(np.ceil(values.size * precision / 8)))
+        assert(np.array_equal(nn_f.unpack_bits(packed, precision, values.shape), values))
+    return
+
+@pytest.mark.compression
+def test_inflate_packed():
+    test_data = generate_weights_array(10)
+    wMin, wMax = nn_f.getMinMaxVals(test_data)
+    shapes = [l.shape for l in test_data]
+    for precision in [2, 4]:
+        compress_data = nn_f.compress_keras_weights(test_data, precision, wMin, wMax)
+        inflated_data = nn_f.inflate_keras_weights(compress_data, wMin, wMax, precision, shapes=shapes)
+        for l in range(len(test_data)):
+            assert(inflated_data[l].shape==test_data[l].shape)
+            assert(np.allclose(inflated_data[l], test_data[l], atol=(wMax-wMin)/(2**precision-1)))
+        with pytest.raises(ValueError):
+            nn_f.inflate_keras_weights(compress_data, wMin, wMax, precision)
+    return
+
+@pytest.mark.compression
+def test_inflate_scaled_outlier():
+    precision = 8
+    test_data = generate_weights_array(10)
+    #outlier bias that would consume the global 8-bit range
+    test_data.append(np.array([500.0, -500.0]))
+    wMin, wMax = nn_f.getMinMaxVals(test_data)
+    global_data = nn_f.inflate_keras_weights(nn_f.compress_keras_weights(test_data, precision, wMin, wMax), wMin, wMax, precision)
+    assert(not np.allclose(global_data[0], test_data[0], atol=1e-2))
+    for per_channel in [False, True]:
+        compress_data, scales, zero_points = nn_f.compress_keras_weights_scaled(test_data, precision, per_channel=per_channel)
+        assert(all(l.dtype==np.uint8 for l in compress_data))
+        inflated_data = nn_f.inflate_keras_weights(compress_data, wMin, wMax, precision, scales=scales, zero_points=zero_points)
+        for l in range(len(test_data)-1):
+            assert(np.allclose(inflated_data[l], test_data[l], atol=1e-2))
+    assert(scales[0].shape==(7,))
+    assert(scales[-1].shape==())
+    return
+
+@pytest.mark.sparse
+def test_topk_sparsify():
+    test_data = generate_weights_array(3)
+    values, indices, residual = nn_f.topk_sparsify(test_data, 0.1)
+    assert(sum(0 if i is None else i.size for i in indices)==int(np.ceil(0.1 * 3 * 4 * 7)))
+    for l in range(len(test_data)):
+        rebuilt = residual[l].copy()
+        if indices[l] is not None:
+            assert(indices[l].dtype==np.int32)
+            rebuilt.reshape(-1)[indices[l]] += values[l]
+        assert(np.allclose(rebuilt, test_data[l]))
+    smallest_sent = min(np.min(np.abs(v)) for v in values if v is not None)
+    assert(all(np.max(np.abs(r)) <= smallest_sent for r in residual))
+    return
 
 @pytest.mark.generalfunc
 def test_weight_list_same_dim():
@@ -78,4 +149,56 @@ def test_weight_list_same_dim():
     with pytest.raises(TypeError) as exc_info:
         nn_f.is_weight_list_same_dim(test_data1, test_data2)
     exception_raised = exc_info.value
-    assert(exception_raised)
\ No newline at end of file
+    assert(exception_raised)
+
+@pytest.mark.generalfunc
+def test_affine_scaler_matches_sklearn(tmpdir):
+    from sklearn.preprocessing import MinMaxScaler, StandardScaler
+    from dl_mqtt_clients.net.scaler import AffineScaler, export_scaler
+    fit_data = np.random.rand(200, 7) * 50 - 10
+    data = (np.random.rand(30, 7) * 50 - 10).astype(np.float32)
+    for sk_scaler in [MinMaxScaler().fit(fit_data), StandardScaler().fit(fit_data), StandardScaler(with_mean=False).fit(fit_data)]:
+        scaler = AffineScaler.from_sklearn(sk_scaler)
+        expected = sk_scaler.transform(data)
+        assert(np.allclose(nn_f.normalize_data(data, scaler), expected, atol=1e-5))
+        path = str(tmpdir.join('scaler.pkl'))
+        with open(path, 'wb') as f:
+            pickle.dump(sk_scaler, f)
+        export_scaler(path, str(tmpdir.join('scaler.npz')))
+        loaded = nn_f.load_scaler(str(tmpdir.join('scaler.npz')))
+        assert(isinstance(loaded, AffineScaler))
+        assert(isinstance(nn_f.load_scaler(path, affine=True), AffineScaler))
+        assert(isinstance(nn_f.load_scaler(path), type(sk_scaler)))
+        #in place on float32 batches
+        batch = data.copy()
+        scaled = nn_f.normalize_data(batch, loaded, copy=False)
+        assert(scaled is batch)
+        assert(np.allclose(batch, expected, atol=1e-5))
+    return
+
+@pytest.mark.generalfunc
+def test_flat_layout():
+    weights = [np.random.rand(4, 7).astype(np.float32), np.zeros((0,), dtype=np.float32), np.random.rand(7).astype(np.float32)]
+    layout = nn_f.FlatLayout(weights)
+    flat = layout.flatten(weights)
+    assert(flat.shape == (35,) and flat.dtype == np.float32)
+    for a, b in zip(layout.unflatten(flat), weights):
+        assert(np.array_equal(a, b))
+    assert(np.allclose(layout.layer_norms(flat), [np.linalg.norm(w) for w in weights]))
+    assert(np.array_equal(layout.flat_indices([np.array([1, 2]), None, np.array([0])]), [1, 2, 28]))
+    with pytest.raises(ValueError):
+        layout.flatten(weights[:2])
+
+@pytest.mark.generalfunc
+def test_merge_models_weighted_clipped():
+    models = [generate_weights_array(3) for i in range(4)]
+    merged = nn_f.merge_models(models)
+    for l in range(3):
+        assert(merged[l].shape == (4, 7) and merged[l].dtype == np.float32)
+        assert(np.allclose(merged[l], np.mean([m[l] for m in models], axis=0), atol=1e-6))
+    merged = nn_f.merge_models(models, sample_weights=[1, 0, 0, 3])
+    assert(np.allclose(merged[1], (models[0][1] + 3 * models[3][1]) / 4, atol=1e-6))
+    reference = [np.zeros((4, 7)) for l in range(3)]
+    far = [np.full((4, 7), 10.0) for l in range(3)]
+    merged = nn_f.merge_models([far, reference], clip_norm=1.0, reference=reference)
+    assert(np.isclose(np.linalg.norm(np.concatenate([np.ravel(l) for l in merged])), 0.5, atol=1e-5))
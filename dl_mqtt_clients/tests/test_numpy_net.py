@@ -0,0 +1,44 @@
+from dl_mqtt_clients import KerasNN
+from dl_mqtt_clients.net.numpy_net import NumpyNN
+from tests.test_net import build_model, INPUT_DATA_SHAPE
+import numpy as np
+import pytest
+
+def _load_numpy_net(model, tmpdir):
+	path = str(tmpdir.join('model.h5'))
+	model.save(path)
+	nNN = NumpyNN()
+	nNN.load_model(hdf5_filename=path)
+	return nNN
+
+def test_numpy_net_matches_keras(tmpdir):
+	model = build_model()
+	kNN = KerasNN()
+	kNN.set_model(keras_model=model)
+	nNN = _load_numpy_net(model, tmpdir)
+	assert(nNN.inputShape[1:]==kNN.inputShape[1:])
+	assert(nNN.outputShape[1:]==kNN.outputShape[1:])
+	weights = nNN.get_weights()
+	for a, b in zip(weights, kNN.get_weights()):
+		assert(np.array_equal(a, b))
+	data = np.random.rand(50, INPUT_DATA_SHAPE).astype(np.float32)
+	assert(np.allclose(nNN.predict(data), kNN.predict(data), atol=1e-5))
+	assert(np.allclose(nNN.reconstruction_error(data), kNN.reconstruction_error(data), atol=1e-4))
+	with pytest.raises(ValueError):
+		nNN.predict(np.random.rand(5, INPUT_DATA_SHAPE + 1).astype(np.float32))
+
+@pytest.mark.serialize
+def test_numpy_net_update_from_payload(tmpdir):
+	model = build_model()
+	nNN = _load_numpy_net(model, tmpdir)
+	kNN = KerasNN()
+	kNN.set_model(keras_model=build_model())
+	_version = nNN.weight_version
+	assert(nNN.update_weights_from_payload(kNN.serialize_model_weights(precision=32)))
+	assert(nNN.weight_version > _version)
+	data = np.random.rand(20, INPUT_DATA_SHAPE).astype(np.float32)
+	assert(np.allclose(nNN.predict(data), kNN.predict(data), atol=1e-5))
+	#payloads serialized by the numpy backend are accepted by keras
+	assert(kNN.update_weights_from_payload(_load_numpy_net(model, tmpdir).serialize_model_weights(precision=32)))
+	assert(np.allclose(kNN.predict(data), model.predict(data, verbose=0), atol=1e-5))
+	assert(not nNN.update_weights(weights=nNN.get_weights()[:-1]))
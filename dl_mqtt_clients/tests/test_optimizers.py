@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+from dl_mqtt_clients.model_server.optimizers import ServerOptimizer, FedAvgM, FedAdam, get_server_optimizer, load_server_optimizer
+
+def random_model():
+    return [np.random.randn(8, 4).astype(np.float32), np.random.randn(4).astype(np.float32)]
+
+def shifted(model, step):
+    return [layer + np.float32(step) for layer in model]
+
+@pytest.mark.server
+def test_fedavg():
+    model, averaged = random_model(), random_model()
+    for merged, layer in zip(ServerOptimizer().step(model, averaged), averaged):
+        assert(np.array_equal(merged, layer))
+    for merged, start, layer in zip(ServerOptimizer(lr=0.5).step(model, averaged), model, averaged):
+        assert(np.allclose(merged, (start + layer) / 2, atol=1e-6))
+
+@pytest.mark.server
+def test_fedavgm():
+    opt = FedAvgM(lr=1.0, momentum=0.5)
+    model = random_model()
+    model = opt.step(model, shifted(model, 1.0))
+    #the second step adds half of the first one on top of its own delta
+    new = opt.step(model, shifted(model, 1.0))
+    for merged, layer in zip(new, model):
+        assert(np.allclose(merged, layer + 1.5, atol=1e-5))
+    with pytest.raises(ValueError):
+        FedAvgM(momentum=1.0)
+
+@pytest.mark.server
+def test_fedadam():
+    opt = FedAdam(lr=0.1, beta1=0.0, beta2=0.0, epsilon=1e-6)
+    model = random_model()
+    #with no moment decay the step is lr * sign(delta)
+    for merged, layer in zip(opt.step(model, shifted(model, -3.0)), model):
+        assert(np.allclose(merged, layer - 0.1, atol=1e-4))
+    assert(opt.steps == 1)
+
+@pytest.mark.server
+def test_optimizer_state(tmp_path):
+    path = str(tmp_path / 'opt.npz')
+    model = random_model()
+    opt = get_server_optimizer('fedadam', momentum=0.9)
+    model = opt.step(model, shifted(model, 1.0))
+    opt.save(path)
+    restored = load_server_optimizer(get_server_optimizer('fedadam', momentum=0.9), path, model)
+    assert(restored.steps == 1)
+    for a, b in zip(opt.step(model, shifted(model, 1.0)), restored.step(model, shifted(model, 1.0))):
+        assert(np.array_equal(a, b))
+    #state of another optimizer or model is ignored
+    assert(load_server_optimizer(get_server_optimizer('fedavgm'), path, model).steps == 0)
+    assert(load_server_optimizer(get_server_optimizer('fedadam'), path, [np.zeros(3, dtype=np.float32)]).steps == 0)
+    with pytest.raises(ValueError):
+        get_server_optimizer('sgd')
+
+@pytest.mark.server
+def test_optimizer_state_truncated(tmp_path):
+    path = str(tmp_path / 'opt.npz')
+    model = random_model()
+    opt = get_server_optimizer('fedadam', momentum=0.9)
+    model = opt.step(model, shifted(model, 1.0))
+    opt.save(path)
+    assert(not (tmp_path / 'opt.npz.tmp').exists())
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[:len(data) // 2])
+    #a truncated file is ignored, the optimizer starts from scratch
+    restored = load_server_optimizer(get_server_optimizer('fedadam', momentum=0.9), path, model)
+    assert(restored.steps == 0 and restored.layout is None)
+    restored.step(model, shifted(model, 1.0))
+    assert(restored.steps == 1)
@@ -0,0 +1,41 @@
+from dl_mqtt_clients import KerasNN
+from dl_mqtt_clients.net.quantized import Reservoir
+from tests.test_net import build_model, INPUT_DATA_SHAPE
+import numpy as np
+import pytest
+import time
+
+def _wait_int8(kNN, timeout=30.0):
+	_deadline = time.time() + timeout
+	while kNN._int8 is None and time.time() < _deadline:
+		time.sleep(0.05)
+	return kNN._int8
+
+def test_reservoir_fill_and_window():
+	r = Reservoir(capacity=10, window=20)
+	r.add(np.arange(4, dtype=np.float32).reshape(4, 1))
+	assert(len(r)==4)
+	assert(np.array_equal(r.sample().ravel(), np.arange(4)))
+	r.add(np.arange(4, 1000, dtype=np.float32).reshape(-1, 1))
+	assert(len(r)==10)
+	#with a window of 20 the sample is drawn from recent rows
+	assert(r.sample().min() > 800)
+	with pytest.raises(ValueError):
+		Reservoir(capacity=10, window=5)
+
+def test_int8_inference_rebuilt_on_update():
+	kNN = KerasNN()
+	kNN.set_model(keras_model=build_model())
+	kNN.enable_int8_inference(calibration_size=64)
+	data = np.random.rand(32, INPUT_DATA_SHAPE).astype(np.float32)
+	_float = kNN.reconstruction_error(data)
+	kNN.reconstruction_error(np.random.rand(32, INPUT_DATA_SHAPE).astype(np.float32))
+	assert(_wait_int8(kNN) is not None)
+	assert(np.allclose(kNN.reconstruction_error(data), _float, atol=0.05))
+	#a new global model invalidates the int8 copy until it is rebuilt from the new weights
+	other = build_model()
+	assert(kNN.update_weights(weights=other.get_weights(), session='s', version=1))
+	_int8 = _wait_int8(kNN)
+	assert(_int8 is not None)
+	assert(np.allclose(_int8.predict(data), other.predict(data, verbose=0), atol=0.05))
+	assert(np.allclose(kNN.predict(data), other.predict(data, verbose=0), atol=0.05))
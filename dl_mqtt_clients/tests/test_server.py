@@ -0,0 +1,317 @@
+from dl_mqtt_clients.func._general_func import logging_format
+from dl_mqtt_clients.model_server.server import ModelAggregator
+from dl_mqtt_clients.net.weights import SerializableWeights
+from dl_mqtt_clients import configurations, KerasNN
+from tests.test_net import build_model
+import numpy as np
+import pytest
+from pytest_mock import mocker
+import logging
+import threading
+logging.basicConfig(format=logging_format(), level=logging.INFO)
+
+class FakeMsg():
+	def __init__(self, payload, topic='model/train/update'):
+		self.payload = payload
+		self.topic = topic
+
+@pytest.fixture(scope='session')
+def mqtt_config_d():
+	mqtt_config_d = {'host': 'localhost',
+					'port': 1883,
+					'sub_topics':['model/train/update'],
+					'pub_topic':'model/production/update',
+					'ssl_protocol': 'tls_12',
+					'keepalive': 10,
+					'sub_qos': 1,
+					'pub_qos': 0,
+					'mqtt_protocol': 311}
+	return mqtt_config_d
+
+@pytest.fixture(scope='session')
+def server_config_d():
+	server_config_d = {'precision': 32,
+					'num_rounds': 10,
+					'prod_pub_topic': 'model/global/update',
+					'model_cache_size': 2,
+					'merge_ratio': 1.0}
+	return server_config_d
+
+def build_aggregator(mqtt_config_d, server_config_d, mocker):
+	kNN = KerasNN()
+	kNN.set_model(keras_model=build_model())
+	aggregator = ModelAggregator(model=kNN,
+								mqtt_config=configurations.MQTTConnectionConfig(mqtt_config_d),
+								server_config=configurations.ModelServerConfig(server_config_d),
+								status_update_topic=None)
+	published = []
+	mocker.patch.object(aggregator.model_client, 'publish_msg', side_effect=lambda formatted_msg, pub_topic=None: published.append(formatted_msg))
+	return aggregator, published
+
+def build_client(aggregator):
+	kNN = KerasNN()
+	kNN.set_model(keras_model=build_model())
+	kNN.update_weights(aggregator.model.model.get_weights())
+	return kNN
+
+@pytest.mark.server
+def test_merge_full_updates(mqtt_config_d, server_config_d, mocker):
+	aggregator, published = build_aggregator(mqtt_config_d, server_config_d, mocker)
+	clients = [build_client(aggregator) for i in range(2)]
+	for c in clients:
+		aggregator.on_message_model(None, None, FakeMsg(c.serialize_model_weights(precision=32)))
+	assert(len(published)==1)
+	assert(len(aggregator.weight_cache)==0)
+	expected = [np.mean([c.model.get_weights()[i] for c in clients], axis=0) for i in range(len(clients[0].model.get_weights()))]
+	merged = clients[0].deserialize_weights(published[0])
+	for i in range(len(expected)):
+		assert(np.allclose(merged[i], expected[i], atol=1e-6))
+
+@pytest.mark.server
+def test_delta_updates(mqtt_config_d, server_config_d, mocker):
+	aggregator, published = build_aggregator(mqtt_config_d, server_config_d, mocker)
+	clients = [build_client(aggregator) for i in range(2)]
+	#first round, no global model received yet so updates are sent in full
+	for c in clients:
+		aggregator.on_message_model(None, None, FakeMsg(c.serialize_model_weights(precision=32, delta=True)))
+	for c in clients:
+		assert(c.update_weights_from_payload(published[-1]))
+		assert(c.global_version==1)
+	#second round, local training only changed the first layer so only that layer is sent
+	for c in clients:
+		weights = c.model.get_weights()
+		weights[0] = weights[0] + 0.5
+		c.model.set_weights(weights)
+	payloads = [c.serialize_model_weights(precision=32, delta=True, delta_threshold=1e-6) for c in clients]
+	assert(len(payloads[0]) < len(clients[0].serialize_model_weights(precision=32)))
+	for p in payloads:
+		aggregator.on_message_model(None, None, FakeMsg(p))
+	assert(len(published)==2)
+	merged = clients[0].deserialize_weights(published[-1])
+	for i, layer in enumerate(clients[0].model.get_weights()):
+		assert(np.allclose(merged[i], layer, atol=1e-6))
+
+@pytest.mark.server
+def test_delta_unknown_base(mqtt_config_d, server_config_d, mocker):
+	aggregator, published = build_aggregator(mqtt_config_d, server_config_d, mocker)
+	c = build_client(aggregator)
+	c.update_weights(c.model.get_weights(), session='other', version=3)
+	aggregator.on_message_model(None, None, FakeMsg(c.serialize_model_weights(precision=32, delta=True)))
+	assert(len(aggregator.weight_cache)==0)
+
+@pytest.mark.server
+def test_sparse_updates(mqtt_config_d, server_config_d, mocker):
+	aggregator, published = build_aggregator(mqtt_config_d, server_config_d, mocker)
+	clients = [build_client(aggregator) for i in range(2)]
+	for c in clients:
+		aggregator.on_message_model(None, None, FakeMsg(c.serialize_model_weights(precision=32)))
+	for c in clients:
+		c.update_weights_from_payload(published[-1])
+	base = [np.copy(w) for w in clients[0].model.get_weights()]
+	updates = []
+	for c in clients:
+		weights = c.model.get_weights()
+		weights[-1] = weights[-1] + np.random.rand(*weights[-1].shape)
+		c.model.set_weights(weights)
+		updates.append(weights[-1] - base[-1])
+	payloads = [c.serialize_model_weights(precision=32, topk_ratio=0.05) for c in clients]
+	assert(len(payloads[0]) < len(clients[0].serialize_model_weights(precision=32)) / 4)
+	for p in payloads:
+		aggregator.on_message_model(None, None, FakeMsg(p))
+	merged = clients[0].deserialize_weights(published[-1])
+	#only the top entries were applied, the rest is kept in the client residual
+	for i in range(len(base)-1):
+		assert(np.allclose(merged[i], base[i], atol=1e-6))
+	residual_mean = np.mean([c._sparse_residual[-1] for c in clients], axis=0)
+	assert(np.allclose(merged[-1] + residual_mean, base[-1] + np.mean(updates, axis=0), atol=1e-5))
+
+@pytest.mark.server
+def test_sparse_resend_same_base(mqtt_config_d, server_config_d, mocker):
+	aggregator, published = build_aggregator(mqtt_config_d, server_config_d, mocker)
+	clients = [build_client(aggregator) for i in range(2)]
+	for c in clients:
+		aggregator.on_message_model(None, None, FakeMsg(c.serialize_model_weights(precision=32)))
+	c = clients[0]
+	c.update_weights_from_payload(published[-1])
+	base = [np.copy(w) for w in c.model.get_weights()]
+	c.model.set_weights([w + np.random.rand(*w.shape).astype(np.float32) for w in base])
+	local = c.model.get_weights()
+	#sent twice against the same global model, both payloads rebuild the sent entries exactly
+	for r in range(2):
+		serialW = SerializableWeights.decode(c.serialize_model_weights(precision=32, topk_ratio=0.1))
+		for index, value, b, l in zip(serialW.indices, serialW.inflate(), base, local):
+			if index is not None:
+				assert(np.allclose(b.reshape(-1)[index] + value.reshape(-1), l.reshape(-1)[index], atol=1e-5))
+
+def run_round(aggregator, clients, published, step):
+	for c in clients:
+		weights = c.model.get_weights()
+		weights[0] = weights[0] + step
+		c.model.set_weights(weights)
+		aggregator.on_message_model(None, None, FakeMsg(c.serialize_model_weights(precision=32)))
+	return published[-1]
+
+@pytest.mark.server
+def test_delta_downlink(mqtt_config_d, server_config_d, mocker):
+	config_d = dict(server_config_d, downlink_mode='delta', keyframe_interval=3)
+	aggregator, published = build_aggregator(mqtt_config_d, config_d, mocker)
+	clients = [build_client(aggregator) for i in range(2)]
+	for r in range(4):
+		payload = run_round(aggregator, clients, published, 0.1)
+		for c in clients:
+			assert(c.update_weights_from_payload(payload))
+			assert(c.global_version==aggregator._model_version)
+	#keyframe, delta, delta, keyframe; the unchanged layers are left out of the deltas
+	full_sz = len(published[0])
+	assert(len(published[1]) < full_sz and len(published[2]) < full_sz)
+	assert(len(published[3]) == full_sz)
+	for i, layer in enumerate(aggregator._version_history[aggregator._model_version]):
+		assert(np.allclose(clients[0].model.get_weights()[i], layer, atol=1e-6))
+
+@pytest.mark.server
+def test_delta_downlink_late_joiner(mqtt_config_d, server_config_d, mocker):
+	config_d = dict(server_config_d, downlink_mode='delta', keyframe_interval=3, downlink_topk_ratio=0.5)
+	aggregator, published = build_aggregator(mqtt_config_d, config_d, mocker)
+	clients = [build_client(aggregator) for i in range(2)]
+	late = build_client(aggregator)
+	for r in range(4):
+		payload = run_round(aggregator, clients, published, 0.1)
+		for c in clients:
+			assert(c.update_weights_from_payload(payload))
+		#the late joiner missed the first keyframe, deltas are ignored until the next one
+		if r > 0:
+			assert(late.update_weights_from_payload(payload) == (r == 3))
+	for i, layer in enumerate(clients[0].model.get_weights()):
+		assert(np.allclose(late.model.get_weights()[i], layer, atol=1e-6))
+
+@pytest.mark.server
+def test_sample_weighted_merge(mqtt_config_d, server_config_d, mocker):
+	config_d = dict(server_config_d, target_loss=0.5)
+	aggregator, published = build_aggregator(mqtt_config_d, config_d, mocker)
+	clients = [build_client(aggregator) for i in range(2)]
+	clients[0].model.set_weights([w + 1.0 for w in clients[0].model.get_weights()])
+	stats = [{'num_samples': 30, 'epochs': 2, 'loss': 1.0}, {'num_samples': 10, 'epochs': 2, 'loss': 0.2}]
+	for c, s in zip(clients, stats):
+		aggregator.on_message_model(None, None, FakeMsg(c.serialize_model_weights(precision=32, train_stats=s)))
+	merged = clients[0].deserialize_weights(published[-1])
+	for i in range(len(merged)):
+		expected = 0.75 * clients[0].model.get_weights()[i] + 0.25 * clients[1].model.get_weights()[i]
+		assert(np.allclose(merged[i], expected, atol=1e-5))
+	assert(np.isclose(aggregator.loss_history[-1], 0.8))
+	assert(aggregator.target_loss_round is None)
+	#the stats are part of the memoized payload key
+	stats = [{'num_samples': 10, 'epochs': 1, 'loss': 0.4}, {'num_samples': 10, 'epochs': 1, 'loss': 0.2}]
+	for c, s in zip(clients, stats):
+		aggregator.on_message_model(None, None, FakeMsg(c.serialize_model_weights(precision=32, train_stats=s)))
+	assert(np.isclose(aggregator.loss_history[-1], 0.3))
+	assert(aggregator.target_loss_round == 2)
+
+@pytest.mark.server
+def test_uniform_weighting(mqtt_config_d, server_config_d, mocker):
+	config_d = dict(server_config_d, update_weighting='uniform')
+	aggregator, published = build_aggregator(mqtt_config_d, config_d, mocker)
+	clients = [build_client(aggregator) for i in range(2)]
+	clients[0].model.set_weights([w + 1.0 for w in clients[0].model.get_weights()])
+	for c, n in zip(clients, [30, 10]):
+		aggregator.on_message_model(None, None, FakeMsg(c.serialize_model_weights(precision=32, train_stats={'num_samples': n})))
+	merged = clients[0].deserialize_weights(published[-1])
+	for i in range(len(merged)):
+		expected = 0.5 * clients[0].model.get_weights()[i] + 0.5 * clients[1].model.get_weights()[i]
+		assert(np.allclose(merged[i], expected, atol=1e-5))
+
+@pytest.mark.server
+def test_first_round_clip(mqtt_config_d, server_config_d, mocker):
+	config_d = dict(server_config_d, update_clip_norm=0.5)
+	aggregator, published = build_aggregator(mqtt_config_d, config_d, mocker)
+	clients = [build_client(aggregator) for i in range(2)]
+	start = aggregator.model.get_weights()
+	clients[0].model.set_weights([w + 1.0 for w in start])
+	for c in clients:
+		aggregator.on_message_model(None, None, FakeMsg(c.serialize_model_weights(precision=32)))
+	#the first round is already clipped against the initial model, the outlier moves the average by half the clip norm
+	merged = clients[0].deserialize_weights(published[-1])
+	assert(np.isclose(np.sqrt(sum(np.sum(np.square(m - w)) for m, w in zip(merged, start))), 0.25, atol=1e-4))
+
+@pytest.mark.server
+def test_server_momentum(mqtt_config_d, server_config_d, mocker, tmp_path):
+	config_d = dict(server_config_d, server_optimizer='fedavgm', server_momentum=0.5, optimizer_state_path=str(tmp_path / 'opt.npz'))
+	aggregator, published = build_aggregator(mqtt_config_d, config_d, mocker)
+	clients = [build_client(aggregator) for i in range(2)]
+	start = aggregator.model.get_weights()
+	payload = run_round(aggregator, clients, published, 0.1)
+	for c in clients:
+		assert(c.update_weights_from_payload(payload))
+	payload = run_round(aggregator, clients, published, 0.1)
+	#the second round moves by its own 0.1 average change plus half of the first round's step
+	merged = clients[0].deserialize_weights(payload)
+	assert(np.allclose(merged[0], start[0] + 0.25, atol=1e-5))
+	assert(np.allclose(merged[1], start[1], atol=1e-6))
+	restarted, _ = build_aggregator(mqtt_config_d, config_d, mocker)
+	assert(restarted.server_optimizer.steps == 2)
+
+@pytest.mark.server
+def test_async_aggregation(mqtt_config_d, server_config_d, mocker):
+	config_d = dict(server_config_d, aggregation_mode='async', async_alpha=0.5, staleness_exponent=1.0)
+	aggregator, published = build_aggregator(mqtt_config_d, config_d, mocker)
+	clients = [build_client(aggregator) for i in range(2)]
+	start = aggregator.model.get_weights()
+	assert(not aggregator.publish_async())
+	c = clients[0]
+	c.model.set_weights([w + 1.0 for w in start])
+	c._bump_weight_version()
+	aggregator.on_message_model(None, None, FakeMsg(c.serialize_model_weights(precision=32)))
+	#updates are mixed in without waiting for model_cache_size of them
+	assert(len(published)==0)
+	assert(aggregator.publish_async())
+	assert(len(published)==1 and aggregator._model_version==1)
+	for c in clients:
+		assert(c.update_weights_from_payload(published[-1]))
+	merged = clients[0].deserialize_weights(published[-1])
+	for i in range(len(start)):
+		assert(np.allclose(merged[i], start[i] + 0.5, atol=1e-6))
+	#a client still on version 1 after two more publishes is mixed in with a third of the weight
+	for r in range(2):
+		clients[0].model.set_weights(merged)
+		clients[0]._bump_weight_version()
+		aggregator.on_message_model(None, None, FakeMsg(clients[0].serialize_model_weights(precision=32)))
+		assert(aggregator.publish_async())
+	stale = [w + 1.0 for w in clients[1].model.get_weights()]
+	clients[1].model.set_weights(stale)
+	clients[1]._bump_weight_version()
+	aggregator.on_message_model(None, None, FakeMsg(clients[1].serialize_model_weights(precision=32, delta=True)))
+	assert(aggregator.publish_async())
+	final = clients[0].deserialize_weights(published[-1])
+	for i in range(len(start)):
+		assert(np.allclose(final[i], merged[i] + 0.5 / 3, atol=1e-5))
+
+@pytest.mark.server
+def test_async_concurrent_publish(mqtt_config_d, server_config_d, mocker):
+	config_d = dict(server_config_d, aggregation_mode='async', version_history_size=1)
+	aggregator, published = build_aggregator(mqtt_config_d, config_d, mocker)
+	c = build_client(aggregator)
+	payloads = []
+	for r in range(3):
+		c.model.set_weights([w + 0.1 for w in c.model.get_weights()])
+		c._bump_weight_version()
+		aggregator.on_message_model(None, None, FakeMsg(c.serialize_model_weights(precision=32)))
+		aggregator.publish_async()
+		c.update_weights_from_payload(published[-1])
+		payloads.append(c.serialize_model_weights(precision=32, delta=True))
+	#delta updates arriving while the timer thread publishes (and evicts their base) are mixed or dropped, never raise
+	stop, errors = threading.Event(), []
+	def publish():
+		while not stop.is_set():
+			try:
+				aggregator.on_message_model(None, None, FakeMsg(c.serialize_model_weights(precision=32)))
+				aggregator.publish_async()
+			except Exception as e:
+				errors.append(e)
+	publisher = threading.Thread(target=publish)
+	publisher.start()
+	try:
+		for i in range(50):
+			aggregator.on_message_model(None, None, FakeMsg(payloads[i % len(payloads)]))
+	finally:
+		stop.set()
+		publisher.join()
+	assert(errors == [])
@@ -5,7 +5,7 @@ import yaml
 import signal
 
 from datetime import datetime
-from dl_mqtt_clients import configurations, KerasNN
+from dl_mqtt_clients import configurations
 
 logger = logging.getLogger(__name__)
 
@@ -92,7 +92,19 @@ def set_mqtt_configuration(config_dict):
 def set_entrypoint(function_type, config_dict, config_errors):
     config_dict, predict_mqtt_c, training_mqtt_c, manager_mqtt_c = set_mqtt_configuration(config_dict)  
     
-    n = KerasNN()
+    #predict nodes may run the TensorFlow-free NumPy backend, everything else needs Keras
+    backend = config_dict['nn_config'].get('backend', 'keras')
+    if function_type == "predict" and backend == "numpy":
+        from dl_mqtt_clients.net.numpy_net import NumpyNN
+        n = NumpyNN()
+    else:
+        if backend != "keras":
+            logger.error('Invalid nn_config/backend: {} (numpy is only supported for predict)'.format(backend))
+            config_errors = True
+        from dl_mqtt_clients import KerasNN
+        n = KerasNN()
+        if function_type == "predict" and config_dict['nn_config'].get('int8_inference', False):
+            n.enable_int8_inference(calibration_size=config_dict['nn_config'].get('calibration_size', 256))
     try:
         n.load_model(hdf5_filename=config_dict['nn_config']['model_path'])
     except KeyError:
@@ -103,12 +115,10 @@ def set_entrypoint(function_type, config_dict, config_errors):
         #Importing train/predict specific functionality
         from dl_mqtt_clients import ad_mosqeras
         from dl_mqtt_clients.func._nn_func import load_scaler
-        from dl_mqtt_clients.payload_serializers.JSONSerializer import JSONSerializer
-        
-        s = JSONSerializer()
+        from dl_mqtt_clients.payload_serializers import get_serializer
 	      
         try:
-	          scaler = load_scaler(h5_path=config_dict['nn_config']['scaler_path'])
+	          scaler = load_scaler(h5_path=config_dict['nn_config']['scaler_path'], affine=config_dict['nn_config'].get('affine_scaler', False))
         except KeyError:
             logger.error('KeyError: missing nn_config/scaler_path')
             config_errors=True
@@ -120,9 +130,32 @@ def set_entrypoint(function_type, config_dict, config_errors):
             entrypoint = ad_mosqeras.predict_client(model = n, 
                                                     sk_scaler = scaler, 
                                                     mqtt_config = predict_mqtt_c, 
-                                                    serializer = s,
+                                                    serializer = get_serializer(predict_mqtt_c.serializer()),
                                                     model_update_topic = config_dict['nn_config']['model_update_topic'],
                                                     cache_sz = config_dict['predict_mqtt_topics']['cache_size'])
+            try:
+                entrypoint.set_executor_config(workers=config_dict['predict_mqtt_topics'].get('inference_workers', 1),
+                                               max_queue=config_dict['predict_mqtt_topics'].get('inference_queue_size', 4),
+                                               overflow=config_dict['predict_mqtt_topics'].get('overflow_policy', 'block'))
+            except ValueError as e:
+                logger.error('Invalid predict_mqtt_topics inference configuration: {}'.format(e))
+                config_errors = True
+            if config_dict['predict_mqtt_topics'].get('batched_output'):
+                try:
+                    entrypoint.set_output_config(passthrough_fields=config_dict['predict_mqtt_topics'].get('passthrough_fields') or [],
+                                                 coalesce_ms=config_dict['predict_mqtt_topics'].get('coalesce_ms'))
+                except ValueError as e:
+                    logger.error('Invalid predict_mqtt_topics output configuration: {}'.format(e))
+                    config_errors = True
+            if config_dict['predict_mqtt_topics'].get('score_cache_size'):
+                entrypoint.set_score_cache(max_size=config_dict['predict_mqtt_topics']['score_cache_size'])
+            if config_dict['predict_mqtt_topics'].get('max_latency_ms'):
+                try:
+                    entrypoint.set_batching_config(max_latency_ms=config_dict['predict_mqtt_topics']['max_latency_ms'],
+                                                   p99_target_ms=config_dict['predict_mqtt_topics'].get('p99_target_ms'))
+                except ValueError as e:
+                    logger.error('Invalid predict_mqtt_topics batching configuration: {}'.format(e))
+                    config_errors = True
         
                                                                                                                                                                     
         elif function_type == "train":
@@ -137,10 +170,16 @@ def set_entrypoint(function_type, config_dict, config_errors):
        	    entrypoint = ad_mosqeras.train_client(model = n, 
 								                                  sk_scaler = scaler, 
 								                                  mqtt_config = training_mqtt_c,
-							                                    serializer = s,
+							                                    serializer = get_serializer(training_mqtt_c.serializer()),
 						                                      model_update_topic = config_dict['nn_config']['model_update_topic'],
 								                                  cache_sz = config_dict['training_mqtt_topics']['cache_size'])
             entrypoint.set_train_config(k_c)   
+        if config_dict['nn_config'].get('features'):
+            try:
+                entrypoint.set_feature_order(config_dict['nn_config']['features'])
+            except ValueError as e:
+                logger.error('Invalid nn_config features: {}'.format(e))
+                config_errors = True
                
     elif function_type == "merge_model":  
         #Importing merge_model specific functionality
@@ -6,6 +6,7 @@ import logging
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.metrics import f1_score, confusion_matrix
 from preprocess import prepare_dataset
+from dl_mqtt_clients.net.scaler import AffineScaler
 
 logging.basicConfig(level = logging.INFO)
 
@@ -30,6 +31,8 @@ def create_scaler(df, scaler_file):
     scaler.fit(feats)
     print(f"Finished with scalar. Writing to {scaler_file}")
     pickle.dump( scaler, open( scaler_file, 'wb' ) )
+    # Affine export (scale, offset) loaded by the predict / train services without sklearn
+    AffineScaler.from_sklearn(scaler).save(f"{scaler_file}.npz")
     
 def train(df, scaler, epochs, model_output_path):
     # checkpoint_path = "model.ckpt"